@@ -31,6 +31,7 @@ import time
 import closure
 import deps as DEPS
 import paths as PATHS
+import scheduler as SCHEDULER
 import utils
 
 
@@ -89,26 +90,49 @@ class Bundle(object):
       self.copy_targets[target_name] = targets_dict[target_name]
 
   def Construct(self, verbose, deps, start_msg=None, fail_early=True,
-                deps_root=''):
+                deps_root='', jobs=None):
+    """Compiles the targets of the bundle, then copies its files.
+
+    To share the compile jobs with other bundles, call QueueCompiles on each
+    of them with the same scheduler, run it, then call Copy.
+    """
     if start_msg is not None:
       print start_msg
 
-    # Prepare data
+    # Start bundling process
+    current_time = time.time()
+
+    scheduler = SCHEDULER.Scheduler(jobs=jobs, fail_early=fail_early)
+    self.QueueCompiles(scheduler, verbose, deps, deps_root=deps_root)
+    if verbose:
+      print '%sCompiling soy templates and JavaScript files ...' % (
+          utils.GetIndentString(2))
+    if not scheduler.Run() and fail_early:
+      exit()
+    if verbose:
+      scheduler.PrintReport(indent=2)
+
+    self.Copy(verbose)
+
+    print 'Total time elapsed %s (s)' % (time.time() - current_time)
+    if verbose:
+      print ''
+
+  def QueueCompiles(self, scheduler, verbose, deps, deps_root=''):
+    """Queues the compiles of the soy and JavaScript targets."""
     soy_command = closure.CreateSoyCompilerCommand(deps, self.soy_flags,
                                                    deps_location=deps_root)
     compiler_command = closure.CreateClosureCompilerCommand(deps,
         self.compiler_flags, self.compiler_controls, deps_location=deps_root)
 
-    # Start bundling process
-    current_time = time.time()
-
-    _CompileTargets(soy_command, self.soy_targets, verbose,
-                    fail_early=fail_early, indent=2,
-                    start_msg='Compiling soy templates ...')
-    _CompileTargets(compiler_command, self.js_targets, verbose,
-                    fail_early=fail_early, indent=2,
-                    start_msg='Compiling JavaScript files ...')
+    soy_jobs = _QueueTargets(scheduler, soy_command, self.soy_targets,
+                             verbose, indent=2)
+    # The compiled soy templates are JavaScript inputs.
+    _QueueTargets(scheduler, compiler_command, self.js_targets, verbose,
+                  indent=2, after=soy_jobs)
 
+  def Copy(self, verbose):
+    """Copies the files of the bundle, including the compiled targets."""
     if verbose:
       print '%sCopying target library and files ...' % utils.GetIndentString(2)
 
@@ -131,10 +155,6 @@ class Bundle(object):
       s = utils.GetIndentString(2)
       print '%s[SUCCESS] Bundle construction complete.' % s
 
-    print 'Total time elapsed %s (s)' % (time.time() - current_time)
-    if verbose:
-      print ''
-
   def CreateJsTargets(self, src_location, dst_location):
     return {}
 
@@ -158,50 +178,9 @@ def AddTargets(names, targets, src_root, dst_root, src_ext, dst_ext,
     }
 
 
-def _CompileTargets(command, targets, verbose, fail_early, indent=0,
-                    start_msg=None):
-  indent_string = utils.GetIndentString(indent)
-
-  # List of processes not yet completed (when added to list).
-  ps = []
-
-  # Start compile process for each target and append it to ps if no_wait is
-  # True.  no_wait means the processes will run simultaneously as possible.
-  # For each process with no_wait == False, they will be completed immediately
-  # so no need to wait for them.
-  for target_name in targets:
-    src = targets[target_name][SRC]
-    dst = targets[target_name][DST]
-
-    # Ensure the directory structure exists for the destination file.
-    (path, _) = os.path.split(dst)
-    if not os.path.exists(path):
-      os.makedirs(path)
-
-    # Callback once the compile process completes.  Used in asynchronous build
-    # environment.
-    on_complete = closure.OnComplete(src, dst, verbose, fail_early=False,
-                                     indent=indent)
-
-    # Start compile process
-    cs = closure.CompileScript(src, dst, command, on_complete)
-    # Only add process to ps if it is not done.
-    if cs is not None and cs[utils.SUCCESS] is None:
-      ps.append(cs)
-    # If compiling fails and fail_early is true then kill all currently pending
-    # processes and exit.
-    elif fail_early and cs is not None and not cs[utils.SUCCESS]:
-      for p in ps:
-        utils.KillSubprocess(p)
-      exit()
-
-  if verbose and len(ps) and start_msg is not None:
-    print '%s%s' % (indent_string, start_msg)
-
-  # Wait for all compile processes to finish and check for failure.
-  if not utils.WaitUntilSubprocessesFinished(ps, fail_early=fail_early):
-    if fail_early:
-      exit()
-
-  if verbose and len(ps) and start_msg is not None:
-    print ''
+def _QueueTargets(scheduler, command, targets, verbose, indent=0,
+                  after=None):
+  """Queues the compile of each target; returns the list of jobs."""
+  return [scheduler.Add(targets[target_name][SRC], targets[target_name][DST],
+                        command, verbose, indent=indent, after=after)
+          for target_name in targets]
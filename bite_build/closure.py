@@ -30,8 +30,13 @@ import utils
 
 COMMAND = 'command'
 INPUTS = 'inputs'
+KIND = 'kind'
 OUTPUTS = 'outputs'
 
+# Kinds of compile commands.
+CLOSURE = 'closure'
+SOY = 'soy'
+
 
 def CreateCssFlags():
   return [
@@ -66,6 +71,7 @@ def CreateClosureCompilerCommand(deps, flags, controls, deps_location=''):
   return {
     COMMAND: command_base + controls + flags,
     INPUTS: '--input=%s',
+    KIND: CLOSURE,
     OUTPUTS: '--output_file=%s'
   }
 
@@ -118,6 +124,7 @@ def CreateSoyCompilerCommand(deps, flags, deps_location=''):
   return {
     COMMAND: ['java', '-jar', compiler] + flags + ['--outputPathFormat'],
     INPUTS: '%s',
+    KIND: SOY,
     OUTPUTS: '%s'
   }
 
@@ -129,6 +136,13 @@ def CreateSoyCompilerFlags():
   ]
 
 
+def CreateCompileCommand(src, dst, command):
+  """Returns the full command line compiling src into dst. (list)"""
+  inputs = command[INPUTS] % src
+  outputs = command[OUTPUTS] % dst
+  return command[COMMAND] + [outputs, inputs] # Specific order
+
+
 def CompileScript(src, dst, command, on_complete=None, force_compile=False):
   """Compile a script based on the given input file.
 
@@ -147,9 +161,7 @@ def CompileScript(src, dst, command, on_complete=None, force_compile=False):
   if os.path.exists(dst):
     os.remove(dst)
 
-  inputs = command[INPUTS] % src
-  outputs = command[OUTPUTS] % dst
-  full_command = command[COMMAND] + [outputs, inputs] # Specific order
+  full_command = CreateCompileCommand(src, dst, command)
   # TODO (jason.stredwick): Temporary fix for Windows under new build.
   no_wait = True
   if utils.IsOsWindows():
@@ -159,12 +171,14 @@ def CompileScript(src, dst, command, on_complete=None, force_compile=False):
 
 
 class OnComplete:
-  def __init__(self, src, dst, verbose, fail_early, indent=0):
+  def __init__(self, src, dst, verbose, fail_early, indent=0,
+               on_success=None):
     self.src = src
     self.dst = dst
     self.verbose = verbose
     self.fail_early = fail_early
     self.indent = utils.GetIndentString(indent)
+    self.on_success = on_success
 
   def __call__(self, success, out, cancelled=False):
     try:
@@ -174,6 +188,8 @@ class OnComplete:
       if success and os.path.exists(self.dst):
         if self.verbose:
           print '%s[SUCCESS] Compiling %s' % (self.indent, self.src)
+        if self.on_success is not None:
+          self.on_success()
       else:
         raise Exception
     except Exception:
@@ -0,0 +1,218 @@
+#!/usr/bin/python
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Long lived compiler processes shared by all the compiles of a build.
+
+Each compile normally starts a new JVM (closurebuilder.py runs
+"java -jar compiler.jar", the soy compiler is run with "java -jar"), and JVM
+startup and warm up dominate the small targets.  In compile server mode the
+build starts one Nailgun server (http://www.martiansoftware.com/nailgun/)
+with the Closure compiler and one with the soy compiler, and runs every
+compile through them with the "ng" client.
+
+The JavaScript compiles call the Closure compiler directly with the sources
+in dependency order, which closurebuilder.py would otherwise compute, using
+the goog.provide/goog.require graph of the build manifest.
+
+Compiles fall back to starting their own process when a server could not be
+started or stopped answering.
+"""
+
+
+import os
+import socket
+import subprocess
+import time
+
+import closure
+import deps as DEPS
+import tools as TOOLS
+
+
+NAILGUN_MAIN = 'com.martiansoftware.nailgun.NGServer'
+CLOSURE_MAIN = 'com.google.javascript.jscomp.CommandLineRunner'
+SOY_MAIN = 'com.google.template.soy.SoyToJsSrcCompiler'
+
+# Exit code of the ng client when it can not connect to the server.
+NAILGUN_CONNECT_FAILED = 230
+
+NG = 'ng'
+
+_HOST = '127.0.0.1'
+_START_TIMEOUT = 30 # Seconds allowed for a server to accept connections.
+
+_COMPILER_FLAGS = '--compiler_flags='
+_ROOT = '--root='
+
+
+class CompileServer(object):
+  def __init__(self, name, jar, main_class, nailgun_jar, ng):
+    """Describes a Nailgun server running a compiler.
+
+    Args:
+      name: Name printed in messages. (string)
+      jar: The compiler jar. (string)
+      main_class: The main class of the compiler. (string)
+      nailgun_jar: The Nailgun server jar. (string)
+      ng: The path to the Nailgun client. (string)
+    """
+    self.name = name
+    self.jar = jar
+    self.main_class = main_class
+    self.nailgun_jar = nailgun_jar
+    self.ng = ng
+    self.port = None
+    self.process = None
+
+  def Start(self):
+    """Starts the server and waits for it to accept connections.
+
+    Returns:
+      Whether or not the server is available. (boolean)
+    """
+    java = TOOLS.GetExecutable(TOOLS.JAVA)
+    if not java or not os.path.exists(self.jar):
+      return False
+
+    self.port = _GetFreePort()
+    classpath = os.pathsep.join([self.nailgun_jar, self.jar])
+    devnull = open(os.devnull, 'w')
+    self.process = subprocess.Popen(
+        [java, '-cp', classpath, NAILGUN_MAIN, '%s:%d' % (_HOST, self.port)],
+        stdout=devnull, stderr=subprocess.STDOUT)
+
+    deadline = time.time() + _START_TIMEOUT
+    while time.time() < deadline and self.process.poll() is None:
+      try:
+        socket.create_connection((_HOST, self.port), 1).close()
+        return True
+      except socket.error:
+        time.sleep(0.1)
+
+    self.Stop()
+    return False
+
+  def IsAvailable(self):
+    return self.process is not None and self.process.poll() is None
+
+  def Stop(self):
+    if not self.IsAvailable():
+      return
+
+    subprocess.call([self.ng, '--nailgun-port', str(self.port), 'ng-stop'],
+                    stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    if self.process.poll() is None:
+      self.process.terminate()
+    self.process.wait()
+
+  def CreateCommand(self, args):
+    """Returns the command running the compiler with the given arguments."""
+    return [self.ng, '--nailgun-port', str(self.port), self.main_class] + args
+
+
+class CompileServers(object):
+  def __init__(self, deps, nailgun_jar, deps_location=''):
+    """Create the servers for the Closure and soy compilers.
+
+    Args:
+      deps: A set of dependencies used by BITE. (dict)
+      nailgun_jar: The Nailgun server jar. (string)
+      deps_location: The root directory for dependencies. (string)
+    """
+    ng = TOOLS.GetExecutable(NG)
+    self.servers = {}
+    if not ng or not nailgun_jar or not os.path.exists(nailgun_jar):
+      return
+
+    compiler = os.path.join(deps_location,
+                            deps[DEPS.CLOSURE_COMPILER][DEPS.ROOT])
+    soy_compiler = os.path.join(deps_location,
+                                deps[DEPS.CLOSURE_SOY_COMPILER][DEPS.ROOT])
+    self.servers = {
+      closure.CLOSURE: CompileServer('Closure compiler', compiler,
+                                     CLOSURE_MAIN, nailgun_jar, ng),
+      closure.SOY: CompileServer('soy compiler', soy_compiler, SOY_MAIN,
+                                 nailgun_jar, ng)
+    }
+
+  def Start(self, verbose):
+    """Starts the servers; compiles fall back to processes for the others."""
+    if not self.servers:
+      print ('[WARNING] Compile server unavailable (requires the ng client '
+             'and the Nailgun jar); compiling with one process per target.')
+      return
+
+    for kind in self.servers.keys():
+      server = self.servers[kind]
+      if server.Start():
+        if verbose:
+          print '[SUCCESS] Started the %s server.' % server.name
+      else:
+        print ('[WARNING] Could not start the %s server; compiling with one '
+               'process per target.' % server.name)
+        del self.servers[kind]
+
+  def Stop(self):
+    for server in self.servers.values():
+      server.Stop()
+
+  def CreateCommand(self, src, dst, command, manifest):
+    """Returns the command compiling src into dst through a server.
+
+    Args:
+      src: The target source file. (string)
+      dst: The file to create. (string)
+      command: The compile command. (dict)
+      manifest: Resolves the dependencies of JavaScript targets.
+          (manifest.Manifest)
+
+    Returns:
+      The command, or None if no server is available for the command.
+      (list or None)
+    """
+    server = self.servers.get(command.get(closure.KIND))
+    if server is None or not server.IsAvailable():
+      return None
+
+    if command[closure.KIND] == closure.SOY:
+      # Same arguments as the soy compiler command, after "java -jar <jar>".
+      args = closure.CreateCompileCommand(src, dst, command)[3:]
+      return server.CreateCommand(args)
+
+    # Same arguments closurebuilder.py passes to the compiler.
+    roots = []
+    flags = []
+    for arg in command[closure.COMMAND]:
+      if arg.startswith(_ROOT):
+        roots.append(arg[len(_ROOT):])
+      elif arg.startswith(_COMPILER_FLAGS):
+        flags.append(arg[len(_COMPILER_FLAGS):])
+
+    args = []
+    for path in manifest.GetOrderedInputs(src, roots):
+      args += ['--js', path]
+    args += flags + ['--js_output_file', dst]
+    return server.CreateCommand(args)
+
+
+def _GetFreePort():
+  s = socket.socket()
+  try:
+    s.bind((_HOST, 0))
+    return s.getsockname()[1]
+  finally:
+    s.close()
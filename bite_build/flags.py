@@ -31,9 +31,12 @@ except ImportError:
 
 
 CLEAN = 'clean'
+COMPILE_SERVER = 'compile_server'
 DEPS = 'deps'
 EXPUNGE = 'expunge'
 EXTENSION_ONLY = 'extension_only'
+JOBS = 'jobs'
+NAILGUN_JAR = 'nailgun_jar'
 QUIET = 'quiet'
 RPF = 'rpf'
 RPF_LIB = 'rpfl'
@@ -43,6 +46,8 @@ ACTION = 'action'
 DEFAULT = 'default'
 REQUIRED = 'required'
 HELP = 'help'
+SHORT = 'short'
+TYPE = 'type'
 
 # Define information about each command and their options.
 FLAGS = {
@@ -53,6 +58,14 @@ FLAGS = {
     HELP: 'Remove all generated and output files.'
   },
 
+  COMPILE_SERVER: {
+    ACTION: 'store_true',
+    DEFAULT: False,
+    REQUIRED: False,
+    HELP: ('Compile through long lived Closure and soy compiler processes; '
+           'requires Nailgun (the ng client and --nailgun_jar).')
+  },
+
   DEPS: {
     ACTION: 'store_true',
     DEFAULT: False,
@@ -74,6 +87,23 @@ FLAGS = {
     HELP: 'Only build the extension.'
   },
 
+  JOBS: {
+    ACTION: 'store',
+    DEFAULT: None,
+    REQUIRED: False,
+    HELP: ('Maximum number of concurrent compiles; defaults to the number of '
+           'CPUs.'),
+    SHORT: 'j',
+    TYPE: int
+  },
+
+  NAILGUN_JAR: {
+    ACTION: 'store',
+    DEFAULT: None,
+    REQUIRED: False,
+    HELP: 'The Nailgun server jar used by --compile_server.'
+  },
+
   QUIET: {
     ACTION: 'store_true',
     DEFAULT: False,
@@ -108,8 +138,14 @@ def Process(flags):
   arg_parser = argparse.ArgumentParser(prog='bb')
   for key in flags:
     flag = flags[key]
-    arg_parser.add_argument(('--%s' % key), dest=key, action=flag[ACTION],
+    names = ['--%s' % key]
+    if SHORT in flag:
+      names.append('-%s' % flag[SHORT])
+    options = {}
+    if TYPE in flag:
+      options['type'] = flag[TYPE]
+    arg_parser.add_argument(*names, dest=key, action=flag[ACTION],
                             default=flag[DEFAULT], required=flag[REQUIRED],
-                            help=flag[HELP])
+                            help=flag[HELP], **options)
 
   return vars(arg_parser.parse_args())
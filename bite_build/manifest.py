@@ -0,0 +1,250 @@
+#!/usr/bin/python
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Build manifest used to only recompile targets whose inputs changed.
+
+The fingerprint of a target is a hash of:
+  - its compile command, i.e. the compiler flags and controls;
+  - the content of every file named on the command line, which includes the
+    compiler jars (the tool versions), externs and closurebuilder.py;
+  - the content of the target source and of every source it transitively
+    requires, resolved from the goog.provide/goog.require graph of the
+    --root directories of the command.
+
+The manifest remembers the fingerprint and compile time of each compiled
+output, along with the content hash and namespaces of each source file
+(keyed by path and refreshed when its size or modification time changes),
+so unchanged files are not read again.  It lives with the outputs in the
+genfiles folder, so cleaning removes it as well.
+"""
+
+
+import hashlib
+import json
+import os
+import re
+
+import paths as PATHS
+
+
+MANIFEST_PATH = os.path.join(PATHS.GENFILES_ROOT, 'build_manifest.json')
+
+# Same expressions as closurebuilder's source.py.
+_BASE_REGEX_STRING = r'^\s*goog\.%s\(\s*[\'"](.+)[\'"]\s*\)'
+_PROVIDE_REGEX = re.compile(_BASE_REGEX_STRING % 'provide', re.MULTILINE)
+_REQUIRE_REGEX = re.compile(_BASE_REGEX_STRING % 'require', re.MULTILINE)
+
+# closurebuilder always includes base.js, which provides goog implicitly.
+_BASE_JS = os.path.join('closure', 'goog', 'base.js')
+
+DURATIONS = 'durations'
+FILES = 'files'
+TARGETS = 'targets'
+
+HASH = 'hash'
+MTIME = 'mtime'
+PROVIDES = 'provides'
+REQUIRES = 'requires'
+SIZE = 'size'
+
+
+class Manifest(object):
+  def __init__(self, path=MANIFEST_PATH):
+    """Loads the manifest, or starts an empty one if it can not be read.
+
+    Args:
+      path: The location of the manifest file. (string)
+    """
+    self.path = path
+    self.data = {DURATIONS: {}, FILES: {}, TARGETS: {}}
+    self._indices = {}
+
+    if os.path.exists(path):
+      try:
+        with open(path) as f:
+          data = json.load(f)
+        if FILES in data and TARGETS in data:
+          self.data = data
+          self.data.setdefault(DURATIONS, {})
+      except ValueError:
+        pass
+
+  def Save(self):
+    (directory, _) = os.path.split(self.path)
+    if directory and not os.path.exists(directory):
+      os.makedirs(directory)
+
+    with open(self.path, 'w') as f:
+      json.dump(self.data, f)
+
+  def IsCurrent(self, dst, fingerprint):
+    """Returns whether dst exists and was built with the given fingerprint."""
+    return (os.path.exists(dst) and
+            self.data[TARGETS].get(dst) == fingerprint)
+
+  def Record(self, dst, fingerprint):
+    """Remembers the fingerprint dst was successfully built with."""
+    self.data[TARGETS][dst] = fingerprint
+
+  def Forget(self, dst):
+    self.data[TARGETS].pop(dst, None)
+
+  def GetDuration(self, dst, default=None):
+    """Returns how long dst took to compile last time, in seconds."""
+    return self.data[DURATIONS].get(dst, default)
+
+  def RecordDuration(self, dst, seconds):
+    self.data[DURATIONS][dst] = seconds
+
+  def GetFingerprint(self, src, command):
+    """Computes the fingerprint of a target.
+
+    Args:
+      src: The target source file. (string)
+      command: The compile command, without the input and output arguments.
+          (list of string)
+
+    Returns:
+      The fingerprint. (string)
+    """
+    digest = hashlib.sha1()
+    for arg in command:
+      digest.update('arg:%s\n' % arg)
+      # Flags name files as --flag=path or --flag=--other_flag=path.
+      path = arg.rsplit('=', 1)[-1]
+      if os.path.isfile(path):
+        digest.update('tool:%s\n' % self._GetFile(path)[HASH])
+
+    roots = [arg[len('--root='):] for arg in command
+             if arg.startswith('--root=')]
+    for path in self._GetInputs(src, roots):
+      info = self._GetFile(path)
+      digest.update('input:%s:%s\n' % (path, info and info[HASH]))
+    return digest.hexdigest()
+
+  def GetOrderedInputs(self, src, roots):
+    """Returns the files src transitively depends on, in dependency order.
+
+    The order is the one closurebuilder.py gives to the compiler: base.js,
+    then each file after the files it requires.
+    """
+    (providers, base_js) = self._GetIndex(roots)
+    ordered = []
+    visited = set()
+
+    def Visit(path):
+      if path in visited:
+        return
+      visited.add(path)
+
+      info = self._GetFile(path)
+      for namespace in (info and info[REQUIRES]) or []:
+        if namespace in providers:
+          Visit(providers[namespace])
+      ordered.append(path)
+
+    if base_js:
+      Visit(base_js)
+    Visit(src)
+    return ordered
+
+  def _GetFile(self, path):
+    """Returns the cached hash and namespaces of a file, updating them.
+
+    Returns:
+      A dict with the file's HASH, PROVIDES and REQUIRES, or None if the file
+      does not exist. (dict or None)
+    """
+    try:
+      stat = os.stat(path)
+    except OSError:
+      return None
+
+    info = self.data[FILES].get(path)
+    if (info is None or info[MTIME] != stat.st_mtime or
+        info[SIZE] != stat.st_size):
+      with open(path, 'rb') as f:
+        content = f.read()
+
+      provides = []
+      requires = []
+      if path.endswith('.js'):
+        provides = _PROVIDE_REGEX.findall(content)
+        requires = _REQUIRE_REGEX.findall(content)
+
+      info = {HASH: hashlib.sha1(content).hexdigest(),
+              MTIME: stat.st_mtime,
+              SIZE: stat.st_size,
+              PROVIDES: provides,
+              REQUIRES: requires}
+      self.data[FILES][path] = info
+    return info
+
+  def _GetIndex(self, roots):
+    """Maps each namespace provided under the roots to its file.
+
+    The index is built once per set of roots and reused by later targets of
+    the same build.
+
+    Returns:
+      A tuple of the namespace to file dict and the base.js path (or None).
+      (tuple)
+    """
+    key = tuple(roots)
+    if key not in self._indices:
+      providers = {}
+      base_js = None
+      for root in roots:
+        for (directory, _, filenames) in os.walk(root):
+          for filename in filenames:
+            if not filename.endswith('.js'):
+              continue
+
+            path = os.path.join(directory, filename)
+            info = self._GetFile(path)
+            if info is None:
+              continue
+
+            if path.endswith(_BASE_JS):
+              base_js = path
+            for namespace in info[PROVIDES]:
+              providers.setdefault(namespace, path)
+      self._indices[key] = (providers, base_js)
+    return self._indices[key]
+
+  def _GetInputs(self, src, roots):
+    """Returns the sorted list of files src transitively depends on."""
+    if not roots:
+      return [src]
+
+    (providers, base_js) = self._GetIndex(roots)
+    inputs = set([src])
+    if base_js:
+      inputs.add(base_js)
+
+    pending = [src]
+    while pending:
+      info = self._GetFile(pending.pop())
+      if info is None:
+        continue
+
+      for namespace in info[REQUIRES]:
+        path = providers.get(namespace)
+        if path and path not in inputs:
+          inputs.add(path)
+          pending.append(path)
+    return sorted(inputs)
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Tests for the build manifest.
+
+Run from the bite_build folder with: python manifest_test.py
+"""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import manifest as MANIFEST
+
+
+class ManifestTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.src_root = os.path.join(self.root, 'src')
+    self._Write(os.path.join('closure', 'goog', 'base.js'),
+                "goog.provide('goog');\n")
+    self._Write('a.js', "goog.provide('a');\ngoog.require('b');\n")
+    self._Write('b.js', "goog.provide('b');\n")
+    self._Write('unused.js', "goog.provide('unused');\n")
+    self.main = self._Write('main.js', "goog.require('a');\n")
+    self.tool = self._Write('compiler.jar', 'v1')
+    self.command = ['--root=%s' % self.src_root,
+                    '--compiler_jar=%s' % self.tool]
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def _Write(self, name, content):
+    path = os.path.join(self.src_root, name)
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+    with open(path, 'w') as f:
+      f.write(content)
+    return path
+
+  def _NewManifest(self):
+    return MANIFEST.Manifest(os.path.join(self.root, 'manifest.json'))
+
+  def _GetFingerprint(self):
+    # A new manifest per call, so the namespace index is built again.
+    return self._NewManifest().GetFingerprint(self.main, self.command)
+
+  def testFingerprintIsStable(self):
+    self.assertEqual(self._GetFingerprint(), self._GetFingerprint())
+
+  def testFingerprintChangesWithTransitiveInput(self):
+    before = self._GetFingerprint()
+    self._Write('b.js', "goog.provide('b');\nvar changed = true;\n")
+    self.assertNotEqual(before, self._GetFingerprint())
+
+  def testFingerprintIgnoresUnrequiredFiles(self):
+    before = self._GetFingerprint()
+    self._Write('unused.js', "goog.provide('unused');\nvar changed;\n")
+    self.assertEqual(before, self._GetFingerprint())
+
+  def testFingerprintChangesWithCommandAndTools(self):
+    before = self._GetFingerprint()
+    self.command.append('--compiler_flags=--debug')
+    with_flag = self._GetFingerprint()
+    self.assertNotEqual(before, with_flag)
+
+    self._Write('compiler.jar', 'version 2')
+    self.assertNotEqual(with_flag, self._GetFingerprint())
+
+  def testRecordedTargetIsCurrentAfterReload(self):
+    dst = os.path.join(self.root, 'out.js')
+    with open(dst, 'w') as f:
+      f.write('compiled')
+    manifest = self._NewManifest()
+    fingerprint = manifest.GetFingerprint(self.main, self.command)
+    self.assertFalse(manifest.IsCurrent(dst, fingerprint))
+
+    manifest.Record(dst, fingerprint)
+    manifest.RecordDuration(dst, 1.5)
+    manifest.Save()
+    manifest = self._NewManifest()
+    self.assertTrue(manifest.IsCurrent(dst, fingerprint))
+    self.assertEqual(1.5, manifest.GetDuration(dst))
+
+    manifest.Forget(dst)
+    self.assertFalse(manifest.IsCurrent(dst, fingerprint))
+
+  def testMissingOutputIsNotCurrent(self):
+    manifest = self._NewManifest()
+    dst = os.path.join(self.root, 'missing.js')
+    manifest.Record(dst, 'fingerprint')
+    self.assertFalse(manifest.IsCurrent(dst, 'fingerprint'))
+
+  def testGetOrderedInputs(self):
+    inputs = self._NewManifest().GetOrderedInputs(self.main,
+                                                  [self.src_root])
+    self.assertEqual(
+        [os.path.join(self.src_root, 'closure', 'goog', 'base.js'),
+         os.path.join(self.src_root, 'b.js'),
+         os.path.join(self.src_root, 'a.js'),
+         self.main],
+        inputs)
+
+
+if __name__ == '__main__':
+  unittest.main()
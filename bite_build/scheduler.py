@@ -0,0 +1,260 @@
+#!/usr/bin/python
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Runs the compiles of one or more bundles with a bounded number of jobs.
+
+Every compile spawns a JVM, so running all targets at once oversubscribes
+the machine.  The scheduler keeps one queue of compiles across all the
+bundles of a build and runs at most a given number of them at a time,
+starting the targets that took the longest in previous builds first.
+
+Each running compile is waited on by its own thread, which reports the
+completion to the scheduler through a queue, so the scheduler sleeps until a
+compile finishes instead of polling the processes.
+
+When given compile servers, the compiles run through them and only fall
+back to their own process if the server can not be reached.
+"""
+
+
+import multiprocessing
+import os
+import Queue
+import threading
+import time
+
+import closure
+import compile_server as COMPILE_SERVER
+import manifest as MANIFEST
+import utils
+
+
+# Targets never compiled before are assumed to be slow, so they start early.
+_UNKNOWN_DURATION = float('inf')
+
+# Waits on the completion queue time out only so that the build can still be
+# interrupted from the keyboard; Queue.get without a timeout can not be.
+_WAIT_TIMEOUT = 3600
+
+
+def GetDefaultJobs():
+  """Returns the default number of concurrent compiles."""
+  # TODO (jason.stredwick): Temporary fix for Windows under new build; the
+  # compiles used to run one at a time there.
+  if utils.IsOsWindows():
+    return 1
+
+  try:
+    return multiprocessing.cpu_count()
+  except NotImplementedError:
+    return 1
+
+
+class Job(object):
+  def __init__(self, src, dst, command, verbose, indent=0, after=None):
+    """Describes one target to compile.
+
+    Args:
+      src: The target source file. (string)
+      dst: The file to create. (string)
+      command: The compile command. (dict)
+      verbose: Whether or not to print the outcome. (boolean)
+      indent: The indentation of the printed messages. (integer)
+      after: The jobs to wait for before starting this one. (list of Job)
+    """
+    self.src = src
+    self.dst = dst
+    self.command = command
+    self.verbose = verbose
+    self.indent = indent
+    self.after = after or []
+    self.process = None
+    self.on_complete = None
+    self.start_time = None
+    self.done = False
+
+
+class Scheduler(object):
+  def __init__(self, jobs=None, manifest=None, fail_early=True,
+               compile_servers=None):
+    """Create a scheduler.
+
+    Args:
+      jobs: The maximum number of concurrent compiles, GetDefaultJobs() if
+          None. (integer)
+      manifest: Holds the fingerprints and previous compile times of the
+          targets. (manifest.Manifest)
+      fail_early: Whether or not to stop at the first failure. (boolean)
+      compile_servers: The started compile servers to compile with, if any.
+          (compile_server.CompileServers)
+    """
+    self.jobs = max(1, jobs or GetDefaultJobs())
+    self.manifest = manifest or MANIFEST.Manifest()
+    self.fail_early = fail_early
+    self.compile_servers = compile_servers
+    self.timings = [] # Array of (src, seconds) of the compiled targets.
+    self.elapsed = 0
+
+    self._pending = []
+    self._running = []
+    self._completed = Queue.Queue()
+
+  def Add(self, src, dst, command, verbose, indent=0, after=None):
+    """Queues the compile of a target; returns its Job."""
+    # Ensure the directory structure exists for the destination file.
+    (path, _) = os.path.split(dst)
+    if path and not os.path.exists(path):
+      os.makedirs(path)
+
+    job = Job(src, dst, command, verbose, indent=indent, after=after)
+    self._pending.append(job)
+    return job
+
+  def Run(self):
+    """Runs all the queued compiles.
+
+    Returns:
+      Whether or not all the compiles succeeded; the fingerprints and compile
+      times of the successful ones are saved to the manifest either way.
+      (boolean)
+    """
+    start_time = time.time()
+    failed = False
+    try:
+      while self._pending or self._running:
+        self._StartReadyJobs()
+        if not self._running:
+          continue
+
+        (job, success, out) = self._WaitForJob()
+        job.on_complete(success, out)
+        if success and os.path.exists(job.dst):
+          seconds = time.time() - job.start_time
+          self.timings.append((job.src, seconds))
+          self.manifest.RecordDuration(job.dst, seconds)
+        else:
+          failed = True
+          if self.fail_early:
+            self._CancelAll()
+            break
+    finally:
+      self.elapsed = time.time() - start_time
+      self.manifest.Save()
+
+    return not failed
+
+  def PrintReport(self, indent=0):
+    """Prints the compile time of each target, slowest first."""
+    if not self.timings:
+      return
+
+    indent_string = utils.GetIndentString(indent)
+    print '%sCompile times (%d jobs):' % (indent_string, self.jobs)
+    for (src, seconds) in sorted(self.timings, key=lambda t: -t[1]):
+      print '%s  %7.2fs  %s' % (indent_string, seconds, src)
+    total = sum([seconds for (_, seconds) in self.timings])
+    print '%s  %7.2fs  total compile time, %.2fs elapsed' % (
+        indent_string, total, self.elapsed)
+    print ''
+
+  def _StartReadyJobs(self):
+    """Starts the slowest jobs whose prerequisites are done, up to the limit.
+
+    Jobs found up to date are marked done without being run, which may make
+    others ready, so the jobs are picked again until the limit is reached or
+    no job is ready.
+    """
+    while len(self._running) < self.jobs:
+      ready = [job for job in self._pending
+               if all([prerequisite.done for prerequisite in job.after])]
+      if not ready:
+        return
+
+      job = max(ready, key=lambda job: self.manifest.GetDuration(
+          job.dst, _UNKNOWN_DURATION))
+      self._pending.remove(job)
+      self._Start(job)
+
+  def _Start(self, job):
+    """Starts a job, unless its output is up to date."""
+    fingerprint = self.manifest.GetFingerprint(job.src,
+                                               job.command[closure.COMMAND])
+    if self.manifest.IsCurrent(job.dst, fingerprint):
+      job.done = True
+      return
+
+    self.manifest.Forget(job.dst)
+    on_success = lambda: self.manifest.Record(job.dst, fingerprint)
+    job.on_complete = closure.OnComplete(job.src, job.dst, job.verbose,
+                                         fail_early=False, indent=job.indent,
+                                         on_success=on_success)
+    if os.path.exists(job.dst):
+      os.remove(job.dst)
+
+    command = closure.CreateCompileCommand(job.src, job.dst, job.command)
+    fallback = None
+    if self.compile_servers is not None:
+      server_command = self.compile_servers.CreateCommand(
+          job.src, job.dst, job.command, self.manifest)
+      if server_command is not None:
+        (command, fallback) = (server_command, command)
+
+    job.start_time = time.time()
+    job.process = utils.ExecuteCommand(command, no_wait=True)[utils.PROCESS]
+    self._running.append(job)
+
+    waiter = threading.Thread(target=self._Wait, args=(job, fallback))
+    waiter.daemon = True
+    waiter.start()
+
+  def _Wait(self, job, fallback=None):
+    """Waits for the process of a job, then reports its completion.
+
+    Args:
+      job: The started job. (Job)
+      fallback: The command to run instead if the compile server could not
+          be reached. (list or None)
+    """
+    (out, _) = job.process.communicate()
+    if (fallback is not None and
+        job.process.returncode == COMPILE_SERVER.NAILGUN_CONNECT_FAILED):
+      job.process = utils.ExecuteCommand(fallback,
+                                         no_wait=True)[utils.PROCESS]
+      (out, _) = job.process.communicate()
+    self._completed.put((job, job.process.returncode == 0, out))
+
+  def _WaitForJob(self):
+    """Blocks until a running job completes; returns its outcome."""
+    while True:
+      try:
+        (job, success, out) = self._completed.get(True, _WAIT_TIMEOUT)
+        break
+      except Queue.Empty:
+        pass
+
+    self._running.remove(job)
+    job.done = True
+    return (job, success, out)
+
+  def _CancelAll(self):
+    """Kills the running compiles and drops the pending ones."""
+    for job in self._running:
+      if job.process.poll() is None:
+        job.process.terminate()
+      job.on_complete(False, None, cancelled=True)
+    self._running = []
+    self._pending = []
@@ -31,6 +31,7 @@ __author__ = 'jasonstredwick@google.com (Jason Stredwick)'
 import os
 import subprocess
 import shutil
+import time
 
 
 BUILD_ROOT = os.path.join('bite_build')
@@ -40,12 +41,14 @@ BUILD_ROOT = os.path.join('bite_build')
 bite_build_imported = False
 try:
   from bite_build import clean
+  from bite_build import compile_server as COMPILE_SERVER
   from bite_build import deps as DEPS
   from bite_build import extension as EXTENSION
   from bite_build import flags as FLAGS
   from bite_build import paths as PATHS
   from bite_build import rpf as RPF
   from bite_build import rpfl as RPFL
+  from bite_build import scheduler as SCHEDULER
   from bite_build import server as SERVER
   from bite_build import tools
   bite_build_imported = True
@@ -100,11 +103,14 @@ except ImportError:
 # If the build files failed to be imported then try again after download phase.
 if not bite_build_imported:
   from bite_build import clean
+  from bite_build import compile_server as COMPILE_SERVER
   from bite_build import deps as DEPS
   from bite_build import extension as EXTENSION
   from bite_build import flags as FLAGS
   from bite_build import paths as PATHS
   from bite_build import rpf as RPF
+  from bite_build import rpfl as RPFL
+  from bite_build import scheduler as SCHEDULER
   from bite_build import server as SERVER
   from bite_build import tools
 
@@ -157,6 +163,10 @@ def Main():
     shutil.rmtree(PATHS.OUTPUT_ROOT)
   os.mkdir(PATHS.OUTPUT_ROOT)
 
+  # The compiles of all the bundles share one queue of jobs, then the bundles
+  # are copied to the output folder.
+  bundles = []
+
   # T T -> Build
   # T F -> Build
   # F T -> No build
@@ -164,24 +174,15 @@ def Main():
   if args[FLAGS.EXTENSION_ONLY] or not args[FLAGS.SERVER_ONLY]:
     if args[FLAGS.RPF_LIB]:
       rpfl = RPFL.RPFL(deps, debug=True, deps_root='', src_root='', dst_root='')
-      rpfl.Construct(verbose, deps,
-                    start_msg='Creating RPFL bundle ...',
-                    fail_early=True,
-                    deps_root='')
+      bundles.append((rpfl, 'Creating RPFL bundle ...'))
 
     elif args[FLAGS.RPF]:
       rpf = RPF.RPF(deps, debug=True, deps_root='', src_root='', dst_root='')
-      rpf.Construct(verbose, deps,
-                    start_msg='Creating RPF extension bundle ...',
-                    fail_early=True,
-                    deps_root='')
+      bundles.append((rpf, 'Creating RPF extension bundle ...'))
     else:
       extension = EXTENSION.Extension(deps, debug=True, deps_root='',
                                       src_root='', dst_root='')
-      extension.Construct(verbose, deps,
-                          start_msg='Creating extension bundle ...',
-                          fail_early=True,
-                          deps_root='')
+      bundles.append((extension, 'Creating extension bundle ...'))
 
   # T T -> No build
   # T F -> No build
@@ -190,10 +191,39 @@ def Main():
   if not args[FLAGS.EXTENSION_ONLY] and not args[FLAGS.RPF_LIB]:
     server = SERVER.Server(deps, debug=True, deps_root='', src_root='',
                            dst_root='')
-    server.Construct(verbose, deps,
-                     start_msg='Creating server bundle ...',
-                     fail_early=True,
-                     deps_root='')
+    bundles.append((server, 'Creating server bundle ...'))
+
+  current_time = time.time()
+  compile_servers = None
+  if args[FLAGS.COMPILE_SERVER]:
+    compile_servers = COMPILE_SERVER.CompileServers(
+        deps, args[FLAGS.NAILGUN_JAR], deps_location='')
+    compile_servers.Start(verbose)
+
+  scheduler = SCHEDULER.Scheduler(jobs=args[FLAGS.JOBS], fail_early=True,
+                                  compile_servers=compile_servers)
+  for (bundle, _) in bundles:
+    bundle.QueueCompiles(scheduler, verbose, deps, deps_root='')
+
+  print 'Compiling soy templates and JavaScript files ...'
+  try:
+    success = scheduler.Run()
+  finally:
+    if compile_servers is not None:
+      compile_servers.Stop()
+  if not success:
+    print 'Build failed ... exiting.'
+    exit()
+  if verbose:
+    scheduler.PrintReport()
+
+  for (bundle, start_msg) in bundles:
+    print start_msg
+    bundle.Copy(verbose)
+    if verbose:
+      print ''
+
+  print 'Total time elapsed %s (s)' % (time.time() - current_time)
 
 
 if __name__ == '__main__':
@@ -20,6 +20,7 @@ validation of request parameters.
 
 __author__ = 'alexto@google.com (Alexis O. Torres)'
 
+import hashlib
 import json
 import logging
 import os
@@ -30,6 +31,7 @@ from google.appengine.api import users
 from google.appengine.ext import ereporter
 from google.appengine.ext.webapp import template
 
+from common.util import rpc_profile
 import root
 
 
@@ -100,6 +102,18 @@ class BaseHandler(webapp2.RequestHandler):
     value = self.GetOptionalIntParameter('int_parameter_name', 10)
   """
 
+  def dispatch(self):
+    """Dispatches the request, profiling its RPCs when enabled."""
+    handler_name = '%s %s.%s' % (self.request.method,
+                                 self.__class__.__module__,
+                                 self.__class__.__name__)
+    profile = rpc_profile.Start(handler_name)
+    try:
+      super(BaseHandler, self).dispatch()
+    finally:
+      if profile:
+        rpc_profile.Finish(profile)
+
   def handle_exception(self, exception, debug):
     logging.exception('Exception handled by common.handlers.base.BaseHandler.')
 
@@ -287,8 +301,55 @@ class BaseHandler(webapp2.RequestHandler):
       assert data, 'Data required.'
       assert isinstance(data, dict), 'Response data is not a dictionary.'
 
-      self.response.headers['Content-Type'] = 'application/json'
-      json.dump(data, self.response.out, indent=2)
-      self.response.out.write('\n')
+      self.WriteJson(data)
     except (AssertionError, Exception), e:
       raise Error('Invalid response data.\n%s\n' % e, code=400)
+
+  def WriteJson(self, data, cls=None):
+    """Writes the given data as a compact JSON response.
+
+    The data is encoded chunk by chunk, so large lists are never held as one
+    string before being written. Compression is left to the App Engine
+    frontend, which negotiates it with the client and drops any
+    Content-Encoding set by the app.
+
+    The response carries a weak ETag computed from its content, weak since
+    the frontend may serve it gzipped or not. A GET or HEAD request whose
+    If-None-Match matches it gets an empty 304 response instead.
+
+    Args:
+      data: The object to encode.
+      cls: The json.JSONEncoder subclass to encode with. (class or None)
+    """
+    encoder = (cls or json.JSONEncoder)(separators=(',', ':'))
+    digest = hashlib.md5()
+    out = self.response.out
+    for chunk in encoder.iterencode(data):
+      if isinstance(chunk, unicode):
+        chunk = chunk.encode('utf-8')
+      digest.update(chunk)
+      out.write(chunk)
+
+    etag = 'W/"%s"' % digest.hexdigest()
+    self.response.headers['ETag'] = etag
+    if (self.request.method in ('GET', 'HEAD') and
+        self._MatchesETag(etag)):
+      self.response.clear()
+      self.response.set_status(304)
+      return
+    self.response.headers['Content-Type'] = 'application/json'
+
+  def _MatchesETag(self, etag):
+    """Whether the If-None-Match of the request matches the ETag.
+
+    The comparison is weak, as If-None-Match calls for.
+    """
+    opaque_tag = etag[2:]
+    header = self.request.headers.get('If-None-Match', '')
+    for tag in header.split(','):
+      tag = tag.strip()
+      if tag.startswith('W/'):
+        tag = tag[2:]
+      if tag in ('*', opaque_tag):
+        return True
+    return False
@@ -0,0 +1,255 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per request profiling of the API RPCs made by handlers.
+
+Profiling is off by default. It is turned on from appengine_config.py, the
+same way appstats is configured, for example:
+  rpc_profile_ENABLED = True
+  rpc_profile_SAMPLE_RATE = 0.1
+
+For each sampled request the RPCs made through the API proxy are counted and
+timed by service call, along with the number of entities they read or wrote.
+The totals are added to per handler histograms kept in memcache (see
+GetReport), and calls repeated many times on one entity each, typically gets
+or queries in a loop, are logged as possible N+1 patterns.
+"""
+
+import bisect
+import logging
+import random
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import lib_config
+from google.appengine.api import memcache
+
+
+_config = lib_config.register('rpc_profile', {
+    'ENABLED': False,
+    # Fraction of the requests profiled.
+    'SAMPLE_RATE': 0.1,
+    # Calls repeated this many times on at most one entity each are logged.
+    'N_PLUS_ONE_THRESHOLD': 10,
+    # Requests spending longer than this in RPCs are logged, in ms.
+    'SLOW_RPC_MS': 1000})
+
+# Upper bounds of the histogram buckets; the last bucket is unbounded.
+RPC_COUNT_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500]
+RPC_MS_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+_REPORT_KEY = 'rpc_profile_report'
+_REPORT_CAS_RETRIES = 3
+
+# Number of entities read or written by datastore calls.
+_ENTITY_COUNTERS = {
+    'Get': lambda request, response: response.entity_size(),
+    'Put': lambda request, response: request.entity_size(),
+    'Delete': lambda request, response: request.key_size(),
+    'RunQuery': lambda request, response: response.result_size(),
+    'Next': lambda request, response: response.result_size()}
+
+_local = threading.local()
+_hooks_lock = threading.Lock()
+_hooks_installed = False
+
+
+class Profile(object):
+  """The RPCs made while serving one request.
+
+  Attributes:
+    handler: Name of the handler serving the request.
+    calls: Dict of 'service.call' to a [count, ms, entities] list.
+  """
+
+  def __init__(self, handler):
+    self.handler = handler
+    self.calls = {}
+    self._starts = {}
+
+  def CallStarted(self, response):
+    self._starts[id(response)] = time.time()
+
+  def CallFinished(self, service, call, request, response):
+    started = self._starts.pop(id(response), None)
+    elapsed_ms = 0
+    if started is not None:
+      elapsed_ms = (time.time() - started) * 1000
+    entities = 0
+    if service == 'datastore_v3' and call in _ENTITY_COUNTERS:
+      try:
+        entities = _ENTITY_COUNTERS[call](request, response)
+      except Exception:
+        pass
+    stats = self.calls.setdefault('%s.%s' % (service, call), [0, 0, 0])
+    stats[0] += 1
+    stats[1] += elapsed_ms
+    stats[2] += entities
+
+  @property
+  def rpc_count(self):
+    return sum([stats[0] for stats in self.calls.itervalues()])
+
+  @property
+  def rpc_ms(self):
+    return sum([stats[1] for stats in self.calls.itervalues()])
+
+  def GetRepeatedCalls(self, threshold):
+    """Gets the calls made at least threshold times on one entity at most."""
+    return sorted([name for name, (count, _, entities)
+                   in self.calls.iteritems()
+                   if count >= threshold and entities <= count])
+
+
+def _PreCallHook(service, call, request, response):
+  profile = getattr(_local, 'profile', None)
+  if profile:
+    profile.CallStarted(response)
+
+
+def _PostCallHook(service, call, request, response):
+  profile = getattr(_local, 'profile', None)
+  if profile:
+    profile.CallFinished(service, call, request, response)
+
+
+def _InstallHooks():
+  """Registers the API proxy hooks once per instance."""
+  global _hooks_installed
+  with _hooks_lock:
+    if _hooks_installed:
+      return
+    apiproxy = apiproxy_stub_map.apiproxy
+    apiproxy.GetPreCallHooks().Append('rpc_profile', _PreCallHook)
+    apiproxy.GetPostCallHooks().Append('rpc_profile', _PostCallHook)
+    _hooks_installed = True
+
+
+def Start(handler):
+  """Starts profiling the current request, if enabled and sampled.
+
+  Args:
+    handler: Name of the handler serving the request. (string)
+
+  Returns:
+    The Profile, or None if the request is not profiled.
+  """
+  if not _config.ENABLED or random.random() >= _config.SAMPLE_RATE:
+    return None
+  _InstallHooks()
+  _local.profile = Profile(handler)
+  return _local.profile
+
+
+def Finish(profile):
+  """Stops profiling the current request and records its profile.
+
+  Args:
+    profile: The Profile returned by Start.
+  """
+  _local.profile = None
+  rpc_ms = profile.rpc_ms
+  for name in profile.GetRepeatedCalls(_config.N_PLUS_ONE_THRESHOLD):
+    count, _, entities = profile.calls[name]
+    logging.warning('Possible N+1 in %s: %d %s calls for %d entities.',
+                    profile.handler, count, name, entities)
+  if rpc_ms >= _config.SLOW_RPC_MS:
+    logging.warning('Slow handler %s: %d RPCs took %dms.',
+                    profile.handler, profile.rpc_count, rpc_ms)
+  try:
+    _AddToReport(profile)
+  except Exception:
+    logging.exception('Failed to record the RPC profile.')
+
+
+def _NewHandlerStats():
+  return {'requests': 0,
+          'rpc_count': [0] * (len(RPC_COUNT_BUCKETS) + 1),
+          'rpc_ms': [0] * (len(RPC_MS_BUCKETS) + 1),
+          'n_plus_one': 0,
+          'calls': {}}
+
+
+def _AddToReport(profile):
+  """Adds a profile to the histograms of its handler in memcache."""
+  client = memcache.Client()
+  for _ in range(_REPORT_CAS_RETRIES):
+    report = client.gets(_REPORT_KEY)
+    if report is None:
+      report = {}
+      if not client.add(_REPORT_KEY, report):
+        continue
+      report = client.gets(_REPORT_KEY)
+      if report is None:
+        continue
+
+    stats = report.setdefault(profile.handler, _NewHandlerStats())
+    stats['requests'] += 1
+    stats['rpc_count'][bisect.bisect_left(RPC_COUNT_BUCKETS,
+                                          profile.rpc_count)] += 1
+    stats['rpc_ms'][bisect.bisect_left(RPC_MS_BUCKETS, profile.rpc_ms)] += 1
+    if profile.GetRepeatedCalls(_config.N_PLUS_ONE_THRESHOLD):
+      stats['n_plus_one'] += 1
+    for name, values in profile.calls.iteritems():
+      totals = stats['calls'].setdefault(name, [0, 0, 0])
+      for i, value in enumerate(values):
+        totals[i] += value
+
+    if client.cas(_REPORT_KEY, report):
+      return
+
+
+def GetReport():
+  """Gets the RPC profiles recorded per handler.
+
+  Returns:
+    A list of dicts, one per handler, slowest first, with:
+      handler: The handler name.
+      requests: Number of profiled requests.
+      rpc_count: Histogram of RPCs per request, a list of
+          [upper bound, requests] pairs; the last bound is None.
+      rpc_ms: Histogram of time spent in RPCs per request, in ms.
+      n_plus_one: Number of requests with possible N+1 patterns.
+      mean_rpc_ms: Average time spent in RPCs per request, in ms.
+      calls: Dict of 'service.call' to totals with count, ms, entities and
+          per_request (the average count per request).
+  """
+  report = memcache.get(_REPORT_KEY) or {}
+  handlers = []
+  for handler, stats in report.iteritems():
+    requests = stats['requests']
+    calls = {}
+    total_ms = 0
+    for name, (count, ms, entities) in stats['calls'].iteritems():
+      calls[name] = {'count': count,
+                     'ms': int(ms),
+                     'entities': entities,
+                     'per_request': float(count) / requests}
+      total_ms += ms
+    handlers.append({
+        'handler': handler,
+        'requests': requests,
+        'rpc_count': zip(RPC_COUNT_BUCKETS + [None], stats['rpc_count']),
+        'rpc_ms': zip(RPC_MS_BUCKETS + [None], stats['rpc_ms']),
+        'n_plus_one': stats['n_plus_one'],
+        'mean_rpc_ms': int(total_ms / requests),
+        'calls': calls})
+  handlers.sort(key=lambda stats: stats['mean_rpc_ms'], reverse=True)
+  return handlers
+
+
+def ClearReport():
+  """Drops the recorded profiles."""
+  memcache.delete(_REPORT_KEY)
@@ -23,6 +23,12 @@ __author__ = 'alexto@google.com (Alexis O. Torres)'
 from google.appengine.ext.appstats import recording
 
 
+# Per handler RPC profiling, see common/server/appengine/util/rpc_profile.py.
+# The report is served at /admin/rpc_profile.
+rpc_profile_ENABLED = False
+rpc_profile_SAMPLE_RATE = 0.1
+
+
 def webapp_add_wsgi_middleware(app):
   """Adds support for Appstats, the appengine RPC instrumentation service."""
   app = recording.appstats_wsgi_middleware(app)
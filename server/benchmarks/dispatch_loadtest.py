@@ -0,0 +1,323 @@
+#!/usr/bin/python
+#
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local load test of the executor dispatch and bug lookup handlers.
+
+Runs the handlers in process against the App Engine testbed stubs, so the
+run and bug paths can be measured without a live app:
+  - executors: threads fetching queued results from /result/fetch and
+    reporting them as passed to /result/update until the runs are done.
+  - clients: threads looking up bugs with /get_bugs_for_url.
+
+Reports requests/sec, RPCs per request and p50/p99 latency per handler. The
+stubs are much slower than the production services and threads share the
+GIL, so the numbers are meant to compare two versions of the code, e.g.:
+  dispatch_loadtest.py --sdk=$SDK --app_root=$BUNDLE --output=before.json
+  (apply the change, rebuild the bundle)
+  dispatch_loadtest.py --sdk=$SDK --app_root=$BUNDLE --compare=before.json
+
+The app root must be the built server bundle, which has the common code
+copied under common/.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib
+
+
+PROJECT_NAME = 'loadtest'
+SUITE_NAME = 'loadtest_suite'
+TOKENS = 'loadtest'
+HOST_PATTERN = 'http://host%d.example.com/page%d'
+
+FETCH = 'fetch'
+UPDATE = 'update'
+BUGS_FOR_URL = 'bugs_for_url'
+
+_PERCENTILES = [50, 99]
+
+
+def _SetUpPaths(sdk, app_root):
+  """Makes the SDK and the app importable."""
+  sys.path.insert(0, sdk)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  sys.path.insert(0, app_root)
+
+
+def _SetUpTestbed(app_root):
+  """Activates the service stubs used by the handlers."""
+  from google.appengine.datastore import datastore_stub_util
+  from google.appengine.ext import testbed
+
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.setup_env(user_email='loadtest@example.com', user_id='1',
+                user_is_admin='1', overwrite=True)
+  policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+  bed.init_datastore_v3_stub(consistency_policy=policy)
+  bed.init_memcache_stub()
+  bed.init_taskqueue_stub(root_path=app_root)
+  bed.init_urlfetch_stub()
+  bed.init_user_stub()
+  return bed
+
+
+class RpcCounter(object):
+  """Counts the API RPCs made by the current thread."""
+
+  def __init__(self):
+    self._local = threading.local()
+
+  def Install(self):
+    from google.appengine.api import apiproxy_stub_map
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'loadtest_counter', self._Hook)
+
+  def _Hook(self, service, call, request, response):
+    self._local.count = getattr(self._local, 'count', 0) + 1
+
+  def Reset(self):
+    self._local.count = 0
+
+  @property
+  def count(self):
+    return getattr(self._local, 'count', 0)
+
+
+class Stats(object):
+  """Latencies and RPC counts of the requests sent to each handler."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._samples = {}
+    self._errors = {}
+    self._elapsed = {}
+
+  def Add(self, name, latency_ms, rpcs, ok):
+    with self._lock:
+      self._samples.setdefault(name, []).append((latency_ms, rpcs))
+      if not ok:
+        self._errors[name] = self._errors.get(name, 0) + 1
+
+  def SetElapsed(self, names, seconds):
+    for name in names:
+      self._elapsed[name] = seconds
+
+  def GetReport(self):
+    """Gets the summary of each handler as a dict."""
+    report = {}
+    for name, samples in self._samples.iteritems():
+      latencies = sorted([latency for latency, _ in samples])
+      summary = {
+          'requests': len(samples),
+          'errors': self._errors.get(name, 0),
+          'requests_per_sec': len(samples) / max(self._elapsed[name], 1e-6),
+          'rpcs_per_request': (sum([rpcs for _, rpcs in samples]) /
+                               float(len(samples)))}
+      for percentile in _PERCENTILES:
+        summary['p%d_ms' % percentile] = _GetPercentile(latencies,
+                                                        percentile)
+      report[name] = summary
+    return report
+
+
+def _GetPercentile(values, percentile):
+  """Gets the nearest-rank percentile of a sorted non empty list."""
+  rank = int(round(percentile / 100.0 * (len(values) - 1)))
+  return values[rank]
+
+
+def SeedRuns(num_runs, tests_per_run):
+  """Adds a suite with runs whose results are all queued."""
+  from handlers import deferred_util
+  from models import bite_project
+  from models import bite_run
+  from models import bite_suite
+
+  bite_project.AddProject(PROJECT_NAME, None)
+  suite = bite_suite.AddSuite(SUITE_NAME, PROJECT_NAME)
+  for i in range(num_runs):
+    test_info_list = [{'id': 'test_%d_%d' % (i, j),
+                       'name': 'test %d of run %d' % (j, i),
+                       'automated': True,
+                       'labels': []}
+                      for j in range(tests_per_run)]
+    run = bite_run.AddRun('loadtest_run_%d' % i, suite.key(),
+                          datetime.datetime.now(), test_info_list,
+                          tokens=TOKENS)
+    deferred_util.StartTests(test_info_list, run.key(), is_deferred=False)
+
+
+def SeedBugs(num_bugs, num_urls):
+  """Adds bugs spread over num_urls URLs; returns the URLs."""
+  from models import bugs
+  from models import bugs_util
+  from models import url_bug_map
+
+  urls = [HOST_PATTERN % (i % 10, i) for i in range(num_urls)]
+  for i in range(num_bugs):
+    bug = bugs.Store(str(i), 'Bug %d' % i, 'Summary of bug %d' % i, '2',
+                     PROJECT_NAME, bugs_util.Provider.LOCAL, 'unconfirmed',
+                     'loadtest@example.com', '1', '', '2012-01-01',
+                     '2012-01-01', 'loadtest@example.com')
+    url_bug_map.StoreUrlBugMapping(urls[i % num_urls], bug)
+  return urls
+
+
+def _Send(app, path, params, counter):
+  """Sends a request to an app.
+
+  Returns:
+    A (response, latency in ms, number of RPCs) tuple.
+  """
+  import webapp2
+
+  request = webapp2.Request.blank(path, POST=params)
+  request.remote_addr = '127.0.0.1'
+  counter.Reset()
+  start = time.time()
+  response = request.get_response(app)
+  return response, (time.time() - start) * 1000, counter.count
+
+
+def _RunExecutor(app, stats, counter):
+  """Fetches and completes results until there is none left."""
+  while True:
+    response, latency_ms, rpcs = _Send(app, '/result/fetch',
+                                       {'tokens': TOKENS}, counter)
+    job = None
+    if response.status_int == 200:
+      job = json.loads(response.body or '{}').get('result')
+    if not job:
+      # No result is left to fetch; once no run has queued results the
+      # handler fails, so the last fetch is not recorded.
+      return
+    stats.Add(FETCH, latency_ms, rpcs, True)
+
+    result = json.dumps({'result': {'id': job['id'],
+                                    'parent': job['parent'],
+                                    'attempt': job.get('attempt')}})
+    response, latency_ms, rpcs = _Send(
+        app, '/result/update', {'result': result, 'status': 'passed'},
+        counter)
+    stats.Add(UPDATE, latency_ms, rpcs, response.status_int == 200)
+
+
+def _RunClient(app, urls, num_requests, stats, counter):
+  """Looks up the bugs of random URLs."""
+  for _ in range(num_requests):
+    path = '/get_bugs_for_url?' + urllib.urlencode(
+        {'target_url': random.choice(urls)})
+    response, latency_ms, rpcs = _Send(app, path, None, counter)
+    stats.Add(BUGS_FOR_URL, latency_ms, rpcs, response.status_int == 200)
+
+
+def _RunThreads(target, num_threads, args):
+  """Runs target in num_threads threads; returns the elapsed seconds."""
+  threads = [threading.Thread(target=target, args=args)
+             for _ in range(num_threads)]
+  start = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return time.time() - start
+
+
+def _PrintReport(report, baseline=None):
+  """Prints the report, with the change from the baseline if given."""
+  columns = ['requests', 'errors', 'requests_per_sec', 'rpcs_per_request']
+  columns.extend(['p%d_ms' % percentile for percentile in _PERCENTILES])
+  print '%-14s' % 'handler' + ''.join(['%18s' % c for c in columns])
+  for name in sorted(report):
+    line = '%-14s' % name
+    for column in columns:
+      value = report[name][column]
+      cell = '%.1f' % value
+      if baseline and name in baseline and baseline[name][column]:
+        change = 100.0 * (value - baseline[name][column]) / (
+            baseline[name][column])
+        cell += ' (%+.0f%%)' % change
+      line += '%18s' % cell
+    print line
+
+
+def Main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--sdk', required=True,
+                      help='Path to the App Engine Python SDK.')
+  parser.add_argument('--app_root', default=os.path.dirname(
+      os.path.dirname(os.path.abspath(__file__))),
+                      help='Path to the built server bundle.')
+  parser.add_argument('--runs', type=int, default=5)
+  parser.add_argument('--tests', type=int, default=200,
+                      help='Tests per run.')
+  parser.add_argument('--executors', type=int, default=8)
+  parser.add_argument('--bugs', type=int, default=2000)
+  parser.add_argument('--urls', type=int, default=200)
+  parser.add_argument('--clients', type=int, default=8)
+  parser.add_argument('--client_requests', type=int, default=100,
+                      help='Requests sent by each client.')
+  parser.add_argument('--seed', type=int, default=0,
+                      help='Random seed, for repeatable comparisons.')
+  parser.add_argument('--output', help='Writes the report as JSON.')
+  parser.add_argument('--compare',
+                      help='JSON report of a previous run to compare with.')
+  args = parser.parse_args()
+
+  random.seed(args.seed)
+  _SetUpPaths(args.sdk, args.app_root)
+  bed = _SetUpTestbed(args.app_root)
+  try:
+    from handlers import get_bugs
+    from handlers import result_handler
+
+    SeedRuns(args.runs, args.tests)
+    urls = SeedBugs(args.bugs, args.urls)
+
+    counter = RpcCounter()
+    counter.Install()
+    stats = Stats()
+    elapsed = _RunThreads(_RunExecutor, args.executors,
+                          (result_handler.app, stats, counter))
+    stats.SetElapsed([FETCH, UPDATE], elapsed)
+    elapsed = _RunThreads(_RunClient, args.clients,
+                          (get_bugs.app, urls, args.client_requests, stats,
+                           counter))
+    stats.SetElapsed([BUGS_FOR_URL], elapsed)
+  finally:
+    bed.deactivate()
+
+  report = stats.GetReport()
+  baseline = None
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+  _PrintReport(report, baseline)
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+  Main()
@@ -25,6 +25,7 @@ import gdata.client
 import gdata.projecthosting
 import gdata.projecthosting.client
 
+from google.appengine.api import app_identity
 from google.appengine.ext import deferred
 from google.appengine.runtime import DeadlineExceededError
 
@@ -290,12 +291,18 @@ def  StoreBug(bug_id,  title, summary,  priority,  project_name,  provider,
   """Updates  or create  a Bug."""
   screenshot_link = ''
   if screenshot:
-    # Store the screenshot data and get the link.
+    # Store the screenshot data and get the link. The data URL is decoded here,
+    # in the store-bug task, rather than while handling the report request.
+    content_type, data = screenshots_util.DecodeDataUrl(screenshot)
     new_screenshot = screenshots.Add(
-        data=screenshots_util.DecodeBase64PNG(screenshot),
-        source=provider, project=project)
+        data=data, source=provider, project=project_name,
+        content_type=content_type, pending_normalization=True)
+    deferred.defer(screenshots.NormalizeScreenshot,
+                   new_screenshot.key().id(),
+                   _queue='screenshots-queue')
     screenshot_link = screenshots_util.RetrievalUrl(
-        self.request.url, new_screenshot.key().id())
+        'https://' + app_identity.get_default_version_hostname(),
+        new_screenshot.key().id())
 
   if cycle_id:
     cycle = test_cycle.AddTestCycle(provider, project_name, cycle_id)
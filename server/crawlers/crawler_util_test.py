@@ -0,0 +1,89 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the screenshots stored by crawlers.crawler_util.StoreBug.
+
+Requires the App Engine SDK on the path. Run from the server folder with:
+  python -m crawlers.crawler_util_test
+"""
+
+import os
+import unittest
+
+from google.appengine.ext import deferred
+from google.appengine.ext import testbed
+
+from crawlers import crawler_util
+from handlers import screenshots as screenshots_handler
+from models import bugs_util
+
+
+# A 1x1 PNG image, as sent by the extension in bug reports.
+SCREENSHOT = ('data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAIAAACQ'
+              'd1PeAAAADElEQVR4nGP4z8AAAAMBAQDJ/pLvAAAAAElFTkSuQmCC')
+
+SERVER_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class StoreBugScreenshotTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_app_identity_stub()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_images_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_taskqueue_stub(root_path=SERVER_ROOT)
+    self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def _StoreBug(self):
+    crawler_util.StoreBug(
+        bug_id='', title='Broken page', summary='', priority='',
+        project_name='project', provider=bugs_util.Provider.LOCAL,
+        status='unconfirmed', author='user@example.com', details_link='',
+        reported_on='2012-01-01', last_update='2012-01-01',
+        last_updater='user@example.com', urls=[], cycle_id='cycle',
+        screenshot=SCREENSHOT)
+    tasks = self.taskqueue.get_filtered_tasks(
+        queue_names='screenshots-queue')
+    self.assertEqual(1, len(tasks))
+    return tasks[0]
+
+  def _Fetch(self, screenshot_id):
+    response = screenshots_handler.app.get_response(
+        '/screenshots/fetch?id=%s' % screenshot_id)
+    self.assertEqual(200, response.status_int)
+    return response
+
+  def testScreenshotIsNotCachedUntilNormalized(self):
+    task = self._StoreBug()
+    screenshot_id = deferred.deserialize(task.payload)[1][0]
+
+    for _ in range(2):
+      response = self._Fetch(screenshot_id)
+      self.assertEqual(screenshots_handler._PENDING_CACHE_CONTROL,
+                       response.headers['Cache-Control'])
+
+    deferred.run(task.payload)
+    response = self._Fetch(screenshot_id)
+    self.assertEqual(screenshots_handler._CACHE_CONTROL,
+                     response.headers['Cache-Control'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -21,7 +21,9 @@ import datetime
 import logging
 import math
 import random
+import re
 
+from google.appengine.api import taskqueue
 from google.appengine.ext import db
 from google.appengine.ext import deferred
 
@@ -29,12 +31,18 @@ from models import bite_result
 from models import bite_run
 from models import bite_suite
 from models import suite_test_map
+from models import test_duration
 from utils import basic_util
+from utils import version_util
 
 
 DEFAULT_PUT_DELETE_MAX = 500
 DEFAULT_RESULTS_NUM_PER_TASK = 10000
 DEFAULT_NO_DEFERRED_NUM = 2000
+DEFAULT_SCHEDULED_JOBS_PER_TASK = 100
+
+# Characters not allowed in task names.
+_INVALID_TASK_NAME_CHARS = re.compile('[^a-zA-Z0-9_-]')
 
 
 def DeleteResultsOfRun(run_key_str, max_num):
@@ -94,6 +102,8 @@ def KickOffTests(test_info_list, run_slice_index, run_key):
   i = 0
   logging.info('Adding a run slice number: ' + str(run_slice_index))
   run_slice = bite_run.AddRunSlice(run_key, run_slice_index)
+  estimates = test_duration.GetEstimates(
+      [test_info['id'] for test_info in test_info_list])
   while test_info_list:
     if len(temp_list) == len(test_info_list):
       db.run_in_transaction(RetryBatchOperation, temp_list, True)
@@ -109,7 +119,10 @@ def KickOffTests(test_info_list, run_slice_index, run_key):
                                     status='queued',
                                     random=random.random(),
                                     automated=test_info['automated'],
-                                    test_name=test_info['name'])
+                                    test_name=test_info['name'],
+                                    labels=test_info.get('labels') or [],
+                                    expected_duration=estimates.get(
+                                        str(test_info['id'])))
     temp_list.append(result)
     if len(temp_list) == DEFAULT_PUT_DELETE_MAX:
       db.run_in_transaction(RetryBatchOperation, temp_list, True)
@@ -131,20 +144,44 @@ def KickOffTests(test_info_list, run_slice_index, run_key):
 def StartRun(suite_key, run_name,
              test_info_list, tokens, labels,
              dimensions, start_url,
-             run_template_key, user):
-  """Starts the run with the given info."""
+             run_template_key, user, kickoff_key=None):
+  """Starts the run with the given info.
+
+  Args:
+    suite_key: Key of the suite to run.
+    run_name: Name of the run, defaults to the name of the suite.
+    test_info_list: The tests to run, defaults to the tests of the suite.
+    tokens: Tokens an executor must present to get the tests of the run.
+    labels: Labels the tests to run must have one of.
+    dimensions: Dimension labels the tests are expanded over.
+    start_url: The url the tests start at.
+    run_template_key: Key of the run template the run is started from.
+    user: The user starting the run.
+    kickoff_key: Optional idempotency key of the run. Starting a run again
+        with the same key, e.g. from a retried task, reuses the run and only
+        adds the tests not added yet.
+
+  Returns:
+    The key of the run.
+  """
   if not suite_key and not run_template_key:
     return
 
   start_time = datetime.datetime.now()
   if not test_info_list:
-    test_info_list = GetAllTestInfo(str(suite_key), user)
+    test_info_list = GetAllTestInfo(str(suite_key), user, labels)
+  test_info_list = suite_test_map.ExpandDimensions(test_info_list, dimensions)
   if not tokens:
     tokens = bite_suite.GetSuiteTokens(suite_key)
   run = bite_run.AddRun(run_name, suite_key, start_time,
                         test_info_list, tokens, labels,
                         dimensions, start_url,
-                        run_template_key)
+                        run_template_key, kickoff_key)
+  if kickoff_key:
+    # Named tasks are only enqueued once, so a retry skips the tests added.
+    StartTests(test_info_list, run.key(),
+               task_name_prefix=_INVALID_TASK_NAME_CHARS.sub('-', kickoff_key))
+    return run.key()
   is_deferred = True
   if len(test_info_list) < DEFAULT_NO_DEFERRED_NUM:
     is_deferred = False
@@ -157,8 +194,33 @@ def GetSlicesNum(total_num):
   return int(math.ceil(float(total_num) / DEFAULT_PUT_DELETE_MAX))
 
 
-def StartTests(test_info_list, run_key, is_deferred=True):
-  """Kicks off the tests of the given suite."""
+def _DeferKickOffTests(test_info_list, run_index, run_key,
+                       task_name_prefix=None):
+  """Enqueues the KickOffTests task of a slice, once if named."""
+  if not task_name_prefix:
+    deferred.defer(KickOffTests, test_info_list,
+                   run_index, run_key, _queue='add-results')
+    return
+  try:
+    deferred.defer(KickOffTests, test_info_list,
+                   run_index, run_key, _queue='add-results',
+                   _name='%s-%d' % (task_name_prefix, run_index))
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    logging.info('The tests of slice %d of %s were already added.',
+                 run_index, run_key)
+
+
+def StartTests(test_info_list, run_key, is_deferred=True,
+               task_name_prefix=None):
+  """Kicks off the tests of the given suite.
+
+  Args:
+    test_info_list: The tests to add results for.
+    run_key: Key of the run.
+    is_deferred: Whether to add the results in tasks.
+    task_name_prefix: Optional prefix of the names of the tasks, which makes
+        calling this again for the same run only enqueue the missing tasks.
+  """
   temp_list = []
   run_index = 0
   logging.info('Starts kicking off tests in tasks.')
@@ -166,8 +228,7 @@ def StartTests(test_info_list, run_key, is_deferred=True):
     if len(test_info_list) >= DEFAULT_RESULTS_NUM_PER_TASK:
       temp_list = test_info_list[:DEFAULT_RESULTS_NUM_PER_TASK]
       if is_deferred:
-        deferred.defer(KickOffTests, temp_list,
-                       run_index, run_key, _queue='add-results')
+        _DeferKickOffTests(temp_list, run_index, run_key, task_name_prefix)
       else:
         KickOffTests(temp_list, run_index, run_key)
       del test_info_list[:DEFAULT_RESULTS_NUM_PER_TASK]
@@ -176,16 +237,117 @@ def StartTests(test_info_list, run_key, is_deferred=True):
     else:
       if test_info_list:
         if is_deferred:
-          deferred.defer(KickOffTests, test_info_list,
-                         run_index, run_key, _queue='add-results')
+          _DeferKickOffTests(test_info_list, run_index, run_key,
+                             task_name_prefix)
         else:
           KickOffTests(test_info_list, run_index, run_key)
       break
 
 
-def GetAllTestInfo(suite_key_str, user=None):
-  """Gets all the tests for the suite."""
+def GetAllTestInfo(suite_key_str, user=None, labels=None):
+  """Gets all the tests for the suite, or those with one of the labels."""
   suite = bite_suite.BiteSuite.get(db.Key(suite_key_str))
   # Assume the saved query overrides the stored tests.
-  return suite_test_map.GetAllTestInfoOfSuite(suite_key_str)
+  return suite_test_map.GetAllTestInfoOfSuite(suite_key_str, labels)
+
+
+def ScheduleDueJobs(now=None, force=False, cursor=None):
+  """Enqueues the kickoff of every scheduled job due at the given time.
+
+  Only the due jobs are read, from the next_run_time index. Each job is
+  advanced to its next run time in the same transaction as the enqueue of
+  its kickoff task, so a tick processed twice never starts a run twice. A
+  task is chained per DEFAULT_SCHEDULED_JOBS_PER_TASK jobs.
+
+  When forced, all the jobs are paged in key order instead, since the jobs
+  advanced by a batch would otherwise show up again further in the
+  next_run_time index and be started once per batch.
+
+  Args:
+    now: The time of the tick, defaults to the current time.
+    force: Whether to kick off all jobs, due or not.
+    cursor: Cursor of the due jobs query where this batch starts.
+  """
+  now = now or datetime.datetime.now()
+  if force:
+    job_keys, cursor = bite_run.GetScheduledJobKeys(
+        DEFAULT_SCHEDULED_JOBS_PER_TASK, cursor)
+  else:
+    job_keys, cursor = bite_run.GetDueScheduledJobKeys(
+        now, DEFAULT_SCHEDULED_JOBS_PER_TASK, cursor)
+  for job_key in job_keys:
+    try:
+      db.run_in_transaction(_ScheduleJob, job_key, now, force)
+    except db.TransactionFailedError:
+      logging.warning('Failed to schedule the job %s, the next tick will '
+                      'retry it.', job_key)
+  logging.info('Scheduled %d jobs.', len(job_keys))
+
+  if len(job_keys) == DEFAULT_SCHEDULED_JOBS_PER_TASK:
+    deferred.defer(ScheduleDueJobs, now, force, cursor,
+                   _queue='scheduled-runs')
+
+
+def _ScheduleJob(job_key, now, force):
+  """Advances a due job and enqueues its kickoff, in a transaction."""
+  job = bite_run.BiteScheduledJob.get(job_key)
+  if not job or not job.interval:
+    return
+  run_time = job.next_run_time
+  if not force and run_time > now:
+    # Scheduled by a concurrent tick.
+    return
+  job.next_run_time = bite_run.GetNextRunTime(run_time, job.interval, now)
+  job.put()
+  deferred.defer(KickOffScheduledJob, job_key,
+                 bite_run.GetKickoffKey(job_key, run_time),
+                 _queue='scheduled-runs', _transactional=True)
 
+
+def KickOffScheduledJob(job_key, kickoff_key):
+  """Starts the run of a scheduled job.
+
+  When the suite has a latest version URL, the run is only started if the
+  URL serves a version no run was started for yet. Builds released between
+  two ticks of the job are thus coalesced into one run, for the latest.
+
+  Args:
+    job_key: Key of the BiteScheduledJob.
+    kickoff_key: Idempotency key of the run; a retried task with the same
+        key does not start the run again.
+  """
+  job = bite_run.BiteScheduledJob.get(job_key)
+  if not job:
+    return
+  version = None
+  version_url = job.run_template.suite.latest_version_url
+  if version_url:
+    version = version_util.GetLatestVersion(version_url)
+    if not version:
+      logging.info('No version found at %s, skipping %s.',
+                   version_url, kickoff_key)
+      return
+    if version == bite_run.GetLastTargetVersion(job):
+      logging.info('No new version since the last run, skipping %s.',
+                   kickoff_key)
+      return
+
+  job = bite_run.ClaimScheduledRun(job_key, kickoff_key, version)
+  if not job:
+    logging.info('The run %s was already started.', kickoff_key)
+    return
+  run_template = job.run_template
+  try:
+    StartRun(str(bite_run.BiteRunTemplate.suite.get_value_for_datastore(
+                 run_template)),
+             run_template.name, [],
+             run_template.tokens,
+             run_template.filtered_labels,
+             run_template.test_dimension_labels,
+             run_template.start_url,
+             str(run_template.key()),
+             run_template.created_by,
+             kickoff_key)
+  except Exception:
+    bite_run.ReleaseScheduledRun(job_key, kickoff_key, version)
+    raise
@@ -43,7 +43,15 @@ class ShowEventsHandler(base.BaseHandler):
         basic_util.DumpJsonStr({'details': data}))
 
 
+class FlushEventsHandler(base.BaseHandler):
+  """Handler called by cron to write events whose flush task was lost."""
+
+  def get(self):
+    bite_event.FlushEvents()
+
+
 app = webapp2.WSGIApplication(
-    [('/event/show_all', ShowEventsHandler)],
+    [('/event/show_all', ShowEventsHandler),
+     ('/event/flush', FlushEventsHandler)],
     debug=True)
 
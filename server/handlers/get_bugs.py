@@ -75,9 +75,7 @@ class BugsForUrlHandler(base.BaseHandler):
         target_url, user_email, max_results, state, status)
 
     # JSON-encode the response and send it to the client.
-    result = bugs.JsonEncode(bugs_list)
-    self.response.headers['Content-Type'] = 'application/json'
-    self.response.out.write(result)
+    self.WriteJson(bugs_list, cls=bugs.BugEncoder)
 
 app = webapp2.WSGIApplication(
     [('/get_bugs_for_url', BugsForUrlHandler)],
@@ -0,0 +1,39 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Admin handler showing the RPC profiles of the handlers."""
+
+import webapp2
+
+from common.handlers import base
+from common.util import rpc_profile
+from utils import basic_util
+
+
+class RpcProfileHandler(base.BaseHandler):
+  """Shows the RPC histograms of the profiled handlers, slowest first."""
+
+  def get(self):
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(
+        basic_util.DumpJsonStr({'handlers': rpc_profile.GetReport()}))
+
+  def post(self):
+    """Clears the recorded profiles."""
+    rpc_profile.ClearReport()
+
+
+app = webapp2.WSGIApplication(
+    [('/admin/rpc_profile', RpcProfileHandler)],
+    debug=True)
@@ -43,11 +43,13 @@ class FetchResultHandler(base.BaseHandler):
     job = {}
     result = {}
     if run:
-      job = bite_result.GetRandomQueuedJob(run)
+      job = (bite_result.GetLongestQueuedJob(run) or
+             bite_result.GetRandomQueuedJob(run))
     if job:
       result = {'result': {'id': job.key().id(),
                            'testId': job.test_id,
-                           'parent': str(job.parent().key())}}
+                           'parent': str(job.parent().key()),
+                           'attempt': bite_result.GetCurrentAttempt(job)}}
     self.response.out.write(
         basic_util.DumpJsonStr(result))
 
@@ -84,11 +86,29 @@ class UpdateResultHandler(base.BaseHandler):
     result = bite_result.UpdateResult(
         result_obj['id'], result_obj['parent'],
         status, screenshot, log, '', ip,
-        project_name, platform, chrome_version)
+        project_name, platform, chrome_version,
+        result_obj.get('attempt'))
+    if not result:
+      self.response.out.write(
+          'Result was reclaimed before the update, ignored it.')
+      return
     self.response.out.write(
         'Result has been successfully updated.' + result.test_id)
 
 
+class ReclaimResultsHandler(base.BaseHandler):
+  """Handler called by cron to reclaim results held by lost executors.
+
+  Reclaims the first batch of expired results, and reports how many; the
+  others are reclaimed by chained tasks.
+  """
+
+  def get(self):
+    requeued, failed = bite_result.ReclaimExpiredResults()
+    self.response.out.write(
+        basic_util.DumpJsonStr({'requeued': requeued, 'failed': failed}))
+
+
 class ViewResultHandler(base.BaseHandler):
   """The handler for viewing a result."""
 
@@ -132,6 +152,7 @@ class GetResultTableHandler(base.BaseHandler):
 app = webapp2.WSGIApplication(
     [('/result/fetch', FetchResultHandler),
      ('/result/update', UpdateResultHandler),
+     ('/result/reclaim', ReclaimResultsHandler),
      ('/result/view', ViewResultHandler),
      ('/result/tableview', TableViewResultHandler),
      ('/result/get_result_table', GetResultTableHandler)],
@@ -36,6 +36,7 @@ from models import bite_project
 from models import bite_result
 from models import bite_run
 from models import bite_suite
+from models import entity_loader
 from utils import basic_util
 
 
@@ -50,6 +51,10 @@ class NotEnoughInfoError(Error):
   """Raised when there is not enough info passed."""
 
 
+class LabelInfoFormatError(Error):
+  """An error encountered if the label format is not correct."""
+
+
 class ShowRunsOfSameSuiteHandler(base.BaseHandler):
   """The handler for showing the runs of the same suite."""
 
@@ -114,7 +119,8 @@ class ShowRunsHandler(base.BaseHandler):
 
   def _GetScheduledRunsData(self, project_name):
     """Gets the scheduled runs data."""
-    jobs = bite_run.GetAllScheduledJobs(project_name)
+    jobs = list(bite_run.GetAllScheduledJobs(project_name))
+    entity_loader.EntityLoader().Prefetch(jobs, 'run_template.suite')
     runs_data = []
     for job in jobs:
       run_template = job.run_template
@@ -126,7 +132,8 @@ class ShowRunsHandler(base.BaseHandler):
           'id': str(job.key()),
           'type': 'run',
           'title': run_template.name,
-          'labels': [suite.parent().name].extend(run_template.filtered_labels),
+          'labels': ([bite_suite.GetProjectName(suite)] +
+                     run_template.filtered_labels),
           'icon': '/images/run00-pie.png',
           'props': [{'label': '# of tests', 'value': suite.tests_number},
                     {'label': 'last time', 'value': last_time},
@@ -215,8 +222,7 @@ class GetDetailsHandler(base.BaseHandler):
     self.AddRunSummary(details, passed_num, failed_num,
                        run_start_time, run_lead, run)
     details['results'] = self.AddRunDetails(results)
-    self.response.out.write(
-        basic_util.DumpJsonStr({'details': details}))
+    self.WriteJson({'details': details})
 
 
 class LoadResultsSummaryHandler(GetDetailsHandler):
@@ -276,8 +282,7 @@ class LoadResultsDetailsHandler(GetDetailsHandler):
         'numOfTests': len(data['results']),
         'resultRows': data['results']
     }
-    self.response.out.write(
-        basic_util.DumpJsonStr({'data': details}))
+    self.WriteJson({'data': details})
 
 
 class LoadRunTemplateHandler(base.BaseHandler):
@@ -368,51 +373,22 @@ class AddRunTemplateHandler(base.BaseHandler):
 
 
 class CheckScheduledJobs(base.BaseHandler):
-  """Checks whether to run the scheduled jobs."""
+  """Checks whether to run the scheduled jobs.
+
+  The due jobs are kicked off from tasks, see deferred_util.ScheduleDueJobs.
+  Passing test kicks off all jobs; passing backfill first schedules the jobs
+  created before the schedule was stored.
+  """
 
   def get(self):
     self.post()
 
-  def _checkHitInterval(self, last_time, interval, test):
-    elapsed_time = datetime.datetime.now() - last_time
-    elapsed_minutes = elapsed_time.days * 24 * 60 + elapsed_time.seconds / 60
-    logging.info(
-        'Since last run, it has passed ' + str(elapsed_minutes) + ' mins')
-    if test:
-      return True
-    else:
-      return elapsed_minutes > interval
-
-  def CheckScheduledJob(self, test):
-    """Checks whether to launch the scheduled jobs."""
-    jobs = bite_run.GetAllScheduledJobs()
-    updated_jobs = []
-    for job in jobs:
-      interval = bite_suite.ParseWatchdogSetting(
-          job.run_template.watchdog_setting)
-      if (interval and self._checkHitInterval(job.watchdog_last_time,
-                                              interval, test)):
-        self.kickOffScheduledJob(job.run_template)
-        job.watchdog_last_time = datetime.datetime.now()
-        updated_jobs.append(job)
-    if updated_jobs:
-      bite_run.UpdateScheduledJobs(updated_jobs)
-
-  def kickOffScheduledJob(self, run_template):
-    deferred_util.StartRun(
-        str(run_template.suite.key()),
-        run_template.name, [],
-        run_template.tokens,
-        run_template.filtered_labels,
-        run_template.test_dimension_labels,
-        run_template.start_url,
-        str(run_template.key()),
-        run_template.created_by)
-
   def post(self):
     """Checks whether to run a suite."""
     test = self.GetOptionalParameter('test', '')
-    self.CheckScheduledJob(test)
+    if self.GetOptionalParameter('backfill', ''):
+      bite_run.BackfillScheduledJobs()
+    deferred_util.ScheduleDueJobs(force=bool(test))
     self.response.out.write('done')
 
 
@@ -469,6 +445,31 @@ class AddRunHandler(base.BaseHandler):
   def get(self):
     self.post()
 
+  def _parseLabelStr(self, label_str):
+    """Parses a labels or dimensions string.
+
+    The string in Json format should be either a list of labels, as the run
+    template handler takes, or {'labels': ['label1', 'label2', ...]}, as the
+    suite handler takes.
+
+    Args:
+      label_str: A Json format string represents the labels.
+
+    Returns:
+      A list of labels.
+
+    Raises:
+      LabelInfoFormatError: An error occurred if the label info is incorrect.
+    """
+    if not label_str:
+      return []
+    label_obj = basic_util.ParseJsonStr(label_str)
+    if isinstance(label_obj, dict):
+      label_obj = label_obj.get('labels')
+    if isinstance(label_obj, list):
+      return label_obj
+    raise LabelInfoFormatError()
+
   def post(self):
     """Starts a run, kicks off the tests and returns the run key."""
     user = users.get_current_user()
@@ -476,12 +477,17 @@ class AddRunHandler(base.BaseHandler):
     run_template_key = self.GetOptionalParameter('runTemplateKey', '')
     run_key = self.GetOptionalParameter('runKey', '')
     run_name = self.GetOptionalParameter('runName', '')
-    test_info_list = self.GetOptionalParameter('testInfoList', [])
+    test_info_list_str = self.GetOptionalParameter('testInfoList', '')
     tokens = self.GetOptionalParameter('tokens', '')
-    labels = self.GetOptionalParameter('labels', [])
-    dimensions = self.GetOptionalParameter('dimensions', [])
+    labels = self._parseLabelStr(self.GetOptionalParameter('labels', ''))
+    dimensions = self._parseLabelStr(
+        self.GetOptionalParameter('dimensions', ''))
     start_url = self.GetOptionalParameter('startUrl', '')
 
+    test_info_list = []
+    if test_info_list_str:
+      test_info_list = basic_util.ParseJsonStr(test_info_list_str)
+
     if not suite_key and not run_template_key and not run_key:
       raise NotEnoughInfoError('Not enough info to start the run.')
 
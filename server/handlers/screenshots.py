@@ -16,9 +16,14 @@
 
 __author__ = 'alexto@google.com (Alexis O. Torres)'
 
+import calendar
 import json
 import webapp2
 
+from email import utils as email_utils
+
+from google.appengine.ext import deferred
+
 from common.handlers import base
 from models import screenshots
 from utils import screenshots_util
@@ -54,19 +59,146 @@ class UploadHandler(base.BaseHandler):
         json.dumps({'id': screenshot_id, 'url': screenshot_url}))
 
 
+# Screenshots only change when normalized after a binary upload, so clients
+# may keep them for long once normalized; until then they must revalidate.
+_CACHE_CONTROL = 'private, max-age=604800'
+_PENDING_CACHE_CONTROL = 'private, no-cache'
+
+
+def _FormatHttpDate(date):
+  """Formats a naive UTC datetime as an HTTP date."""
+  return email_utils.formatdate(calendar.timegm(date.utctimetuple()),
+                                usegmt=True)
+
+
+def _ParseHttpDate(value):
+  """Parses an HTTP date into seconds since the epoch, or None if invalid."""
+  parsed = email_utils.parsedate_tz(value)
+  if not parsed:
+    return None
+  return email_utils.mktime_tz(parsed)
+
+
+class BinaryUploadHandler(base.BaseHandler):
+  """Class for handling uploads of raw image bytes.
+
+  Unlike UploadHandler, the image is not sent as a form field. It is either
+  the request body itself (Content-Type image/png or image/jpeg, metadata in
+  the query string) or a multipart/form-data file field named "screenshot".
+  """
+
+  def post(self):
+    """Handles uploading a new screenshot as binary data."""
+    # Required params.
+    source = self.GetRequiredParameter('source')
+    project = self.GetRequiredParameter('project')
+    # Optional params.
+    source_id = self.GetOptionalParameter('source_id', '')
+    caption = self.GetOptionalParameter('caption', None)
+    details = self.GetOptionalParameter('details', None)
+    labels = self.GetOptionalParameter('labels', None)
+    if labels:
+      labels = json.loads(labels)
+
+    data = self._GetImageData()
+    if not data:
+      raise base.MissingRequiredParameterError('screenshot')
+    if len(data) > screenshots_util.MAX_UPLOAD_BYTES:
+      raise base.Error('Screenshot exceeds %d bytes.\n' %
+                       screenshots_util.MAX_UPLOAD_BYTES, code=413)
+    # Only the magic bytes are checked here, the image itself is decoded and
+    # validated by the normalization task.
+    content_type = screenshots_util.DetectContentType(data)
+    if not content_type:
+      raise base.Error('Screenshot must be a PNG or JPEG image.\n', code=415)
+
+    screenshot = screenshots.Add(data=data, source=source, source_id=source_id,
+                                 project=project, caption=caption,
+                                 details=details, labels=labels,
+                                 content_type=content_type,
+                                 pending_normalization=True)
+    screenshot_id = screenshot.key().id()
+    deferred.defer(screenshots.NormalizeScreenshot, screenshot_id,
+                   _queue='screenshots-queue')
+
+    screenshot_url = screenshots_util.RetrievalUrl(
+        self.request.url, screenshot_id)
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(
+        json.dumps({'id': screenshot_id, 'url': screenshot_url}))
+
+  def _GetImageData(self):
+    """Returns the uploaded image bytes from the file field or the body."""
+    content_type = self.request.headers.get('Content-Type', '')
+    if content_type.startswith('multipart/form-data'):
+      field = self.request.POST.get('screenshot')
+      # Plain (non-file) fields are returned as strings.
+      return getattr(field, 'value', field)
+    return self.request.body
+
+
 class GetHandler(base.BaseHandler):
   """Class for handling fetching a screenshot."""
 
   def get(self):
-    """Handles retrieving an existing screenshot."""
+    """Handles retrieving an existing screenshot.
+
+    Supports an optional size parameter to fetch a downscaled rendition and
+    answers conditional requests (If-None-Match/If-Modified-Since) with a 304.
+    """
     screenshot_id = self.GetRequiredParameter('id')
-    screenshot = screenshots.GetById(screenshot_id=screenshot_id)
-    if not screenshot:
+    size = self.GetOptionalParameter('size', None)
+    if size and size not in screenshots.SIZES:
+      self.error(400)
+      return
+
+    # Revalidations are answered from memcache alone when possible.
+    rendition = screenshots.GetCachedRendition(screenshot_id, size)
+    if rendition and self._IsNotModified(rendition):
+      self._WriteNotModified(rendition)
+      return
+
+    if not rendition or rendition.data is None:
+      rendition = screenshots.GetRendition(screenshot_id, size)
+    if not rendition:
       self.error(400)
       return
 
-    self.response.headers['Content-Type'] = 'image/png'
-    self.response.out.write(screenshot.data)
+    if self._IsNotModified(rendition):
+      self._WriteNotModified(rendition)
+      return
+
+    self._WriteCacheHeaders(rendition)
+    self.response.headers['Content-Type'] = rendition.content_type
+    self.response.out.write(rendition.data)
+
+  def _IsNotModified(self, rendition):
+    """Whether the client already has the given rendition."""
+    if_none_match = self.request.headers.get('If-None-Match')
+    if if_none_match:
+      etags = [etag.strip() for etag in if_none_match.split(',')]
+      return '*' in etags or '"%s"' % rendition.etag in etags
+
+    if_modified_since = self.request.headers.get('If-Modified-Since')
+    if if_modified_since and rendition.modified_date:
+      since = _ParseHttpDate(if_modified_since)
+      modified = calendar.timegm(rendition.modified_date.utctimetuple())
+      return since is not None and modified <= since
+    return False
+
+  def _WriteCacheHeaders(self, rendition):
+    self.response.headers['ETag'] = '"%s"' % rendition.etag
+    if rendition.final:
+      self.response.headers['Cache-Control'] = _CACHE_CONTROL
+    else:
+      self.response.headers['Cache-Control'] = _PENDING_CACHE_CONTROL
+    if rendition.modified_date:
+      self.response.headers['Last-Modified'] = _FormatHttpDate(
+          rendition.modified_date)
+
+  def _WriteNotModified(self, rendition):
+    self.response.set_status(304)
+    self._WriteCacheHeaders(rendition)
 
 
 class SearchHandler(base.BaseHandler):
@@ -80,19 +212,32 @@ class SearchHandler(base.BaseHandler):
     source_id = self.GetOptionalParameter('source_id', None)
     project = self.GetOptionalParameter('project', None)
     limit = int(self.GetOptionalParameter('max', screenshots.DEFAULT_LIMIT))
+    # When set, each match is returned as an object with its id, URL and
+    # thumbnail URL instead of just the URL.
+    with_thumbnails = self.GetOptionalParameter('thumbnails', '') == 'true'
 
+    # Only ids are needed to build the URLs, skip loading the image data.
     matches = screenshots.GetScreenshots(source=source,
                                          source_id=source_id,
                                          project=project,
-                                         limit=limit)
+                                         limit=limit,
+                                         keys_only=True)
     request_url = self.request.url
-    result = [screenshots_util.RetrievalUrl(request_url, curr.key().id())
-              for curr in matches]
+    if with_thumbnails:
+      result = [{'id': key.id(),
+                 'url': screenshots_util.RetrievalUrl(request_url, key.id()),
+                 'thumbnail_url': screenshots_util.ThumbnailUrl(request_url,
+                                                                key.id())}
+                for key in matches]
+    else:
+      result = [screenshots_util.RetrievalUrl(request_url, key.id())
+                for key in matches]
     self.response.out.write(json.dumps(result))
 
 
 app = webapp2.WSGIApplication(
     [('/screenshots/upload', UploadHandler),
+     ('/screenshots/upload/binary', BinaryUploadHandler),
      ('/screenshots/fetch', GetHandler),
      ('/screenshots/search', SearchHandler)
     ], debug=True)
@@ -16,29 +16,39 @@
 
 __author__ = 'alexto@google.com (Alexis O. Torres)'
 
+import datetime
 import json
+import logging
 import re
 import sys
+import threading
 import webapp2
 
-from google.appengine.api import memcache
 from google.appengine.api import users
+from google.appengine.ext import blobstore
 
 from common.handlers import base
+from models import entity_loader
 from models.compat import admins
 from models.compat import assignment
 from models.compat import browser as compat_browser
 from models.compat import result as compat_result
+from models.compat import result_export
 from models.compat import run as compat_run
 from models.compat import run_site_map
 from models.compat import run_tester_map
 from models.compat import site as compat_site
+from models.compat import stats as compat_stats
 from models.compat import tester
+from models.compat import tests
 from models.compat import verification
+from utils import lru_cache
 
 
 JSON_CONTENT_TYPE = 'application/json'
 
+EXPORT_STATUS_PATH = '/compat/results/export/status'
+
 
 # Extracts the OS, OS version, webkit version, and chrome version from the
 # user agent string. User agent strings looks like this:
@@ -53,6 +63,22 @@ _EXTRACT_VERSION_RE = re.compile(
     '\((?P<platform>.*); .; (?P<platform_version>.*); (?P<locale>..-..)\) .+'
     'webkit/(?P<webkit_version>[\d\.]+) .+ chrome/(?P<chrome_version>[\d\.]+) ')
 
+# Instance local cache of user agent string to BrowserVersion. Only a handful
+# of distinct user agents hit the server each day, so most requests resolve
+# their browser version without parsing the user agent or calling memcache.
+# Entries expire so that changes made to a BrowserVersion by other instances,
+# e.g. SetTestsMaterialized, are eventually seen.
+_MAX_CACHED_USER_AGENTS = 200
+_BROWSER_VERSION_TTL = 300
+_browser_versions = lru_cache.LruCache(_MAX_CACHED_USER_AGENTS,
+                                       ttl=_BROWSER_VERSION_TTL)
+
+# Locks of the user agents being resolved by this instance, so concurrent
+# requests from a new user agent resolve (and possibly insert) its browser
+# version once, without holding up the requests of other user agents.
+_browser_version_locks = {}
+_browser_version_locks_lock = threading.Lock()
+
 
 def GetBrowserInfo(user_agent):
   """Extracts browser version information from the supplied string.
@@ -71,8 +97,45 @@ def GetBrowserInfo(user_agent):
   return result.groupdict()
 
 
+def _ResolveBrowserVersion(user_agent):
+  """Gets the BrowserVersion for a user agent, inserting it if new.
+
+  Args:
+    user_agent: User agent string.
+
+  Returns:
+    A BrowserVersion object, or None if the user agent is not recognized.
+  """
+  browser_info = GetBrowserInfo(user_agent)
+  if not browser_info:
+    return None
+
+  return assignment.GetBrowserVersion(
+      platform=browser_info['platform'],
+      platform_version=browser_info['platform_version'],
+      webkit_version=browser_info['webkit_version'],
+      chrome_version=browser_info['chrome_version'],
+      locale=browser_info['locale'])
+
+
 class SiteCompatHandler(base.BaseHandler):
-  """Base handler for the Site Compatibility handlers."""
+  """Base handler for the Site Compatibility handlers.
+
+  Attributes:
+    loader: EntityLoader used to resolve references in batches during the
+        request.
+  """
+
+  def dispatch(self):
+    """Handles the request with a fresh request-local EntityLoader."""
+    self.loader = entity_loader.EntityLoader()
+    try:
+      super(SiteCompatHandler, self).dispatch()
+    finally:
+      if self.loader.dereferences:
+        logging.info('Resolved %d references with %d gets (%d saved).',
+                     self.loader.dereferences, self.loader.round_trips,
+                     self.loader.round_trips_saved)
 
   def IsCurrentUserSuperAdmin(self):
     """Wheter the current user is a site-wide admin."""
@@ -98,16 +161,26 @@ class SiteCompatHandler(base.BaseHandler):
 
   def GetBrowserVersion(self):
     """Gets the BrowserVersion that match the user-agent information."""
-    browser_info = GetBrowserInfo(self.request.headers['user-agent'])
-    if not browser_info:
-      return None
-
-    return assignment.GetBrowserVersion(
-        platform=browser_info['platform'],
-        platform_version=browser_info['platform_version'],
-        webkit_version=browser_info['webkit_version'],
-        chrome_version=browser_info['chrome_version'],
-        locale=browser_info['locale'])
+    user_agent = self.request.headers['user-agent']
+    found, browser_version = _browser_versions.Get(user_agent)
+    if found:
+      return browser_version
+
+    with _browser_version_locks_lock:
+      lock = _browser_version_locks.setdefault(user_agent, threading.Lock())
+    try:
+      with lock:
+        found, browser_version = _browser_versions.Get(user_agent)
+        if not found:
+          browser_version = _ResolveBrowserVersion(user_agent)
+          _browser_versions.Put(user_agent, browser_version)
+    finally:
+      # Requests still waiting on the lock find the cached entry; a request
+      # arriving in between at worst resolves the browser version again.
+      with _browser_version_locks_lock:
+        if _browser_version_locks.get(user_agent) is lock:
+          del _browser_version_locks[user_agent]
+    return browser_version
 
 # Disable 'Invalid method name' lint error.
 # pylint: disable-msg=C6409
@@ -141,9 +214,9 @@ class RunsVisibilityHandler(SiteCompatHandler):
     key_name = self.GetRequiredParameter('id')
     hide = self.GetRequiredParameter('hide')
     if hide.lower() == 'true':
-      compat_run.SetVisibility(key_name=key_name, hidden=True)
+      assignment.SetRunVisibility(key_name=key_name, hidden=True)
     else:
-      compat_run.SetVisibility(key_name=key_name, hidden=False)
+      assignment.SetRunVisibility(key_name=key_name, hidden=False)
 
 
 # Disable 'Invalid method name' lint error.
@@ -342,11 +415,13 @@ class TesterTestsHandler(SiteCompatHandler):
         user=user, browser_version=version)
     test_data = None
     if assign:
+      self.loader.Prefetch([assign], 'test.run', 'test.mapping.site',
+                           'test.mapping.verification')
       test = assign.test
       test_data = {'key': assign.key().name(),
                    'run_name': test.run.name,
-                   'url': test.start_url,
-                   'steps': test.steps}
+                   'url': tests.GetStartUrl(test),
+                   'steps': tests.GetSteps(test)}
     self.RenderTemplate('site_compat.html',
                         {'view': 'tester_test',
                          'test': test_data,
@@ -403,10 +478,12 @@ class MyTestsHandler(SiteCompatHandler):
       assign = assignment.GetOrAssignTest(
           user=user, browser_version=self.GetBrowserVersion())
       if assign:
+        self.loader.Prefetch([assign], 'test.mapping.site',
+                             'test.mapping.verification')
         test = assign.test
         test_data = {'test_id': assign.key().name(),
-                     'test_url': test.start_url,
-                     'verification_steps': test.steps}
+                     'test_url': tests.GetStartUrl(test),
+                     'verification_steps': tests.GetSteps(test)}
       response = json.dumps(
           {'user': user.email(),
            'test': test_data})
@@ -427,6 +504,105 @@ class AllResultsHandler(SiteCompatHandler):
                          'user': self.GetUserInfo()})
 
 
+class ExportResultsHandler(SiteCompatHandler):
+  """Handler used to export the results as CSV or newline delimited JSON.
+
+  A GET writes the export to the response page by page, unless it has more
+  than result_export.MAX_INLINE_ROWS results. A POST, or a GET of a larger
+  export, starts a background export to a blob instead; its progress is
+  reported by ExportStatusHandler, at the location returned. Both accept the
+  format, chrome_version, platform, since and until (YYYY-MM-DD) parameters.
+  """
+
+  def GetExportFormat(self):
+    export_format = self.GetOptionalParameter('format', result_export.CSV)
+    if export_format not in result_export.CONTENT_TYPES:
+      raise base.Error('Unknown export format: %s\n' % export_format)
+    return export_format
+
+  def GetDateParameter(self, parameter_name):
+    value = self.GetOptionalParameter(parameter_name, None)
+    if not value:
+      return None
+    try:
+      return datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+      raise base.Error('Invalid date for %s: %s\n' % (parameter_name, value))
+
+  def GetResultsFilter(self):
+    return result_export.ResultsFilter(
+        chrome_version=self.GetOptionalParameter('chrome_version', None),
+        platform=self.GetOptionalParameter('platform', None),
+        since=self.GetDateParameter('since'),
+        until=self.GetDateParameter('until'))
+
+  def WriteExportStarted(self, export):
+    location = '%s?id=%d' % (EXPORT_STATUS_PATH, export.key().id())
+    self.response.headers['Location'] = location
+    self.response.headers['Content-Type'] = JSON_CONTENT_TYPE
+    self.response.out.write(json.dumps({'id': export.key().id(),
+                                        'status': export.status,
+                                        'location': location}))
+
+  def get(self):
+    """Writes the matching results to the response, if not too many."""
+    export_format = self.GetExportFormat()
+    results_filter = self.GetResultsFilter()
+    max_rows = result_export.MAX_INLINE_ROWS
+    if result_export.CountResults(results_filter, max_rows + 1) > max_rows:
+      self.response.set_status(202)
+      self.WriteExportStarted(
+          result_export.StartExport(export_format, results_filter))
+      return
+
+    self.response.headers['Content-Type'] = (
+        result_export.CONTENT_TYPES[export_format])
+    self.response.headers['Content-Disposition'] = (
+        'attachment; filename="results.%s"' % export_format)
+    self.response.out.write(result_export.FormatHeader(export_format))
+    for results, _, _ in result_export.IterPages(results_filter):
+      self.response.out.write(
+          result_export.FormatPage(results, export_format))
+
+  def post(self):
+    """Starts a background export of the matching results."""
+    self.WriteExportStarted(
+        result_export.StartExport(self.GetExportFormat(),
+                                  self.GetResultsFilter()))
+
+
+class ExportStatusHandler(SiteCompatHandler):
+  """Handler reporting the progress of a background export.
+
+  Once the export is done, passing download=true serves the exported file.
+  """
+
+  def get(self):
+    export = result_export.GetExport(self.GetRequiredParameter('id'))
+    if not export:
+      self.error(404)
+      return
+
+    if self.GetOptionalParameter('download', None) == 'true':
+      if export.status != result_export.Status.DONE:
+        raise base.Error('Export not finished yet.\n', code=409)
+      self.response.headers[blobstore.BLOB_KEY_HEADER] = export.blob_key
+      self.response.headers['Content-Type'] = (
+          result_export.CONTENT_TYPES[export.format])
+      self.response.headers['Content-Disposition'] = (
+          'attachment; filename="results.%s"' % export.format)
+      return
+
+    status = {'id': export.key().id(),
+              'status': export.status,
+              'rows': export.rows}
+    if export.status == result_export.Status.DONE:
+      status['download'] = '%s?id=%d&download=true' % (EXPORT_STATUS_PATH,
+                                                       export.key().id())
+    self.response.headers['Content-Type'] = JSON_CONTENT_TYPE
+    self.response.out.write(json.dumps(status))
+
+
 # Disable 'Invalid method name' lint error.
 # pylint: disable-msg=C6409
 class StatsHandler(SiteCompatHandler):
@@ -444,11 +620,7 @@ class StatsHandler(SiteCompatHandler):
     if scope:
       result = self.GetPersonalStats()
     else:
-      stats_key = 'SiteCompat_TopLevelStats'
-      result = memcache.get(stats_key)
-      if not result:
-        result = self.GetTopLevelStats()
-        memcache.set(stats_key, result, 1800)  # Cache for 30 mins.
+      result = self.GetTopLevelStats()
     self.response.headers['Content-Type'] = JSON_CONTENT_TYPE
     self.response.out.write(json.dumps(result))
 
@@ -460,14 +632,22 @@ class StatsHandler(SiteCompatHandler):
         (run_name, site_url, chrome_version, platform, platform_version,
         webkit_version, succeed, created)
     """
-    results = compat_result.GetResultsForUser(users.get_current_user())
+    results = compat_result.GetResultsForUser(users.get_current_user(),
+                                              prefetch_ref_properties=False)
     if not results:
       return None
+    self.loader.Prefetch(results, 'browser_version', 'mapping.run',
+                         'mapping.site')
 
     def _GetDetails(result):
-      test = result.test.get()
-      start_url = test.start_url
-      curr_run = test.run
+      if compat_result.Result.mapping.get_value_for_datastore(result):
+        start_url = result.mapping.site.url
+        curr_run = result.mapping.run
+      else:
+        # Results logged without a mapping are only linked from their test.
+        test = result.test.get()
+        start_url = tests.GetStartUrl(test)
+        curr_run = test.run
       browser = result.browser_version
       return (curr_run.name, start_url, browser.chrome_version,
               browser.platform, browser.platform_version,
@@ -479,33 +659,32 @@ class StatsHandler(SiteCompatHandler):
   def GetTopLevelStats(self):
     """Gets a list of results stats submitted for recent chrome versions.
 
+    The stats are read from the counters maintained as tests and results
+    are added, see models.compat.stats.
+
     Returns:
         A list of tuples. A tuple in the returned list follows this format:
         (chrome_version, (total_results, passed, failed, remaining))
     """
-    versions_table = {}
-    versions = compat_browser.GetBrowserVersions()
-    for version in versions:
-      results = compat_result.GetResultsForBrowserVersion(version)
-      total = len(results)
-      passed = len([result for result in results if result.succeed])
-      failed = total - passed
-      remaining = len(assignment.GetTestsRemainingForBrowser(version))
-      chrome_version = version.chrome_version
-      if chrome_version in versions_table:
-        current = versions_table[chrome_version]
-        total += current[0]
-        passed += current[1]
-        failed += current[2]
-        remaining += current[3]
-      versions_table[chrome_version] = (total, passed, failed, remaining)
-
-    keys = sorted(versions_table.keys())
-
-    def _GetVals(key):
-      return (key, versions_table[key])
-
-    return map(_GetVals, keys)
+    return compat_stats.GetStats()
+
+
+# Disable 'Invalid method name' lint error.
+# pylint: disable-msg=C6409
+class ReconcileStatsHandler(SiteCompatHandler):
+  """Handler called by cron to recompute the stats counters."""
+
+  def get(self):
+    compat_stats.Reconcile()
+
+
+# Disable 'Invalid method name' lint error.
+# pylint: disable-msg=C6409
+class CompactTestsHandler(SiteCompatHandler):
+  """Handler spawning the rewrite of all tests in the compact format."""
+
+  def get(self):
+    tests.StartCompaction()
 
 
 # Disable 'Invalid method name' lint error.
@@ -518,6 +697,7 @@ class RedirectHandler(SiteCompatHandler):
         self.GetRequiredParameter('test_id'))
     if assign:
       assignment.IncrementNavigationData(assign)
+      self.loader.Prefetch([assign], 'run_site_map.site')
       self.redirect(assign.run_site_map.site.url)
     else:
       self.response.out.write('Invalid test_id')
@@ -566,8 +746,12 @@ class ListHandler(SiteCompatHandler):
     elif requested_list == 'subscriptions':
       user = users.get_current_user()
       available_runs = compat_run.GetRuns()
-      tester_mappings = run_tester_map.GetMappingsForTester(user)
-      tester_runs = [mapping.run.key().name() for mapping in tester_mappings]
+      tester_mappings = run_tester_map.GetMappingsForTester(
+          user, prefetch_ref_properties=False)
+      tester_runs = [
+          run_tester_map.RunTesterMap.run.get_value_for_datastore(
+              mapping).name()
+          for mapping in tester_mappings]
       response = [{'id': r.key().name(),
                    'name': r.name,
                    'description': r.description,
@@ -626,7 +810,11 @@ app = webapp2.WSGIApplication(
      ('/compat/subscriptions', TesterMapHandler),
      ('/compat/my_results', ResultsHandler),
      ('/compat/all_results', AllResultsHandler),
+     ('/compat/results/export', ExportResultsHandler),
+     (EXPORT_STATUS_PATH, ExportStatusHandler),
      ('/compat/stats', StatsHandler),
+     ('/compat/stats/reconcile', ReconcileStatsHandler),
+     ('/compat/tests/compact', CompactTestsHandler),
      ('/compat/runs', RunsHandler),
      ('/compat/runs_visibility', RunsVisibilityHandler),
      ('/compat/verifications', VerificationsHandler),
@@ -27,7 +27,11 @@ import logging
 import json
 import webapp2
 
+from google.appengine.api import users
+from google.appengine.ext import deferred
+
 from common.handlers import base
+from models import search_index
 from models import storage
 from models import storage_project
 from utils import zip_util
@@ -187,6 +191,38 @@ class SaveZipFile(base.BaseHandler):
     self.response.out.write(key)
 
 
+class SearchTests(base.BaseHandler):
+  """Searches the tests by name and step text."""
+
+  def get(self):
+    self.post()
+
+  def post(self):
+    """Returns a page of the tests matching the query."""
+    query = self.GetOptionalParameter('q', '')
+    project = self.GetOptionalParameter('project', None)
+    limit = self.GetOptionalIntParameter('limit',
+                                         search_index.DEFAULT_PAGE_SIZE)
+    cursor = self.GetOptionalParameter('cursor', None)
+    tests, cursor, more = storage.SearchTests(query, project, limit, cursor)
+    results = [{'id': test.id,
+                'test_name': test.test_name,
+                'project': test.project} for test in tests]
+    self.response.out.write(json.dumps({'tests': results,
+                                        'cursor': cursor,
+                                        'more': more}))
+
+
+class ReindexTests(base.BaseHandler):
+  """Rebuilds the search index of the tests, for admins only."""
+
+  def post(self):
+    if not users.is_current_user_admin():
+      raise base.Error('Only admins can rebuild the index.\n', code=403)
+    deferred.defer(storage.ReindexTests)
+    self.response.out.write('Reindexing started.')
+
+
 class GetZipFile(base.BaseHandler):
   """Convert an RPF project's exported tests into a zip file."""
   def get(self):
@@ -327,6 +363,8 @@ app = webapp2.WSGIApplication(
      ('/storage/savezip', SaveZipFile),
      ('/storage/getzip', GetZipFile),
      ('/storage/deletetest', DeleteTest),
+     ('/storage/searchtests', SearchTests),
+     ('/storage/reindex', ReindexTests),
      ('/storage/getproject', GetProject),
      ('/storage/saveproject', SaveProject),
      ('/storage/getprojectnames', GetProjectNames),
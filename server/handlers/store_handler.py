@@ -21,8 +21,10 @@ import json
 import webapp2
 
 from google.appengine.api import users
+from google.appengine.ext import deferred
 
 from common.handlers import base
+from models import search_index
 from models import store
 
 
@@ -156,6 +158,37 @@ class ViewMethodsHandler(base.BaseHandler):
                          'label': label})
 
 
+class SearchMethodsHandler(base.BaseHandler):
+  """Search methods handler.
+
+  Finds methods whose name, description or labels contain all the words of
+  the query; words ending with "*" are matched as name or label prefixes.
+  """
+
+  def get(self):
+    self.post()
+
+  def post(self):
+    query = self.GetOptionalParameter('q', '')
+    limit = self.GetOptionalIntParameter('limit',
+                                         search_index.DEFAULT_PAGE_SIZE)
+    cursor = self.GetOptionalParameter('cursor', None)
+    methods, cursor, more = store.SearchMethods(query, limit, cursor)
+    self.response.out.write(json.dumps({'methods': methods,
+                                        'cursor': cursor,
+                                        'more': more}))
+
+
+class ReindexMethodsHandler(base.BaseHandler):
+  """Rebuilds the search index of the methods, for admins only."""
+
+  def post(self):
+    if not users.is_current_user_admin():
+      raise base.Error('Only admins can rebuild the index.\n', code=403)
+    deferred.defer(store.ReindexMethods)
+    self.response.out.write('Reindexing started.')
+
+
 class GetMethodHandler(base.BaseHandler):
   """Submit method handler."""
 
@@ -198,6 +231,8 @@ app = webapp2.WSGIApplication([
      ('/store/update_method', UpdateMethodHandler),
      ('/store/get_method', GetMethodHandler),
      ('/store/view', ViewMethodsHandler),
+     ('/store/search', SearchMethodsHandler),
+     ('/store/reindex', ReindexMethodsHandler),
      ('/store/delete', DeleteMethodHandler),
      ('/store/check_method_name', CheckMethodNameHandler)
     ])
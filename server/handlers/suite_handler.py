@@ -71,7 +71,7 @@ class ShowSuitesHandler(base.BaseHandler):
       projects = [project_name]
     suites = bite_suite.LoadAllSuitesOfProjects(projects)
     for suite in suites:
-      labels = [suite.parent().name]
+      labels = [bite_suite.GetProjectName(suite)]
       labels.extend(suite.labels)
       suite_data = {
           'id': str(suite.key()),
@@ -168,7 +168,7 @@ class LoadSuiteHandler(base.BaseHandler):
               {'suiteName': suite.name,
                'suiteKey': str(suite.key()),
                'description': suite.description,
-               'projectName': suite.parent().name,
+               'projectName': bite_suite.GetProjectName(suite),
                'labels': labels,
                'token': bite_suite.GetSuiteTokens(suite),
                'startUrl': bite_suite.GetStartUrl(suite),
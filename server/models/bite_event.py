@@ -12,16 +12,56 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Bite Event model is used to log activities performed."""
+"""Bite Event model is used to log activities performed.
+
+Events are not written by the requests adding them. AddEvent buffers them in
+a pull queue, and FlushEvents writes the buffered events in batches from a
+task. The latest events of each project are also kept in memcache, so
+showing them does not query the datastore.
+"""
 
 __author__ = 'phu@google.com (Po Hu)'
 
+import datetime
+import json
+import logging
+import time
+import uuid
+
 # Import not at top
 #pylint: disable-msg=C6204
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.api import users
 from google.appengine.ext import db
+from google.appengine.ext import deferred
 
 DEFAULT_MAX_EVENTS = 10000
 
+# Number of events kept in the cached timeline of a project.
+DEFAULT_TIMELINE_SIZE = 50
+
+# Number of events shown by GetEventsData.
+DEFAULT_SHOWN_EVENTS = 10
+
+# Pull queue buffering the events until they are written.
+EVENTS_QUEUE = 'bite-events'
+
+# Events added within the same window are written by the same flush task.
+_FLUSH_WINDOW_SECONDS = 10
+
+# Number of buffered events leased and written per batch.
+_FLUSH_BATCH = 100
+_FLUSH_LEASE_SECONDS = 60
+
+# Caps the time a timeline may miss events, e.g. when it was cached from a
+# query racing with a flush.
+_TIMELINE_CACHE_TIME = 600
+
+_TIMELINE_CAS_RETRIES = 3
+
+_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
 class Error(Exception):
   pass
 
@@ -79,17 +119,142 @@ class BiteEvent(db.Model):
 
 def AddEvent(host=None, action='', log='', event_type='',
              name='', labels=None, project=''):
-  """Adds an event."""
+  """Adds an event.
+
+  The event is buffered and written by a later FlushEvents task, so it shows
+  up within about _FLUSH_WINDOW_SECONDS. It is validated before being
+  buffered, so an invalid event raises here as when it was written directly.
+
+  Raises:
+    db.BadValueError: If a value is invalid for the BiteEvent model.
+  """
   # Assume name is ascii.
-  labels = labels or []
+  user = users.get_current_user()
+  if host and not isinstance(host, db.Key):
+    host = host.key()
+  payload = json.dumps({
+      'key_name': uuid.uuid4().hex,
+      'host': host and str(host) or None,
+      'action': action,
+      'log': log,
+      'event_type': event_type,
+      'name': name,
+      'labels': labels or [],
+      'project': project,
+      'created_by': user and user.email() or None,
+      'created_time': datetime.datetime.now().strftime(_TIME_FORMAT)})
+  _CreateEvent(payload)
+  taskqueue.Queue(EVENTS_QUEUE).add(
+      taskqueue.Task(payload=payload, method='PULL'))
+  _ScheduleFlush()
+
+
+def _ScheduleFlush():
+  """Enqueues the flush of the current window, unless already enqueued."""
+  window = int(time.time()) / _FLUSH_WINDOW_SECONDS
+  try:
+    deferred.defer(FlushEvents, _name='flush-events-%d' % window,
+                   _countdown=_FLUSH_WINDOW_SECONDS)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def _CreateEvent(payload):
+  """Creates the BiteEvent of a buffered event."""
+  data = json.loads(payload)
+  created_by = None
+  if data['created_by']:
+    created_by = users.User(data['created_by'])
+  return BiteEvent(
+      key_name=data['key_name'],
+      host=data['host'] and db.Key(data['host']) or None,
+      action=data['action'],
+      log=data['log'],
+      event_type=data['event_type'],
+      name=data['name'],
+      labels=data['labels'],
+      project=data['project'],
+      created_by=created_by,
+      created_time=datetime.datetime.strptime(data['created_time'],
+                                              _TIME_FORMAT))
+
+
+def FlushEvents():
+  """Writes the buffered events in batches and updates the timelines.
+
+  A buffered event that can not be converted, which AddEvent should have
+  prevented, is logged and dropped rather than failing its whole batch
+  forever.
+  """
+  queue = taskqueue.Queue(EVENTS_QUEUE)
+  while True:
+    tasks = queue.lease_tasks(_FLUSH_LEASE_SECONDS, _FLUSH_BATCH)
+    if not tasks:
+      break
+    events = []
+    for task in tasks:
+      try:
+        events.append(_CreateEvent(task.payload))
+      except Exception:
+        logging.exception('Dropped the invalid buffered event %s: %s',
+                          task.name, task.payload)
+    if events:
+      db.put(events)
+    queue.delete_tasks(tasks)
+    _AddToTimelines(events)
+    logging.info('Wrote %d events.', len(events))
+    if len(tasks) < _FLUSH_BATCH:
+      break
+
+
+def _GetTimelineKey(project_name):
+  return 'event_timeline_%s' % (project_name or '')
+
+
+def _AddToTimelines(events):
+  """Adds new events to the cached timelines they belong to.
+
+  Timelines not cached are left alone; they are loaded with the new events
+  from the datastore when next read.
+  """
+  by_timeline = {'': events}
+  for event in events:
+    if event.project:
+      by_timeline.setdefault(event.project, []).append(event)
+
+  client = memcache.Client()
+  for project_name, new_events in by_timeline.iteritems():
+    key = _GetTimelineKey(project_name)
+    for _ in range(_TIMELINE_CAS_RETRIES):
+      timeline = client.gets(key)
+      if timeline is None:
+        break
+      known = set([event.key() for event in timeline])
+      timeline = [event for event in new_events
+                  if event.key() not in known] + timeline
+      timeline.sort(key=lambda event: event.created_time, reverse=True)
+      if client.cas(key, timeline[:DEFAULT_TIMELINE_SIZE],
+                    _TIMELINE_CACHE_TIME):
+        break
+    else:
+      client.delete(key)
+
+
+def GetTimeline(project_name=''):
+  """Gets the latest events of a project, or of all projects, newest first.
+
+  Args:
+    project_name: The project name, or '' for all projects.
 
-  def Add():
-    event = BiteEvent(host=host, action=action, log=log,
-                      event_type=event_type,
-                      name=name, labels=labels,
-                      project=project)
-    event.put()
-  return db.run_in_transaction(Add)
+  Returns:
+    A list of up to DEFAULT_TIMELINE_SIZE BiteEvent objects.
+  """
+  key = _GetTimelineKey(project_name)
+  timeline = memcache.get(key)
+  if timeline is None:
+    timeline = GetAllEvents(DEFAULT_TIMELINE_SIZE, project_name)
+    memcache.add(key, timeline, _TIMELINE_CACHE_TIME)
+  return timeline
 
 
 def GetAllEvents(limit=DEFAULT_MAX_EVENTS, project_name=''):
@@ -103,7 +268,7 @@ def GetAllEvents(limit=DEFAULT_MAX_EVENTS, project_name=''):
 def GetEventsData(get_event_func, project_name):
   """Gets events data."""
   events_data = []
-  events = GetAllEvents(10, project_name)
+  events = GetTimeline(project_name)[:DEFAULT_SHOWN_EVENTS]
   for event in events:
     temp_data = get_event_func(event)
     if temp_data:
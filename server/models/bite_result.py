@@ -24,8 +24,31 @@ import logging
 import random
 
 from google.appengine.ext import db
+from google.appengine.ext import deferred
 from models import bite_event
 from models import bite_run
+from models import bite_suite
+from models import entity_loader
+from models import test_duration
+from utils import lru_cache
+
+
+# Lease of an assigned result, used when the suite sets no default timeout.
+DEFAULT_LEASE_MINUTES = 60
+
+# Number of expired results reclaimed per task.
+DEFAULT_RECLAIM_BATCH = 100
+
+# Instance local cache of the lease minutes by suite key, so fetching a result
+# does not read its suite. Suites rarely change their timeout, and a change
+# applies to the fetches of each instance once the entry expires.
+_MAX_CACHED_LEASES = 500
+_LEASE_CACHE_TTL = 300
+_lease_minutes = lru_cache.LruCache(_MAX_CACHED_LEASES, ttl=_LEASE_CACHE_TTL)
+
+# Number of the longest queued results a fetch picks from, so concurrent
+# executors rarely try to claim the same one.
+DEFAULT_LONGEST_CANDIDATES = 5
 
 
 class Error(Exception):
@@ -66,6 +89,12 @@ class BiteResult(db.Model):
   project_name = db.StringProperty(required=False)
   platform = db.StringProperty(required=False)
   chrome_version = db.StringProperty(required=False)
+  # Set while the result is assigned; past it, the executor is presumed lost
+  # and the result is reclaimed, see ReclaimExpiredResults.
+  lease_expiry = db.DateTimeProperty(required=False)
+  # Estimated seconds the test takes, from its duration history; the
+  # longest queued results are handed out first.
+  expected_duration = db.FloatProperty(required=False)
 
 
 def GetResult(run_key, test_id='', test_name=''):
@@ -100,11 +129,32 @@ def GetResultsOfRunSlice(run_slice_key):
   return BiteResult.all(keys_only=True).ancestor(run_slice_key)
 
 
-def UpdateStatusAfterFetched(result):
+def GetLeaseMinutes(suite):
+  """Gets how long an executor may hold a result of the given suite."""
+  if suite.default_timeout and (suite.default_timeout <
+                                bite_suite.DEFAULT_SUITE_TIMEOUT):
+    return suite.default_timeout
+  return DEFAULT_LEASE_MINUTES
+
+
+def _GetRunLeaseMinutes(run):
+  """Gets the lease minutes of the results of a run, cached by suite."""
+  suite_key = bite_run.BiteRun.suite.get_value_for_datastore(run)
+  found, lease_minutes = _lease_minutes.Get(suite_key)
+  if not found:
+    lease_minutes = GetLeaseMinutes(run.suite)
+    _lease_minutes.Put(suite_key, lease_minutes)
+  return lease_minutes
+
+
+def UpdateStatusAfterFetched(result, lease_minutes=DEFAULT_LEASE_MINUTES):
   """Updates the result's status."""
   result = BiteResult.get(result.key())
   if result.status == 'queued':
     result.status = 'assigned'
+    result.last_picked_time = datetime.datetime.now()
+    result.lease_expiry = (result.last_picked_time +
+                           datetime.timedelta(minutes=lease_minutes))
     result.put()
     result.parent().queued_number -= 1
     result.parent().put()
@@ -115,6 +165,54 @@ def UpdateStatusAfterFetched(result):
     return False
 
 
+def GetLongestQueuedJob(run):
+  """Gets one of the queued jobs of a run expected to take the longest.
+
+  Handing out the longest tests first keeps them from being picked last and
+  extending the run.
+
+  Args:
+    run: The BiteRun.
+
+  Returns:
+    The claimed BiteResult, or '' if none could be claimed. Queued results
+    whose expected duration is None sort after all the others, so they are
+    handed out once no result with a duration is left; results stored
+    before the property existed are not indexed and only handed out by
+    GetRandomQueuedJob.
+  """
+  candidates = (BiteResult.all().filter('run =', run)
+                .filter('status =', 'queued')
+                .order('-expected_duration')
+                .fetch(DEFAULT_LONGEST_CANDIDATES))
+  random.shuffle(candidates)
+  for result in candidates:
+    if _ClaimQueuedJob(run, result):
+      return result
+  return ''
+
+
+def _ClaimQueuedJob(run, result):
+  """Assigns a queued result and updates the run counters.
+
+  Args:
+    run: The BiteRun of the result.
+    result: The BiteResult to claim.
+
+  Returns:
+    Whether the result was claimed.
+  """
+  success = db.run_in_transaction(UpdateStatusAfterFetched, result,
+                                  _GetRunLeaseMinutes(run))
+  logging.info('The final result is:' + str(success))
+  if success:
+    if result.parent().queued_number == 0:
+      run.queued_number -= result.parent().tests_number
+      # TODO(phu): Need to run_in_transaction.
+      run.put()
+  return success
+
+
 def GetRandomQueuedJob(run):
   """Gets a random queued job given a run."""
   rand_num = random.random()
@@ -129,26 +227,52 @@ def GetRandomQueuedJob(run):
             'random <', rand_num).get()
   if result:
     logging.info('Found a valid result')
-    success = db.run_in_transaction(UpdateStatusAfterFetched, result)
-    logging.info('The final result is:' + str(success))
-    if success:
-      if result.parent().queued_number == 0:
-        run.queued_number -= result.parent().tests_number
-        # TODO(phu): Need to run_in_transaction.
-        run.put()
+    if _ClaimQueuedJob(run, result):
       return result
   return ''
 
 
 def UpdateResult(result_id, parent_key_str, status, screenshot='',
                  log='', finished_time='', executor_ip='',
-                 project_name='', platform='', chrome_version=''):
-  """Updates the result and run slice info in a transaction."""
+                 project_name='', platform='', chrome_version='',
+                 attempt=None):
+  """Updates the result and run slice info in a transaction.
+
+  Only the executor holding the current lease of the result may report it.
+  A late report for a result that was reclaimed meanwhile (re-queued,
+  failed or assigned again) is ignored, so it is never counted twice.
+
+  Args:
+    result_id: The id of the result.
+    parent_key_str: The key of its run slice.
+    status: The reported status.
+    screenshot: The screenshot data url.
+    log: The execution log.
+    finished_time: When the test finished, defaults to now.
+    executor_ip: The IP of the executor.
+    project_name: The project name.
+    platform: The platform the test ran on.
+    chrome_version: The chrome version the test ran on.
+    attempt: The attempt handed out with the result, see
+        GetCurrentAttempt; older executors do not send it, so None only
+        checks the result is still assigned.
+
+  Returns:
+    The updated BiteResult, or None if the report was stale.
+  """
   result = db.run_in_transaction(
       _UpdateResult, result_id, parent_key_str,
       status, screenshot, log, finished_time, executor_ip,
-      project_name, platform, chrome_version)
-  run_slice = result.parent()
+      project_name, platform, chrome_version, attempt)
+  if not result:
+    logging.info('Ignored a stale report of the result %s.', result_id)
+    return None
+  _CompleteRunIfDone(result.parent())
+  return result
+
+
+def _CompleteRunIfDone(run_slice):
+  """Completes the run once all the results of the slice are finished."""
   run = run_slice.run
   if (run_slice.passed_number + run_slice.failed_number ==
       run_slice.tests_number):
@@ -159,19 +283,33 @@ def UpdateResult(result_id, parent_key_str, status, screenshot='',
     run.put()
     bite_event.AddEvent(run, action='complete', event_type='run',
                         name=run.name, labels=run.labels,
-                        project=run.suite.parent().name)
-  return result
+                        project=bite_suite.GetProjectName(run.suite))
+
+
+def GetCurrentAttempt(result):
+  """Gets the token of the current lease of a result.
+
+  Re-queuing an expired result increments retried_times, so it tells the
+  executor holding the current lease from those whose lease expired.
+  """
+  return result.retried_times or 0
 
 
 def _UpdateResult(result_id, parent_key_str, status, screenshot='',
                   log='', finished_time='', executor_ip='',
-                  project_name='', platform='', chrome_version=''):
-  """Updates the result after it's executed."""
+                  project_name='', platform='', chrome_version='',
+                  attempt=None):
+  """Updates the result after it's executed, unless the report is stale."""
   parent_key = None
   if parent_key_str:
     parent_key = db.Key(str(parent_key_str))
   result = BiteResult.get_by_id(result_id, parent_key)
+  if not result or result.status != 'assigned':
+    return None
+  if attempt is not None and int(attempt) != GetCurrentAttempt(result):
+    return None
   result.status = status
+  result.lease_expiry = None
   result.screenshot = screenshot
   result.log = log
   if not finished_time:
@@ -182,6 +320,14 @@ def _UpdateResult(result_id, parent_key_str, status, screenshot='',
   result.platform = platform
   result.chrome_version = chrome_version
   result.put()
+  if status in ('passed', 'failed') and result.last_picked_time:
+    # Recorded from a task enqueued with the update, so that contention on
+    # the durations of the test neither fails nor repeats the update.
+    elapsed = result.finished_time - result.last_picked_time
+    deferred.defer(test_duration.AddDuration, result.test_id,
+                   elapsed.days * 86400 + elapsed.seconds +
+                   elapsed.microseconds / 1000000.0,
+                   _queue='test-durations', _transactional=True)
   if status == 'passed':
     result.parent().passed_number += 1
   elif status == 'failed':
@@ -222,3 +368,96 @@ def GetResultTable(project_name, platform, chrome_from, chrome_to):
                     'resultKey': str(entity.key())})
   return results
 
+
+def ReclaimExpiredResults(now=None, cursor=None):
+  """Reclaims one batch of the assigned results whose lease expired.
+
+  Expired results are re-queued until they were retried the suite's
+  retry_times, then they are failed. Only assigned results have a lease, so
+  the lease_expiry index alone finds them. A task is chained for the next
+  batch, so a backlog of expired results never holds up the caller.
+
+  Args:
+    now: The current time, defaults to now.
+    cursor: Cursor of the expired results query where this batch starts.
+
+  Returns:
+    A (requeued, failed) tuple with the number of results of this batch
+    reclaimed.
+  """
+  now = now or datetime.datetime.now()
+  requeued = failed = 0
+  q = BiteResult.all().filter('lease_expiry <=', now).order('lease_expiry')
+  if cursor:
+    q.with_cursor(cursor)
+  results = q.fetch(DEFAULT_RECLAIM_BATCH)
+  entity_loader.EntityLoader().Prefetch(results, 'run.suite')
+  for result in results:
+    retry_times = result.run.suite.retry_times or 0
+    try:
+      outcome = db.run_in_transaction_options(
+          db.create_transaction_options(xg=True),
+          _ReclaimResult, result.key(), now, retry_times)
+    except db.TransactionFailedError:
+      logging.warning('Failed to reclaim the result %s.', result.key())
+      continue
+    if outcome == 'queued':
+      requeued += 1
+    elif outcome == 'failed':
+      failed += 1
+      _CompleteRunIfDone(bite_run.BiteRunSlice.get(result.parent_key()))
+  logging.info('Re-queued %d and failed %d expired results.',
+               requeued, failed)
+
+  if len(results) == DEFAULT_RECLAIM_BATCH:
+    deferred.defer(ReclaimExpiredResults, now, q.cursor(),
+                   _queue='reclaim-results')
+  return requeued, failed
+
+
+def _ReclaimResult(result_key, now, retry_times):
+  """Re-queues or fails an expired result, updating the counters.
+
+  A run slice with no queued result is subtracted from the run's queued
+  number (see GetRandomQueuedJob), so re-queuing into such a slice adds it
+  back.
+
+  Args:
+    result_key: The key of the result.
+    now: The current time.
+    retry_times: How many times the suite retries a result.
+
+  Returns:
+    'queued' or 'failed' depending on what was done, or None if the result
+    was finished or renewed meanwhile.
+  """
+  result = BiteResult.get(result_key)
+  if not result or not result.lease_expiry or result.lease_expiry > now:
+    return None
+  if result.status != 'assigned':
+    result.lease_expiry = None
+    result.put()
+    return None
+
+  run_slice = result.parent()
+  result.lease_expiry = None
+  if result.retried_times < retry_times:
+    result.status = 'queued'
+    result.retried_times += 1
+    result.random = random.random()
+    if not run_slice.queued_number:
+      run = run_slice.run
+      run.queued_number += run_slice.tests_number
+      run.put()
+    run_slice.queued_number += 1
+    outcome = 'queued'
+  else:
+    result.status = 'failed'
+    result.log = ('The executor did not report the result before its '
+                  'lease expired.')
+    result.finished_time = now
+    run_slice.failed_number += 1
+    outcome = 'failed'
+  result.put()
+  run_slice.put()
+  return outcome
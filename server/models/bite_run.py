@@ -26,9 +26,14 @@ import logging
 from google.appengine.ext import db
 from models import bite_event
 from models import bite_suite
+from models import entity_loader
 from utils import basic_util
 
 
+# Number of target versions remembered per scheduled job.
+_MAX_TARGET_URL_VERSIONS = 10
+
+
 class Error(Exception):
   pass
 
@@ -60,12 +65,23 @@ class BiteRunTemplate(db.Model):
 
 
 class BiteScheduledJob(db.Model):
-  """Contains scheduled jobs info."""
+  """Contains scheduled jobs info.
+
+  The scheduler only reads the jobs whose next_run_time is due, and stores
+  the interval parsed from the watchdog setting so it is not parsed per tick.
+  last_kickoff is the idempotency key of the latest started run, see
+  ClaimScheduledRun. For suites with a latest version URL,
+  target_url_versions lists the versions runs were started for, most recent
+  last.
+  """
   run_template = db.ReferenceProperty(BiteRunTemplate, required=True)
   suite = db.StringProperty(required=False)
   project = db.StringProperty(required=False)
   watchdog_last_time = db.DateTimeProperty()
   target_url_versions = db.StringListProperty()
+  interval = db.IntegerProperty(required=False, indexed=False)
+  next_run_time = db.DateTimeProperty(required=False)
+  last_kickoff = db.StringProperty(required=False, indexed=False)
 
 
 class BiteRun(db.Model):
@@ -112,22 +128,25 @@ def AddScheduledJob(run_template_key_str, interval):
   run_template = BiteRunTemplate.get(db.Key(str(run_template_key_str)))
   suite = run_template.suite
   if not interval:
-    interval = ParseWatchdogSetting(run_template.watchdog_setting)
+    interval = bite_suite.ParseWatchdogSetting(run_template.watchdog_setting)
   for obj in run_template.bitescheduledjob_set:
     obj.delete()
   # add scheduled job
   if int(interval) > 0:
+    now = datetime.datetime.now()
     scheduled_job = BiteScheduledJob(
-        watchdog_last_time=datetime.datetime.now(),
+        watchdog_last_time=now,
         target_url_versions=[],
         run_template=run_template,
         suite=suite.name,
-        project=suite.parent().name)
+        project=bite_suite.GetProjectName(suite),
+        interval=int(interval),
+        next_run_time=now + datetime.timedelta(minutes=int(interval)))
     scheduled_job.put()
     bite_event.AddEvent(scheduled_job, action='schedule', event_type='schedule',
                         name=run_template.name,
                         labels=run_template.filtered_labels,
-                        project=suite.parent().name)
+                        project=bite_suite.GetProjectName(suite))
 
 
 def UpdateScheduledJobs(jobs):
@@ -135,6 +154,146 @@ def UpdateScheduledJobs(jobs):
   db.put(jobs)
 
 
+def GetDueScheduledJobKeys(now, limit, cursor=None):
+  """Gets the keys of the scheduled jobs due at the given time.
+
+  Args:
+    now: The current time.
+    limit: Maximum number of keys to return.
+    cursor: Cursor returned by the previous call, if any.
+
+  Returns:
+    A (keys, cursor) tuple; the jobs due the earliest come first.
+  """
+  q = BiteScheduledJob.all(keys_only=True)
+  q.filter('next_run_time <=', now)
+  q.order('next_run_time')
+  if cursor:
+    q.with_cursor(cursor)
+  return q.fetch(limit), q.cursor()
+
+
+def GetScheduledJobKeys(limit, cursor=None):
+  """Gets the keys of all the scheduled jobs, due or not.
+
+  The jobs are read in key order, so advancing their next run time while
+  paging neither skips nor repeats any of them.
+
+  Args:
+    limit: Maximum number of keys to return.
+    cursor: Cursor returned by the previous call, if any.
+
+  Returns:
+    A (keys, cursor) tuple.
+  """
+  q = BiteScheduledJob.all(keys_only=True)
+  q.order('__key__')
+  if cursor:
+    q.with_cursor(cursor)
+  return q.fetch(limit), q.cursor()
+
+
+def GetNextRunTime(next_run_time, interval, now):
+  """Gets the time a job runs next after being kicked off.
+
+  Ticks stay aligned on the schedule, but the ticks missed while the
+  scheduler was late are skipped rather than run back to back.
+
+  Args:
+    next_run_time: The time the job was due.
+    interval: The interval of the job in minutes.
+    now: The current time.
+
+  Returns:
+    The datetime of the next run.
+  """
+  delta = datetime.timedelta(minutes=interval)
+  next_run_time = (next_run_time or now) + delta
+  if next_run_time <= now:
+    next_run_time = now + delta
+  return next_run_time
+
+
+def GetKickoffKey(job_key, run_time):
+  """Gets the idempotency key of the run of a job due at run_time."""
+  return '%s_%s' % (job_key.id_or_name(), run_time.isoformat())
+
+
+def GetLastTargetVersion(job):
+  """Gets the latest version a run of the job was started for, if any."""
+  if job.target_url_versions:
+    return job.target_url_versions[-1]
+  return None
+
+
+def ClaimScheduledRun(job_key, kickoff_key, version=None):
+  """Records that the run with the given idempotency key is being started.
+
+  Task retries call this again with the same key, so each run is started at
+  most once; ReleaseScheduledRun undoes the claim if the start fails.
+
+  Args:
+    job_key: Key of the BiteScheduledJob.
+    kickoff_key: Idempotency key of the run, see GetKickoffKey.
+    version: The target version the run is for, if the suite has a latest
+        version URL.
+
+  Returns:
+    The job if the run was claimed, or None if the job is gone, the run was
+    started already or a run was already started for the version.
+  """
+
+  def _Txn():
+    job = BiteScheduledJob.get(job_key)
+    if not job or job.last_kickoff == kickoff_key:
+      return None
+    if version:
+      if GetLastTargetVersion(job) == version:
+        return None
+      job.target_url_versions.append(version)
+      del job.target_url_versions[:-_MAX_TARGET_URL_VERSIONS]
+    job.last_kickoff = kickoff_key
+    job.watchdog_last_time = datetime.datetime.now()
+    job.put()
+    return job
+  return db.run_in_transaction(_Txn)
+
+
+def ReleaseScheduledRun(job_key, kickoff_key, version=None):
+  """Forgets a claimed run that failed to start, so it can be retried."""
+
+  def _Txn():
+    job = BiteScheduledJob.get(job_key)
+    if job and job.last_kickoff == kickoff_key:
+      job.last_kickoff = None
+      if version and GetLastTargetVersion(job) == version:
+        job.target_url_versions.pop()
+      job.put()
+  db.run_in_transaction(_Txn)
+
+
+def BackfillScheduledJobs():
+  """Sets the schedule of the jobs stored before it was indexed.
+
+  Such jobs lack next_run_time, so they are never due until backfilled.
+  """
+  jobs = [job for job in BiteScheduledJob.all() if not job.next_run_time]
+  run_templates = db.get(
+      [BiteScheduledJob.run_template.get_value_for_datastore(job)
+       for job in jobs])
+  now = datetime.datetime.now()
+  for job, run_template in zip(jobs, run_templates):
+    if not run_template:
+      continue
+    job.interval = bite_suite.ParseWatchdogSetting(
+        run_template.watchdog_setting)
+    if job.interval:
+      job.next_run_time = ((job.watchdog_last_time or now) +
+                           datetime.timedelta(minutes=job.interval))
+  db.put(jobs)
+  logging.info('Backfilled the schedule of %d jobs.', len(jobs))
+
+
 def GetRunTemplatesWithSuite(suite):
   """Gets the run templates associated with a suite."""
   return BiteRunTemplate.all().filter('suite =', suite)
@@ -178,7 +337,7 @@ def AddRunTemplate(name, suite_key_str, description='', run_once=True,
   bite_event.AddEvent(run, action=bite_event.EventActions.CREATE,
                       event_type=bite_event.EventTypes.RUN_TEMPLATE,
                       name=run.name, labels=run.filtered_labels,
-                      project=run.suite.parent().name)
+                      project=bite_suite.GetProjectName(run.suite))
   return run
 
 
@@ -211,14 +370,19 @@ def UpdateRunTemplate(name, suite_key_str, run_template_key_str,
   bite_event.AddEvent(run, action=bite_event.EventActions.MODIFY,
                       event_type=bite_event.EventTypes.RUN_TEMPLATE,
                       name=run.name, labels=run.filtered_labels,
-                      project=run.suite.parent().name)
+                      project=bite_suite.GetProjectName(run.suite))
   return run
 
 
 def AddRun(name, suite_key, start_time, test_info_list,
            tokens='', labels=None, dimensions=None, start_url='',
-           run_template_key_str=''):
-  """Adds a run."""
+           run_template_key_str='', kickoff_key=None):
+  """Adds a run.
+
+  The run is keyed by its name and start time, or by its name and
+  kickoff_key if given, in which case adding it again returns the run
+  already added.
+  """
   suite = bite_suite.BiteSuite.get(suite_key)
   if not name:
     if not suite_key:
@@ -229,7 +393,7 @@ def AddRun(name, suite_key, start_time, test_info_list,
   run_key = db.Key.from_path(bite_suite.BiteSuite.kind(),
                              suite.key().name(),
                              'BiteRun',
-                             name + '_' + str(start_time))
+                             name + '_' + (kickoff_key or str(start_time)))
   tests_len = len(test_info_list)
   if not labels:
     labels = suite.labels
@@ -253,7 +417,7 @@ def AddRun(name, suite_key, start_time, test_info_list,
                               run_template=run_template)
   bite_event.AddEvent(run, action='create', event_type='run',
                       name=run.name, labels=run.labels,
-                      project=run.suite.parent().name)
+                      project=bite_suite.GetProjectName(run.suite))
   return run
 
 
@@ -331,6 +495,17 @@ def GetLatestRunsThroughSuite(status):
   return latest_runs
 
 
+def GetRunTemplatesWithSuites(suites):
+  """Gets the run templates associated with any of the suites."""
+  suite_keys = [suite.key() for suite in suites]
+  run_templates = []
+  # IN filters take at most 30 values.
+  for i in range(0, len(suite_keys), 30):
+    run_templates.extend(BiteRunTemplate.all().filter(
+        'suite IN', suite_keys[i:i + 30]))
+  return run_templates
+
+
 def GetLatestRunsThroughTemplate(status, project_name):
   """Gets the latest runs through run template info."""
   projects = None
@@ -340,13 +515,11 @@ def GetLatestRunsThroughTemplate(status, project_name):
   suites = bite_suite.LoadAllSuitesOfProjects(projects)
   latest_runs = []
   empty_templates = []
-  for suite in suites:
-    run_templates = GetRunTemplatesWithSuite(suite)
-    for run_template in run_templates:
-      runs = GetRunsOfTemplate(run_template, True, 1, status)
-      if not runs:
-        empty_templates.append(run_template)
-      latest_runs.extend(runs)
+  for run_template in GetRunTemplatesWithSuites(suites):
+    runs = GetRunsOfTemplate(run_template, True, 1, status)
+    if not runs:
+      empty_templates.append(run_template)
+    latest_runs.extend(runs)
   return latest_runs, empty_templates
 
 
@@ -394,6 +567,7 @@ def GetEmptyTemplateData(templates):
 def GetRunsData(runs):
   """Gets all the relevant runs info."""
   runs_data = []
+  entity_loader.EntityLoader().Prefetch(runs, 'suite')
   for run in runs:
     state = 'running'
     if run.end_time:
@@ -411,7 +585,7 @@ def GetRunsData(runs):
     failed_value = '%s (%d)' % (
         basic_util.GetPercentStr(failed_num, total_num),
         failed_num)
-    labels = [run.suite.parent().name]
+    labels = [bite_suite.GetProjectName(run.suite)]
     labels.extend(run.labels)
     start_time_pst = basic_util.ConvertFromUtcToPst(run.start_time)
     start_time = basic_util.CreateStartStr(start_time_pst)
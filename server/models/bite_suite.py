@@ -24,6 +24,7 @@ __author__ = 'phu@google.com (Po Hu)'
 import datetime
 import logging
 
+from google.appengine.api import memcache
 from google.appengine.ext import db
 
 from models import bite_event
@@ -34,6 +35,11 @@ from utils import basic_util
 DEFAULT_SUITE_TIMEOUT = 9999
 DEFAULT_AUTO_DELETE_DEADLINE = 9999
 
+# The suites of each project are cached as a catalog, dropped whenever a
+# suite of the project is written.
+_CATALOG_KEY_PREFIX = 'suite_catalog_'
+_CATALOG_CACHE_TIME = 3600
+
 
 class Error(Exception):
   pass
@@ -102,22 +108,83 @@ def LoadSuite(name, project_name, suite_key_str=''):
   return BiteSuite.get(suite_key)
 
 
+def GetProjectName(suite):
+  """Gets the project name of a suite without loading the project.
+
+  Projects are keyed by their name, so it is the name of the parent key.
+  """
+  return suite.parent_key().name()
+
+
+def InvalidateCatalog(project_name):
+  """Drops the cached suites catalog of a project."""
+  memcache.delete(_CATALOG_KEY_PREFIX + project_name)
+
+
+def _CacheCatalogs(catalogs):
+  """Caches suites catalogs, skipping those over the memcache size limit.
+
+  Args:
+    catalogs: A dict of the suites lists keyed by project name.
+  """
+  try:
+    memcache.set_multi(catalogs, time=_CATALOG_CACHE_TIME,
+                       key_prefix=_CATALOG_KEY_PREFIX)
+    return
+  except ValueError:
+    # Raised for the whole batch when any value is over the size limit.
+    pass
+  for project_name, suites in catalogs.iteritems():
+    try:
+      memcache.set(_CATALOG_KEY_PREFIX + project_name, suites,
+                   _CATALOG_CACHE_TIME)
+    except ValueError:
+      logging.warning('Not caching the catalog of the %d suites of %s.',
+                      len(suites), project_name)
+
+
 def LoadAllSuitesOfProjects(project_names=None):
-  """Loads all the suites of the given projects."""
+  """Loads all the suites of the given projects.
+
+  The suites come from the cached catalog of each project. The catalogs not
+  cached are loaded with one ancestor query per project, all of them run in
+  parallel, and cached.
+
+  Args:
+    project_names: The names of the projects, all projects if None.
+
+  Returns:
+    A list of BiteSuite objects, grouped by project.
+  """
   if project_names is None:
-    projects = bite_project.GetAllProjects()
-    project_names = [project.name for project in projects]
+    project_names = [key.name() for key
+                     in bite_project.BiteProject.all(keys_only=True)]
+  project_names = [str(name) for name in project_names]
+  catalogs = memcache.get_multi(project_names, key_prefix=_CATALOG_KEY_PREFIX)
+
+  # Query.run starts fetching in the background, so the queries overlap.
+  pending = {}
+  for project_name in project_names:
+    if project_name not in catalogs and project_name not in pending:
+      project_key = db.Key.from_path(bite_project.BiteProject.kind(),
+                                     project_name)
+      pending[project_name] = BiteSuite.all().ancestor(project_key).run(
+          batch_size=1000)
+  loaded = dict((project_name, list(suites))
+                for project_name, suites in pending.iteritems())
+  if loaded:
+    _CacheCatalogs(loaded)
+  catalogs.update(loaded)
+
   suites = []
   for project_name in project_names:
-    suites.extend(LoadAllSuitesOfProject(project_name))
+    suites.extend(catalogs[project_name])
   return suites
 
 
 def LoadAllSuitesOfProject(project_name):
   """Loads all of the suites of a project."""
-  project_key = db.Key.from_path(bite_project.BiteProject.kind(),
-                                 project_name)
-  return BiteSuite.all().ancestor(project_key)
+  return LoadAllSuitesOfProjects([project_name])
 
 
 def GetSuiteWatchdogStr(watchdog_setting, interval):
@@ -256,9 +323,10 @@ def UpdateSuite(name, project_name, description='', labels=None, configs='',
   suite.test_source = test_source
   suite.test_src_dict = test_src_dict
   suite.put()
+  InvalidateCatalog(project_name)
   bite_event.AddEvent(suite, action='modify', event_type='set',
                       name=suite.name, labels=suite.labels,
-                      project=suite.parent().name)
+                      project=project_name)
   return suite
 
 
@@ -297,8 +365,9 @@ def AddSuite(name, project_name, description='', labels=None, configs='',
                                   tests_number=tests_num,
                                   test_source=test_source,
                                   test_src_dict=test_src_dict)
+  InvalidateCatalog(project_name)
   bite_event.AddEvent(suite, action='create', event_type='set',
                       name=suite.name, labels=suite.labels,
-                      project=suite.parent().name)
+                      project=project_name)
   return suite
 
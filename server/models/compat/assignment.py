@@ -21,19 +21,34 @@ to individual users (a.k.a. testers).
 __author__ = 'alexto@google.com (Alexis O. Torres)'
 
 
+import logging
+import random
+
 from datetime import datetime
 
 from google.appengine.api import memcache
 from google.appengine.ext import db
+from google.appengine.ext import deferred
 
 from models.compat import browser
 from models.compat import result as compat_result
 from models.compat import run as compat_run
 from models.compat import run_site_map as compat_run_site_map
 from models.compat import run_tester_map
+from models.compat import stats as compat_stats
 from models.compat import tests
 
 
+# Number of tests read from the head of a ready queue when assigning. Claims
+# are spread randomly over them so concurrent testers rarely collide.
+_CLAIM_CANDIDATES = 5
+
+# Number of times a claim is tried while its test remains available. The
+# claim transaction also writes a stats counter shard, so it can fail on
+# contention with other claims of the same chrome version.
+_CLAIM_ATTEMPTS = 3
+
+
 class Assignment(db.Model):
   """Tracks assignments of sites to users."""
   run_site_map = db.ReferenceProperty(
@@ -93,42 +108,126 @@ def GetOrAssignTest(user, browser_version):
 
 
 def AssignTest(user, browser_version):
-  """Assigns a mapping to the given user."""
-  tester_mappings = run_tester_map.GetMappingsForTester(user)
+  """Assigns a mapping to the given user.
+
+  Reads a few keys from the head of the ready queue of each run the user is
+  subscribed to and claims one of them, see ClaimTest.
+
+  Args:
+    user: The user to assign a test to.
+    browser_version: The BrowserVersion of the user's browser.
+
+  Returns:
+    The new Assignment, or None if no test is left in the user's runs.
+  """
+  tester_mappings = run_tester_map.GetMappingsForTester(
+      user, prefetch_ref_properties=False)
   for tester_mapping in tester_mappings:
-    run = tester_mapping.run
-    tests_remaining = GetTestsRemainingForRun(run, browser_version)
-    if tests_remaining:
-      test = tests_remaining[0]
-      key_name = GetAssignmentForTesterKeyName(user)
-      assignment = Assignment(key_name=key_name,
-                              run_site_map=test.mapping,
-                              user=user,
-                              browser_version=browser_version,
-                              test=test)
-      assignment.put()
-      tests.SetAssignment(test.key(), assignment=assignment)
-      return assignment
+    run_key = run_tester_map.RunTesterMap.run.get_value_for_datastore(
+        tester_mapping)
+    candidates = tests.GetNextTestKeys(run_key, browser_version,
+                                       limit=_CLAIM_CANDIDATES)
+    random.shuffle(candidates)
+    for test_key in candidates:
+      assignment = ClaimTest(user, browser_version, test_key)
+      if assignment:
+        return assignment
   return None
 
 
+def ClaimTest(user, browser_version, test_key):
+  """Assigns the given test to a user unless it was claimed already.
+
+  The test update, the new assignment and the stats counter are committed in
+  one transaction, so two testers can never be assigned the same test. A
+  failed transaction is tried again as long as the test is still available,
+  since it may have collided on the counter rather than on the test.
+
+  Args:
+    user: The user to assign the test to.
+    browser_version: The BrowserVersion of the user's browser.
+    test_key: Key of the test to claim.
+
+  Returns:
+    The new Assignment, the user's current one if the user already has one,
+    or None if the test is no longer available.
+  """
+  key_name = GetAssignmentForTesterKeyName(user)
+
+  def _Txn():
+    # Concurrent requests of the same user must not orphan a claimed test.
+    current = Assignment.get_by_key_name(key_name)
+    if current:
+      return current
+    test = tests.Test.get(test_key)
+    if (not test or
+        tests.Test.assignment.get_value_for_datastore(test) or
+        tests.Test.result.get_value_for_datastore(test)):
+      return None
+    assignment = Assignment(
+        key_name=key_name,
+        run_site_map=tests.Test.mapping.get_value_for_datastore(test),
+        user=user,
+        browser_version=browser_version,
+        test=test)
+    assignment.put()
+    test.assignment = assignment
+    test.put()
+    compat_stats.Increment(browser_version.chrome_version, remaining=-1)
+    return assignment
+
+  assignment = None
+  for attempt in range(_CLAIM_ATTEMPTS):
+    try:
+      assignment = db.run_in_transaction_options(
+          db.create_transaction_options(xg=True, retries=0), _Txn)
+      break
+    except db.TransactionFailedError:
+      test = tests.Test.get(test_key)
+      if (not test or
+          tests.Test.assignment.get_value_for_datastore(test) or
+          tests.Test.result.get_value_for_datastore(test)):
+        logging.info('Test %s was claimed concurrently.', test_key)
+        return None
+      logging.info('Claim %d of test %s failed on contention.',
+                   attempt + 1, test_key)
+  if assignment:
+    memcache.set(key_name, assignment)
+  return assignment
+
+
 def LogResult(user, assignment, browser_version, succeed, comment, bugs):
-  """Commits the result for the given mapping and removes the assignment."""
-  result = compat_result.AddResult(user=user,
-                                   mapping=assignment.run_site_map,
-                                   browser_version=browser_version,
-                                   succeed=succeed,
-                                   assigned=assignment.created,
-                                   first_visit=assignment.first_visit,
-                                   last_visit=assignment.last_visit,
-                                   visits=assignment.visits,
-                                   comment=comment,
-                                   bugs=bugs)
-  test_key = assignment.test.key()
-  tests.SetAssignment(test_key, assignment=None)
-  tests.SetResult(test_key, result=result)
-  # Remove assignment from the given user.
-  RemoveAssignment(assignment)
+  """Commits the result for the given mapping and removes the assignment.
+
+  The result, the test update, the stats counters and the assignment removal
+  are committed in a single cross-group transaction.
+  """
+  test_key = Assignment.test.get_value_for_datastore(assignment)
+
+  def _Txn():
+    result = compat_result.AddResult(user=user,
+                                     mapping=assignment.run_site_map,
+                                     browser_version=browser_version,
+                                     succeed=succeed,
+                                     assigned=assignment.created,
+                                     first_visit=assignment.first_visit,
+                                     last_visit=assignment.last_visit,
+                                     visits=assignment.visits,
+                                     comment=comment,
+                                     bugs=bugs)
+    test = tests.Test.get(test_key)
+    test.assignment = None
+    test.result = result
+    test.put()
+    compat_stats.Increment(browser_version.chrome_version,
+                           total=1,
+                           passed=succeed and 1 or 0,
+                           failed=not succeed and 1 or 0)
+    assignment.delete()
+    return result
+  result = db.run_in_transaction_options(
+      db.create_transaction_options(xg=True), _Txn)
+  memcache.delete(assignment.key().name())
   return result
 
 
@@ -140,22 +239,36 @@ def RemoveAssignment(assignment):
 
 
 def SkipAssignment(user, browser_version, assignment):
-  """Tries to get a new mapping for the user, if more are available."""
+  """Tries to get a new mapping for the user, if more are available.
+
+  The skipped test is released so it can be assigned again, which also makes
+  it count as remaining again.
+  """
+  test_key = Assignment.test.get_value_for_datastore(assignment)
+  tests.SetAssignment(test_key, assignment=None)
   RemoveAssignment(assignment=assignment)
   return AssignTest(user=user, browser_version=browser_version)
 
 
 def GetTestsRemainingForRun(run, browser_version):
-  """Returns a list of mappings with no corresponding results."""
+  """Returns the keys of the tests of a run with no result."""
   return tests.GetTestsRemainingFroRunAndBrowser(
       run, browser_version)
 
 
 def GetTestsRemainingForBrowser(browser_version):
-  """Returns a list of mappings with no result across all runs."""
+  """Returns the keys of the tests with no result across visible runs."""
   return tests.GetTestsRemainingForBrowser(browser_version)
 
 
+def SetRunVisibility(key_name, hidden):
+  """Sets the visibility of a run and spawns the update of its tests."""
+  run = compat_run.SetVisibility(key_name=key_name, hidden=hidden)
+  deferred.defer(tests.SetRunTestsHidden, run.key(), hidden,
+                 _queue='tests-queue')
+  return run
+
+
 def AddMapping(run, site, verification, apply_to_all_versions=False,
                browser_versions=None):
   """Adds a new relationship between the a run, site, and verification."""
@@ -199,19 +312,14 @@ def GetBrowserVersion(platform, platform_version,
   Returns:
     A BrowserVersion object.
   """
-  version = browser.GetBrowserVersion(platform=platform,
-                                      platform_version=platform_version,
-                                      webkit_version=webkit_version,
-                                      chrome_version=chrome_version,
-                                      locale=locale)
-  if not version:
-    version = browser.GetOrInsertBrowserVersion(
-        platform=platform,
-        platform_version=platform_version,
-        webkit_version=webkit_version,
-        chrome_version=chrome_version,
-        locale=locale)
-    # Create tests for this new browser version.
-    tests.AddTestsForBrowserVersion(version)
-  return version
+  # Tests are created for the new browser version by the one request that
+  # inserts it.
+  return browser.GetOrInsertBrowserVersion(
+      platform=platform,
+      platform_version=platform_version,
+      webkit_version=webkit_version,
+      chrome_version=chrome_version,
+      locale=locale,
+      on_insert=lambda version: tests.AddTestsForBrowserVersion(
+          version, transactional=True))
 
@@ -32,6 +32,8 @@ class BrowserVersion(db.Model):
   user_locale = db.StringProperty(required=True)
   created = db.DateTimeProperty(required=False, auto_now_add=True)
   created_by = db.UserProperty(required=False, auto_current_user_add=True)
+  # Set once the tests of all mappings have been created for this version.
+  tests_materialized = db.BooleanProperty(required=False, default=False)
 
 
 def GetBrowserVersionKeyName(
@@ -115,20 +117,27 @@ def GetBrowserVersion(platform, platform_version,
   browser_version = memcache.get(key_name)
   if not browser_version:
     browser_version = GetBrowserVersionByKeyName(key_name)
-    memcache.set(key_name, browser_version)
+    if browser_version:
+      memcache.set(key_name, browser_version)
   return browser_version
 
 
 def GetOrInsertBrowserVersion(platform, platform_version,
-                              webkit_version, chrome_version, locale):
+                              webkit_version, chrome_version, locale,
+                              on_insert=None):
   """Gets or inserts the BrowserVersion object for the given parameters.
 
+  The insert runs in a transaction, so when concurrent requests see the same
+  new browser version only one of them inserts it and calls on_insert.
+
   Args:
     platform: str with the name of the OS.
     platform_version:  str with the Platform version string.
     webkit_version: str with the WebKit version number.
     chrome_version: str with the Chrome version number.
     locale: str with the user agent language.
+    on_insert: Optional function called with the new BrowserVersion inside
+        the insert transaction, e.g. to enqueue a transactional task.
 
   Returns:
     A BrowserVersion object.
@@ -138,20 +147,45 @@ def GetOrInsertBrowserVersion(platform, platform_version,
                                       webkit_version,
                                       chrome_version,
                                       locale)
-  if not browser_version:
-    key_name = GetBrowserVersionKeyName(platform,
-                                        platform_version,
-                                        webkit_version,
-                                        chrome_version,
-                                        locale)
-    browser_version = BrowserVersion(
+  if browser_version:
+    return browser_version
+
+  key_name = GetBrowserVersionKeyName(platform,
+                                      platform_version,
+                                      webkit_version,
+                                      chrome_version,
+                                      locale)
+
+  def _Txn():
+    existing = BrowserVersion.get_by_key_name(key_name)
+    if existing:
+      return existing
+    created = BrowserVersion(
         key_name=key_name,
         platform=platform,
         platform_version=platform_version,
         webkit_version=webkit_version,
         chrome_version=chrome_version,
         user_locale=locale)
+    created.put()
+    if on_insert:
+      on_insert(created)
+    return created
+  browser_version = db.run_in_transaction(_Txn)
+  memcache.set(key_name, browser_version)
+  return browser_version
+
+
+def SetTestsMaterialized(key):
+  """Marks the tests of the given browser version as all created."""
+
+  def _Txn():
+    browser_version = BrowserVersion.get(key)
+    browser_version.tests_materialized = True
     browser_version.put()
+    return browser_version
+  browser_version = db.run_in_transaction(_Txn)
+  memcache.delete(key.name())
   return browser_version
 
 
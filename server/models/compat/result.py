@@ -22,6 +22,7 @@ __author__ = 'alexto@google.com (Alexis O. Torres)'
 
 from google.appengine.ext import db
 
+from models import entity_loader
 from models.compat import browser
 from models.compat import run_site_map
 
@@ -61,20 +62,9 @@ def AddResult(user, mapping, browser_version, succeed,
   return result
 
 
-def _PrefetchRefprops(entities, *props):
-  """Pre-fetches reference properties on the given list of entities."""
-  fields = [(entity, prop) for entity in entities for prop in props]
-  ref_keys = [prop.get_value_for_datastore(x) for x, prop in fields]
-  ref_entities = dict((x.key(), x) for x in db.get(set(ref_keys)))
-  for (entity, prop), ref_key in zip(fields, ref_keys):
-    prop.__set__(entity, ref_entities[ref_key])
-  return entities
-
-
 def PrefetchRefProps(entities):
   """Pre-fetches reference properties on the given list of entities."""
-  return _PrefetchRefprops(entities,
-                           Result.browser_version)
+  return entity_loader.PrefetchRefProps(entities, Result.browser_version)
 
 
 def _FetchAll(q, prefetch_ref_properties):
@@ -0,0 +1,298 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Export of compat results as CSV or newline delimited JSON.
+
+Results are read a page at a time with cursors, so an export never holds more
+than one page in memory. Exports of up to MAX_INLINE_ROWS results may be
+written straight to the response; larger ones are written to a blob by a chain
+of tasks, see StartExport.
+"""
+
+import cStringIO
+import csv
+import json
+
+from google.appengine.api import files
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+from models import entity_loader
+from models.compat import browser as compat_browser
+from models.compat import result as compat_result
+
+
+CSV = 'csv'
+NDJSON = 'ndjson'
+
+CONTENT_TYPES = {
+    CSV: 'text/csv',
+    NDJSON: 'application/x-ndjson'
+}
+
+COLUMNS = ['created', 'user', 'chrome_version', 'platform',
+           'platform_version', 'webkit_version', 'locale', 'run', 'url',
+           'succeed', 'bugs', 'comment']
+
+DEFAULT_PAGE_SIZE = 500
+
+# Most results written straight to a response, see CountResults.
+MAX_INLINE_ROWS = 5000
+
+# Pages written by each background export task.
+_PAGES_PER_TASK = 20
+
+
+class Status:
+  """Background export states."""
+  RUNNING = 'running'
+  DONE = 'done'
+
+
+class ResultsFilter(object):
+  """Filters applied to an export.
+
+  Attributes:
+    chrome_version: Only export results for this chrome version.
+    platform: Only export results for this platform.
+    since: Only export results created at or after this datetime.
+    until: Only export results created before this datetime.
+  """
+
+  def __init__(self, chrome_version=None, platform=None, since=None,
+               until=None):
+    self.chrome_version = chrome_version
+    self.platform = platform
+    self.since = since
+    self.until = until
+
+  def GetBrowserVersionKeys(self):
+    """Gets the keys of the browser versions to export.
+
+    Returns:
+      A list of BrowserVersion keys, or [None] when the results of all
+      browser versions are exported.
+    """
+    if not self.chrome_version and not self.platform:
+      return [None]
+    q = compat_browser.BrowserVersion.all(keys_only=True)
+    if self.chrome_version:
+      q.filter('chrome_version =', self.chrome_version)
+    if self.platform:
+      q.filter('platform =', self.platform)
+    return list(q)
+
+  def GetQuery(self, browser_version_key, keys_only=False):
+    """Gets the results query for one browser version (or all if None)."""
+    q = compat_result.Result.all(keys_only=keys_only)
+    if browser_version_key:
+      q.filter('browser_version =', browser_version_key)
+    if self.since:
+      q.filter('created >=', self.since)
+    if self.until:
+      q.filter('created <', self.until)
+    return q.order('created')
+
+
+class ResultExport(db.Model):
+  """Tracks a background export.
+
+  The position (index in browser_version_keys) and cursor record where the
+  next task resumes.
+  """
+  format = db.StringProperty(required=True, choices=CONTENT_TYPES.keys())
+  chrome_version = db.StringProperty(required=False)
+  platform = db.StringProperty(required=False)
+  since = db.DateTimeProperty(required=False)
+  until = db.DateTimeProperty(required=False)
+  status = db.StringProperty(required=True, default=Status.RUNNING)
+  file_name = db.StringProperty(required=False, indexed=False)
+  blob_key = db.StringProperty(required=False)
+  rows = db.IntegerProperty(required=True, default=0)
+  position = db.IntegerProperty(required=True, default=0)
+  cursor = db.TextProperty(required=False)
+  created = db.DateTimeProperty(required=False, auto_now_add=True)
+  created_by = db.UserProperty(required=False, auto_current_user_add=True)
+
+  def GetFilter(self):
+    return ResultsFilter(chrome_version=self.chrome_version,
+                         platform=self.platform,
+                         since=self.since,
+                         until=self.until)
+
+
+def IterPages(results_filter, position=0, cursor=None,
+              page_size=DEFAULT_PAGE_SIZE):
+  """Iterates over the pages of results matching a filter.
+
+  Args:
+    results_filter: The ResultsFilter to apply.
+    position: Index of the browser version to start from.
+    cursor: Cursor to resume from within that browser version.
+    page_size: Number of results per page.
+
+  Yields:
+    (results, position, cursor) tuples, where position and cursor point past
+    the yielded page.
+  """
+  browser_version_keys = results_filter.GetBrowserVersionKeys()
+  while position < len(browser_version_keys):
+    q = results_filter.GetQuery(browser_version_keys[position])
+    if cursor:
+      q.with_cursor(cursor)
+    results = q.fetch(page_size)
+    cursor = q.cursor()
+    if len(results) < page_size:
+      position += 1
+      cursor = None
+    if results:
+      yield results, position, cursor
+
+
+def CountResults(results_filter, limit):
+  """Counts the results matching a filter, stopping at a limit.
+
+  Args:
+    results_filter: The ResultsFilter to apply.
+    limit: Most results to count.
+
+  Returns:
+    The number of matching results, or limit if there are more.
+  """
+  count = 0
+  for browser_version_key in results_filter.GetBrowserVersionKeys():
+    q = results_filter.GetQuery(browser_version_key, keys_only=True)
+    count += q.count(limit - count)
+    if count >= limit:
+      break
+  return count
+
+
+def FormatHeader(export_format):
+  """Gets the text written before the first page."""
+  if export_format == CSV:
+    return _FormatCsv([COLUMNS])
+  return ''
+
+
+def FormatPage(results, export_format):
+  """Formats a page of results.
+
+  Args:
+    results: A list of Result objects.
+    export_format: CSV or NDJSON.
+
+  Returns:
+    The formatted rows as a str.
+  """
+  entity_loader.EntityLoader().Prefetch(results, 'browser_version',
+                                        'mapping.run', 'mapping.site')
+  rows = [_GetRow(result) for result in results]
+  if export_format == CSV:
+    return _FormatCsv([[row[column] for column in COLUMNS] for row in rows])
+  return ''.join([json.dumps(row) + '\n' for row in rows])
+
+
+def _GetRow(result):
+  browser = result.browser_version
+  run_name = ''
+  url = ''
+  if compat_result.Result.mapping.get_value_for_datastore(result):
+    run_name = result.mapping.run.name
+    url = result.mapping.site.url
+  return {'created': result.created.isoformat(),
+          'user': result.user.email(),
+          'chrome_version': browser.chrome_version,
+          'platform': browser.platform,
+          'platform_version': browser.platform_version,
+          'webkit_version': browser.webkit_version,
+          'locale': browser.user_locale,
+          'run': run_name,
+          'url': url,
+          'succeed': result.succeed,
+          'bugs': result.bugs,
+          'comment': result.comment}
+
+
+def _FormatCsv(rows):
+  output = cStringIO.StringIO()
+  writer = csv.writer(output)
+  for row in rows:
+    writer.writerow([unicode(value).encode('utf-8') for value in row])
+  return output.getvalue()
+
+
+def StartExport(export_format, results_filter):
+  """Starts exporting the matching results to a blob in the background.
+
+  Args:
+    export_format: CSV or NDJSON.
+    results_filter: The ResultsFilter to apply.
+
+  Returns:
+    The ResultExport tracking the job.
+  """
+  file_name = files.blobstore.create(
+      mime_type=CONTENT_TYPES[export_format],
+      _blobinfo_uploaded_filename='results.%s' % export_format)
+  with files.open(file_name, 'a') as f:
+    f.write(FormatHeader(export_format))
+  export = ResultExport(format=export_format,
+                        chrome_version=results_filter.chrome_version,
+                        platform=results_filter.platform,
+                        since=results_filter.since,
+                        until=results_filter.until,
+                        file_name=file_name)
+  export.put()
+  deferred.defer(ContinueExport, export.key().id(), _queue='export-queue')
+  return export
+
+
+def ContinueExport(export_id):
+  """Appends a few pages to a background export, then chains the next task.
+
+  Args:
+    export_id: ID of the ResultExport.
+  """
+  export = ResultExport.get_by_id(export_id)
+  if not export or export.status != Status.RUNNING:
+    return
+
+  pages = IterPages(export.GetFilter(), export.position, export.cursor)
+  done = True
+  with files.open(export.file_name, 'a') as f:
+    for index, (results, position, cursor) in enumerate(pages):
+      f.write(FormatPage(results, export.format))
+      export.rows += len(results)
+      export.position = position
+      export.cursor = cursor
+      if index + 1 == _PAGES_PER_TASK:
+        done = False
+        break
+
+  if done:
+    files.finalize(export.file_name)
+    export.blob_key = str(files.blobstore.get_blob_key(export.file_name))
+    export.status = Status.DONE
+    export.put()
+  else:
+    # The file and the export progress are not updated atomically; a retried
+    # task may repeat the rows of its pages.
+    export.put()
+    deferred.defer(ContinueExport, export_id, _queue='export-queue')
+
+
+def GetExport(export_id):
+  """Gets the ResultExport with the given ID."""
+  return ResultExport.get_by_id(int(export_id))
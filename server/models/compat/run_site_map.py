@@ -25,6 +25,7 @@ __author__ = 'alexto@google.com (Alexis O. Torres)'
 
 from google.appengine.ext import db
 
+from models import entity_loader
 from models.compat import run as compat_run
 from models.compat import site as compat_site
 from models.compat import verification as compat_verification
@@ -65,22 +66,12 @@ def GetMappingByKeyName(key_name):
   return RunSiteMap.get_by_key_name(key_name)
 
 
-def _PrefetchRefprops(entities, *props):
-  """Pre-fetches reference properties on the given list of entities."""
-  fields = [(entity, prop) for entity in entities for prop in props]
-  ref_keys = [prop.get_value_for_datastore(x) for x, prop in fields]
-  ref_entities = dict((x.key(), x) for x in db.get(set(ref_keys)))
-  for (entity, prop), ref_key in zip(fields, ref_keys):
-    prop.__set__(entity, ref_entities[ref_key])
-  return entities
-
-
 def PrefetchRefProps(entities):
   """Pre-fetches reference properties on the given list of entities."""
-  return _PrefetchRefprops(entities,
-                           RunSiteMap.run,
-                           RunSiteMap.site,
-                           RunSiteMap.verification)
+  return entity_loader.PrefetchRefProps(entities,
+                                        RunSiteMap.run,
+                                        RunSiteMap.site,
+                                        RunSiteMap.verification)
 
 
 def _FetchAll(q, prefetch_ref_properties):
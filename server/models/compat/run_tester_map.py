@@ -22,6 +22,7 @@ __author__ = 'alexto@google.com (Alexis O. Torres)'
 
 from google.appengine.api import memcache
 from google.appengine.ext import db
+from models import entity_loader
 from models.compat import run as compat_run
 
 
@@ -70,16 +71,6 @@ def GetMappingsForTesterKeyName(user):
   return 'RunTesterMap_Tester_%s' % str(user.user_id())
 
 
-def _PrefetchRefprops(entities, *props):
-  """Prefetches reference properties on the given list of entities."""
-  fields = [(entity, prop) for entity in entities for prop in props]
-  ref_keys = [prop.get_value_for_datastore(x) for x, prop in fields]
-  ref_entities = dict((x.key(), x) for x in db.get(set(ref_keys)))
-  for (entity, prop), ref_key in zip(fields, ref_keys):
-    prop.__set__(entity, ref_entities[ref_key])
-  return entities
-
-
 def GetMappingsForTester(user, prefetch_ref_properties=True):
   """Returns a list of mappings associated with the given user.."""
   cache_key = GetMappingsForTesterKeyName(user)
@@ -93,7 +84,7 @@ def GetMappingsForTester(user, prefetch_ref_properties=True):
       mappings = filter(lambda item: item is not None, mappings)
     memcache.set(cache_key, mappings)
   if prefetch_ref_properties:
-    return _PrefetchRefprops(mappings, RunTesterMap.run)
+    return entity_loader.PrefetchRefProps(mappings, RunTesterMap.run)
   else:
     return mappings
 
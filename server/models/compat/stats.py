@@ -0,0 +1,193 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Aggregated result stats per chrome version.
+
+The stats are sharded counters kept up to date by the code adding tests,
+assigning them and logging results, always within the same transaction as the
+change being counted. Reconcile recomputes them from the datastore to repair
+any drift; the counters of a chrome version that was never reconciled are
+seeded the first time they are read, see GetStats.
+"""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+from models.compat import browser as compat_browser
+from models.compat import result as compat_result
+
+
+_NUM_SHARDS = 5
+
+# Number of entities counted per datastore call when reconciling.
+_COUNT_BATCH = 1000
+
+# Seeding a chrome version is spawned at most once per this many seconds.
+_SEED_INTERVAL = 600
+
+
+class VersionStatsShard(db.Model):
+  """Shard of the result counters of a chrome version.
+
+  Attributes:
+    chrome_version: The chrome version the counters are for.
+    total: Number of results logged.
+    passed: Number of results that succeeded.
+    failed: Number of results that failed.
+    remaining: Number of tests of visible runs neither assigned nor with a
+        result.
+    reconciled: Whether the shard was written by a reconciliation, which
+        makes the sum of the shards of the chrome version a full count.
+  """
+  chrome_version = db.StringProperty(required=True)
+  total = db.IntegerProperty(required=True, default=0)
+  passed = db.IntegerProperty(required=True, default=0)
+  failed = db.IntegerProperty(required=True, default=0)
+  remaining = db.IntegerProperty(required=True, default=0)
+  reconciled = db.BooleanProperty(required=False, default=False)
+
+
+def _GetShardKeyName(chrome_version, index):
+  return 'VersionStatsShard_%s_%d' % (chrome_version, index)
+
+
+def Increment(chrome_version, total=0, passed=0, failed=0, remaining=0):
+  """Adds the given deltas to the counters of a chrome version.
+
+  Must be called inside a (cross-group) transaction, so the counters change
+  if and only if the counted entities do.
+
+  Args:
+    chrome_version: The chrome version to update.
+    total: Delta for the number of results.
+    passed: Delta for the number of passed results.
+    failed: Delta for the number of failed results.
+    remaining: Delta for the number of remaining tests.
+  """
+  key_name = _GetShardKeyName(chrome_version,
+                              random.randint(0, _NUM_SHARDS - 1))
+  shard = VersionStatsShard.get_by_key_name(key_name)
+  if not shard:
+    shard = VersionStatsShard(key_name=key_name,
+                              chrome_version=chrome_version)
+  shard.total += total
+  shard.passed += passed
+  shard.failed += failed
+  shard.remaining += remaining
+  shard.put()
+
+
+def GetStats():
+  """Gets the counters of all chrome versions.
+
+  The counters only hold the changes made since they were created. The
+  chrome versions never reconciled are thus reconciled in the background,
+  and read as counted so far until done.
+
+  Returns:
+    A list of tuples sorted by chrome version. A tuple in the returned list
+    follows this format:
+      (chrome_version, (total_results, passed, failed, remaining))
+  """
+  versions_table = {}
+  reconciled = set()
+  for shard in VersionStatsShard.all():
+    current = versions_table.get(shard.chrome_version, (0, 0, 0, 0))
+    versions_table[shard.chrome_version] = (current[0] + shard.total,
+                                            current[1] + shard.passed,
+                                            current[2] + shard.failed,
+                                            current[3] + shard.remaining)
+    if shard.reconciled:
+      reconciled.add(shard.chrome_version)
+
+  for version in compat_browser.GetBrowserVersions():
+    chrome_version = version.chrome_version
+    if chrome_version in reconciled:
+      continue
+    versions_table.setdefault(chrome_version, (0, 0, 0, 0))
+    reconciled.add(chrome_version)
+    if memcache.add('stats_seed_%s' % chrome_version, True,
+                    time=_SEED_INTERVAL):
+      deferred.defer(ReconcileChromeVersion, chrome_version,
+                     _queue='tests-queue')
+  return [(key, versions_table[key]) for key in sorted(versions_table)]
+
+
+def _Count(q):
+  """Counts the entities matching a keys only query, in batches."""
+  total = 0
+  while True:
+    count = len(q.fetch(_COUNT_BATCH))
+    total += count
+    if count < _COUNT_BATCH:
+      return total
+    q.with_cursor(q.cursor())
+
+
+def Reconcile():
+  """Spawns a task recomputing the counters of each chrome version."""
+  chrome_versions = set([version.chrome_version for version
+                         in compat_browser.GetBrowserVersions()])
+  for chrome_version in chrome_versions:
+    deferred.defer(ReconcileChromeVersion, chrome_version,
+                   _queue='tests-queue')
+
+
+def ReconcileChromeVersion(chrome_version):
+  """Recomputes the counters of a chrome version from the datastore.
+
+  Changes made while counting may be missed or counted twice; they are
+  corrected by the next reconciliation.
+
+  Args:
+    chrome_version: The chrome version to recompute.
+  """
+  # Imported here since tests depends on this module to keep the counters.
+  from models.compat import tests
+
+  total = passed = remaining = 0
+  versions = compat_browser.GetBrowserVersionsByChromeVersion(chrome_version)
+  for version in versions:
+    total += _Count(compat_result.Result.all(keys_only=True)
+                    .filter('browser_version =', version))
+    passed += _Count(compat_result.Result.all(keys_only=True)
+                     .filter('browser_version =', version)
+                     .filter('succeed =', True))
+    remaining_query = tests.Test.all(keys_only=True)
+    remaining_query.filter('browser_version =', version)
+    tests.FilterVisible(remaining_query)
+    remaining_query.filter('result =', None)
+    remaining_query.filter('assignment =', None)
+    remaining += _Count(remaining_query)
+
+  def _Txn():
+    # Shard 0 is overwritten below, the others are reset by deleting them.
+    shards = VersionStatsShard.get_by_key_name(
+        [_GetShardKeyName(chrome_version, index)
+         for index in range(1, _NUM_SHARDS)])
+    shards = [shard for shard in shards if shard]
+    if shards:
+      db.delete(shards)
+    VersionStatsShard(key_name=_GetShardKeyName(chrome_version, 0),
+                      chrome_version=chrome_version,
+                      total=total,
+                      passed=passed,
+                      failed=total - passed,
+                      remaining=remaining,
+                      reconciled=True).put()
+
+  db.run_in_transaction_options(db.create_transaction_options(xg=True), _Txn)
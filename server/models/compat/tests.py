@@ -16,24 +16,61 @@
 
 __author__ = 'alexto@google.com (Alexis O. Torres)'
 
+import datetime
+import logging
 import sha
 
+from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.ext import db
 from google.appengine.ext import deferred
 
+from models import entity_loader
 from models.compat import browser as compat_browser
 from models.compat import result as compat_result
 from models.compat import run as compat_run
 from models.compat import run_site_map
+from models.compat import stats as compat_stats
+
+
+# Number of mappings turned into tests by each materialization task.
+MATERIALIZE_BATCH_SIZE = 500
+
+# Number of tests updated by each task when hiding runs or compacting tests.
+_UPDATE_BATCH_SIZE = 500
+
+# Number of tests written by each cross-group transaction of such a task, the
+# most entity groups a transaction may touch.
+_TXN_BATCH_SIZE = 25
+
+# Key name of the migration rewriting the tests stored before the hidden flag
+# existed, see StartCompaction.
+_COMPACTION = 'compaction'
+
+# A compaction not heard of for this long is considered lost and restarted.
+_COMPACTION_TIMEOUT = datetime.timedelta(minutes=30)
+
+_COMPACTED_CACHE_KEY = 'tests_compacted'
+
+# Set once the compaction is done, since it is never undone.
+_compacted = False
 
 
 class Test(db.Model):
-  """Tracks assignments of sites to users."""
+  """Tracks assignments of sites to users.
+
+  Tests with a mapping only reference it; their start url and steps are read
+  from the mapping's site and verification, see GetStartUrl and GetSteps.
+  start_url and steps are only stored for tests without a mapping.
+
+  hidden mirrors the visibility of the run, so tests of hidden runs are left
+  out of the remaining tests queries.
+  """
   created = db.DateTimeProperty(required=False, auto_now_add=True)
   modified = db.DateTimeProperty(required=False, auto_now=True)
   start_url = db.LinkProperty(required=False)
   steps = db.TextProperty(required=False)
+  hidden = db.BooleanProperty(required=False, default=False)
   run = db.ReferenceProperty(
       required=True,
       reference_class=compat_run.CompatRun,
@@ -53,6 +90,42 @@ class Test(db.Model):
   assignment = db.ReferenceProperty(required=False)
 
 
+class TestsMigration(db.Model):
+  """Progress of a migration rewriting all the tests.
+
+  Attributes:
+    done: Whether every test was rewritten.
+    updated: When the migration last made progress.
+  """
+  done = db.BooleanProperty(required=True, default=False)
+  updated = db.DateTimeProperty(required=False, auto_now=True)
+
+
+def IsCompacted():
+  """Returns whether every test stored has its hidden flag set.
+
+  Tests stored before the flag existed are missing from the indexes on
+  hidden, so the queries only filter on it once CompactTests rewrote them.
+  """
+  global _compacted
+  if not _compacted:
+    if memcache.get(_COMPACTED_CACHE_KEY):
+      _compacted = True
+    else:
+      migration = TestsMigration.get_by_key_name(_COMPACTION)
+      if migration and migration.done:
+        memcache.set(_COMPACTED_CACHE_KEY, True)
+        _compacted = True
+  return _compacted
+
+
+def FilterVisible(q):
+  """Leaves the tests of hidden runs out of a query, once possible."""
+  if IsCompacted():
+    q.filter('hidden = ', False)
+  return q
+
+
 def GetTestKeyName(start_url, steps, browser_version,
                    run, mapping):
   """Returns a str used to uniquely identify a test.
@@ -99,13 +172,42 @@ def AddTest(start_url, steps, browser_version, run,
                             browser_version=browser_version,
                             run=run,
                             mapping=mapping)
-  test = Test.get_or_insert(key_name=key_name,
-                            start_url=start_url,
-                            steps=steps,
-                            run=run,
-                            browser_version=browser_version,
-                            mapping=mapping)
-  return test
+
+  if mapping:
+    # Read from the mapping when needed.
+    start_url = None
+    steps = None
+
+  def _Txn():
+    test = Test.get_by_key_name(key_name)
+    if not test:
+      test = Test(key_name=key_name,
+                  start_url=start_url,
+                  steps=steps,
+                  run=run,
+                  browser_version=browser_version,
+                  mapping=mapping,
+                  hidden=run.hidden)
+      test.put()
+      if not run.hidden:
+        compat_stats.Increment(browser_version.chrome_version, remaining=1)
+    return test
+  return db.run_in_transaction_options(
+      db.create_transaction_options(xg=True), _Txn)
+
+
+def GetStartUrl(test):
+  """Gets the url the given test starts at."""
+  if Test.mapping.get_value_for_datastore(test):
+    return test.mapping.site.url
+  return test.start_url
+
+
+def GetSteps(test):
+  """Gets the verification steps of the given test."""
+  if Test.mapping.get_value_for_datastore(test):
+    return test.mapping.verification.steps
+  return test.steps
 
 
 def _FetchAll(q):
@@ -121,17 +223,18 @@ def _FetchAll(q):
   return results
 
 
-def GetTestsForBrowser(browser_version, keys_only=False):
+def GetTestsForBrowser(browser_version, keys_only=True):
   """Gets all tests associated with the given browser version."""
   q = Test.all(keys_only=keys_only)
   q.filter('browser_version = ', browser_version)
   return _FetchAll(q)
 
 
-def GetTestsRemainingForBrowser(browser_version, keys_only=False):
-  """Gets all tests remaining to execute for the given browser version."""
+def GetTestsRemainingForBrowser(browser_version, keys_only=True):
+  """Gets all tests of visible runs remaining to execute for the browser."""
   q = Test.all(keys_only=keys_only)
   q.filter('browser_version = ', browser_version)
+  FilterVisible(q)
   q.filter('result = ', None)
   q.filter('assignment = ', None)
   q.order('modified')
@@ -139,26 +242,64 @@ def GetTestsRemainingForBrowser(browser_version, keys_only=False):
 
 
 def GetTestsRemainingFroRunAndBrowser(
-    run, browser_version, keys_only=False):
+    run, browser_version, keys_only=True):
   """Gets all tests remaining to execute for the given browser and run."""
   q = Test.all(keys_only=keys_only)
   q.filter('run = ', run)
   q.filter('browser_version = ', browser_version)
+  FilterVisible(q)
   q.filter('result = ', None)
   q.filter('assignment = ', None)
   q.order('modified')
   return _FetchAll(q)
 
 
+def GetNextTestKeys(run, browser_version, limit=1):
+  """Gets the keys of the next tests to assign for a run and browser.
+
+  The (run, browser_version) pair acts as a ready queue of unassigned tests
+  without result, oldest first, so only its head is read.
+
+  Args:
+    run: The run (or its key) the tests belong to.
+    browser_version: The BrowserVersion (or its key) the tests are for.
+    limit: Number of tests to read from the head of the queue.
+
+  Returns:
+    A list of Test keys.
+  """
+  q = Test.all(keys_only=True)
+  q.filter('run = ', run)
+  q.filter('browser_version = ', browser_version)
+  FilterVisible(q)
+  q.filter('result = ', None)
+  q.filter('assignment = ', None)
+  q.order('modified')
+  return q.fetch(limit)
+
+
 def SetAssignment(key, assignment):
-  """Sets the test assignment info."""
+  """Sets the test assignment info.
+
+  Keeps the remaining tests counter up to date, so it must be called inside a
+  cross-group transaction when called from a transaction.
+  """
 
   def _Txn():
     test = Test.get(key)
+    was_remaining = not (Test.assignment.get_value_for_datastore(test) or
+                         Test.result.get_value_for_datastore(test))
     test.assignment = assignment
     test.put()
+    is_remaining = not (assignment or
+                        Test.result.get_value_for_datastore(test))
+    if was_remaining != is_remaining:
+      chrome_version = test.browser_version.chrome_version
+      compat_stats.Increment(chrome_version,
+                             remaining=is_remaining and 1 or -1)
     return test
-  return db.run_in_transaction(_Txn)
+  return db.run_in_transaction_options(
+      db.create_transaction_options(xg=True), _Txn)
 
 
 def SetResult(key, result):
@@ -173,33 +314,83 @@ def SetResult(key, result):
   return test
 
 
-def AddTestsForBrowserVersion(browser_version):
-  """Adds a map of all known tests and the specified browser version."""
-  deferred.defer(SpawnAddTestsForMappings,
-                 browser_version=browser_version,
-                 _queue='tests-queue')
+def AddTestsForBrowserVersion(browser_version, transactional=False):
+  """Adds a map of all known tests and the specified browser version.
+
+  Args:
+    browser_version: The new BrowserVersion.
+    transactional: Whether the task is enqueued as part of the current
+        transaction.
+  """
+  deferred.defer(MaterializeTests,
+                 browser_version_key=browser_version.key(),
+                 _queue='tests-queue',
+                 _transactional=transactional)
 
 
-def SpawnAddTestsForMappings(browser_version):
-  """Fan-out operation to map tests with the given browser version."""
-  mappings = run_site_map.GetMappings()
-  for mapping in mappings:
-    deferred.defer(AddTestForMapping,
-                   mapping=mapping,
-                   browser_version=browser_version,
+def MaterializeTests(browser_version_key, cursor=None):
+  """Creates the tests of one batch of mappings for a browser version.
+
+  Each task pages MATERIALIZE_BATCH_SIZE visible mappings, resolves their
+  sites and verifications with a single batch get and writes the missing
+  tests with a single batch put, then chains a task for the next page. The
+  last task marks the browser version as materialized.
+
+  The stats counters are updated after the batch put; if a task dies in
+  between, the periodic stats reconciliation corrects them.
+
+  Args:
+    browser_version_key: Key of the BrowserVersion to create tests for.
+    cursor: Cursor of the mappings query where this batch starts.
+  """
+  browser_version = compat_browser.BrowserVersion.get(browser_version_key)
+  q = run_site_map.RunSiteMap.all().filter('hidden = ', False)
+  if cursor:
+    q.with_cursor(cursor)
+  mappings = q.fetch(MATERIALIZE_BATCH_SIZE)
+  run_site_map.PrefetchRefProps(mappings)
+
+  candidates = [
+      Test(key_name=GetTestKeyName(start_url=mapping.site.url,
+                                   steps=mapping.verification.steps,
+                                   browser_version=browser_version,
+                                   run=mapping.run,
+                                   mapping=mapping),
+           run=mapping.run,
+           browser_version=browser_version,
+           mapping=mapping,
+           hidden=mapping.run.hidden)
+      for mapping in mappings]
+  existing = db.get([test.key() for test in candidates])
+  new_tests = [test for test, current in zip(candidates, existing)
+               if not current]
+  if new_tests:
+    db.put(new_tests)
+    # Only the tests of visible runs are counted as remaining.
+    remaining = len([test for test in new_tests if not test.hidden])
+    if remaining:
+      db.run_in_transaction(compat_stats.Increment,
+                            browser_version.chrome_version,
+                            remaining=remaining)
+  logging.info('Created %d tests for %d mappings of %s.',
+               len(new_tests), len(mappings), browser_version_key.name())
+
+  if len(mappings) == MATERIALIZE_BATCH_SIZE:
+    deferred.defer(MaterializeTests,
+                   browser_version_key=browser_version_key,
+                   cursor=q.cursor(),
                    _queue='tests-queue')
+  else:
+    compat_browser.SetTestsMaterialized(browser_version_key)
 
 
 def AddTestForMapping(mapping, browser_version):
   """Maps all tests in the given run to the specified browser version."""
-  # TODO(alexto): Make queue names constants.
-  deferred.defer(AddTest,
-                 start_url=mapping.site.url,
-                 steps=mapping.verification.steps,
-                 browser_version=browser_version,
-                 run=mapping.run,
-                 mapping=mapping,
-                 _queue='tests-queue')
+  AddTest(start_url=mapping.site.url,
+          steps=mapping.verification.steps,
+          browser_version=browser_version,
+          run=mapping.run,
+          mapping=mapping)
 
 
 def AddTestForAllBrowserVersions(mapping):
@@ -216,3 +407,152 @@ def AddTestForBrowserVersions(mapping, browser_versions):
                    browser_version=browser_version,
                    _queue='tests-queue')
 
+
+def _IsRemaining(test):
+  """Whether a test is neither assigned nor has a result."""
+  return not (Test.assignment.get_value_for_datastore(test) or
+              Test.result.get_value_for_datastore(test))
+
+
+def _PutHidden(hidden_by_key, compact=False):
+  """Sets the hidden flag of tests, with one batch put per few tests.
+
+  The tests are read again and written in cross-group transactions of
+  _TXN_BATCH_SIZE tests, and only the flag (and, when compacting, the copied
+  start url and steps) is changed, so concurrent assignments and results are
+  kept. Unless compacting, the tests whose flag is already set are not
+  written.
+
+  Args:
+    hidden_by_key: A dict of the hidden flag to set by test key.
+    compact: Whether to also drop the start url and steps of the tests with a
+        mapping.
+
+  Returns:
+    A dict of the number of remaining tests whose flag changed, by the key of
+    their BrowserVersion.
+  """
+
+  def _Txn(keys):
+    changed = {}
+    updated = []
+    for test in db.get(keys):
+      if not test:
+        continue
+      hidden = hidden_by_key[test.key()]
+      if test.hidden == hidden and not compact:
+        continue
+      if test.hidden != hidden and _IsRemaining(test):
+        browser_version_key = Test.browser_version.get_value_for_datastore(
+            test)
+        changed[browser_version_key] = changed.get(browser_version_key, 0) + 1
+      test.hidden = hidden
+      if compact and Test.mapping.get_value_for_datastore(test):
+        test.start_url = None
+        test.steps = None
+      updated.append(test)
+    if updated:
+      db.put(updated)
+    return changed
+
+  keys = hidden_by_key.keys()
+  changed = {}
+  for start in range(0, len(keys), _TXN_BATCH_SIZE):
+    batch_changed = db.run_in_transaction_options(
+        db.create_transaction_options(xg=True), _Txn,
+        keys[start:start + _TXN_BATCH_SIZE])
+    for browser_version_key, count in batch_changed.iteritems():
+      changed[browser_version_key] = changed.get(browser_version_key, 0) + count
+  return changed
+
+
+def SetRunTestsHidden(run_key, hidden, cursor=None):
+  """Copies the visibility of a run to one batch of its tests.
+
+  The remaining tests counters only count the tests of visible runs, so they
+  are decremented by the remaining tests hidden, and incremented by those
+  shown again. As in MaterializeTests, they are updated after the writes; if
+  a task dies in between, the periodic stats reconciliation corrects them.
+  Chains a task for the next batch.
+
+  Args:
+    run_key: Key of the CompatRun.
+    hidden: Whether the run is hidden.
+    cursor: Cursor of the tests query where this batch starts.
+  """
+  q = Test.all(keys_only=True).filter('run = ', run_key)
+  if cursor:
+    q.with_cursor(cursor)
+  batch = q.fetch(_UPDATE_BATCH_SIZE)
+  changed = _PutHidden(dict((key, hidden) for key in batch))
+
+  browser_version_keys = changed.keys()
+  browser_versions = db.get(browser_version_keys)
+  for browser_version_key, browser_version in zip(browser_version_keys,
+                                                  browser_versions):
+    if not browser_version:
+      continue
+    count = changed[browser_version_key]
+    db.run_in_transaction(compat_stats.Increment,
+                          browser_version.chrome_version,
+                          remaining=hidden and -count or count)
+  logging.info('Set hidden to %s on %d tests of run %s.', hidden,
+               len(batch), run_key)
+
+  if len(batch) == _UPDATE_BATCH_SIZE:
+    deferred.defer(SetRunTestsHidden, run_key, hidden, cursor=q.cursor(),
+                   _queue='tests-queue')
+
+
+def StartCompaction():
+  """Starts CompactTests unless it is done or running.
+
+  Called periodically by cron, so the tests stored before the hidden flag
+  existed are rewritten after a deploy without anyone asking, and a
+  compaction whose task chain was lost is started over.
+
+  Returns:
+    Whether a compaction was started.
+  """
+
+  def _Txn():
+    migration = TestsMigration.get_by_key_name(_COMPACTION)
+    if migration and (migration.done or migration.updated >
+                      datetime.datetime.now() - _COMPACTION_TIMEOUT):
+      return False
+    TestsMigration(key_name=_COMPACTION).put()
+    deferred.defer(CompactTests, _queue='tests-queue', _transactional=True)
+    return True
+  return db.run_in_transaction(_Txn)
+
+
+def CompactTests(cursor=None):
+  """Rewrites one batch of tests in the compact representation.
+
+  Drops the start url and steps copied from the mapping and sets the hidden
+  flag from the run, which tests stored before it existed lack and without
+  which they are missing from the indexes on hidden. Chains a task for the
+  next batch; the last one marks the compaction done, from when on the
+  queries filter on hidden, and reconciles the stats accordingly, since the
+  remaining tests of hidden runs were counted until then.
+
+  Args:
+    cursor: Cursor of the tests query where this batch starts.
+  """
+  q = Test.all()
+  if cursor:
+    q.with_cursor(cursor)
+  batch = q.fetch(_UPDATE_BATCH_SIZE)
+  entity_loader.EntityLoader().Prefetch(batch, 'run')
+  _PutHidden(dict((test.key(), test.run.hidden) for test in batch),
+             compact=True)
+  logging.info('Compacted %d tests.', len(batch))
+
+  if len(batch) == _UPDATE_BATCH_SIZE:
+    # Also tells StartCompaction the compaction is still running.
+    TestsMigration(key_name=_COMPACTION).put()
+    deferred.defer(CompactTests, cursor=q.cursor(), _queue='tests-queue')
+  else:
+    TestsMigration(key_name=_COMPACTION, done=True).put()
+    memcache.set(_COMPACTED_CACHE_KEY, True)
+    compat_stats.Reconcile()
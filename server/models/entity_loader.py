@@ -0,0 +1,121 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Batch loading of reference properties.
+
+Dereferencing a db.ReferenceProperty costs one datastore get per entity. The
+EntityLoader resolves whole reference chains (e.g. "mapping.site") for a list
+of entities with one batch get per level of the chain, for example:
+  loader = entity_loader.EntityLoader()
+  loader.Prefetch(results, 'browser_version', 'mapping.run', 'mapping.site')
+"""
+
+import logging
+
+from google.appengine.ext import db
+
+
+class EntityLoader(object):
+  """Resolves reference properties in batches.
+
+  Entities are cached by key for the lifetime of the loader, so a loader
+  should live no longer than a request.
+
+  Attributes:
+    round_trips: Number of batch gets issued.
+    dereferences: Number of references resolved; without the loader each
+        would have been a get.
+  """
+
+  def __init__(self):
+    self._cache = {}
+    self.round_trips = 0
+    self.dereferences = 0
+
+  @property
+  def round_trips_saved(self):
+    """Number of gets avoided compared to dereferencing one at a time."""
+    return max(0, self.dereferences - self.round_trips)
+
+  def Get(self, keys):
+    """Gets the entities for the given keys, using the cache when possible.
+
+    Args:
+      keys: A list of db.Key objects.
+
+    Returns:
+      The list of entities (or None for missing ones), in the order of keys.
+    """
+    missing = list(set([key for key in keys if key not in self._cache]))
+    if missing:
+      self.round_trips += 1
+      self._cache.update(zip(missing, db.get(missing)))
+    return [self._cache[key] for key in keys]
+
+  def Prefetch(self, entities, *chains):
+    """Resolves the given reference chains on all entities.
+
+    Args:
+      entities: A list of db.Model objects of the same kind.
+      chains: Dot separated reference property names, e.g. "mapping.run".
+
+    Returns:
+      The given entities.
+    """
+    tree = {}
+    for chain in chains:
+      node = tree
+      for name in chain.split('.'):
+        node = node.setdefault(name, {})
+    self._PrefetchTree([entity for entity in entities if entity], tree)
+    logging.debug('Resolved %d references with %d gets.',
+                  self.dereferences, self.round_trips)
+    return entities
+
+  def _PrefetchTree(self, entities, tree):
+    """Resolves one level of references, then recurses into the next ones."""
+    if not entities or not tree:
+      return
+
+    fields = []
+    for entity in entities:
+      for name in tree:
+        prop = entity.properties()[name]
+        key = prop.get_value_for_datastore(entity)
+        if key:
+          fields.append((entity, prop, key))
+    self.dereferences += len(fields)
+
+    refs = self.Get([key for _, _, key in fields])
+    resolved = dict((name, {}) for name in tree)
+    for (entity, prop, key), ref in zip(fields, refs):
+      if ref:
+        prop.__set__(entity, ref)
+        resolved[prop.name][key] = ref
+
+    for name, subtree in tree.iteritems():
+      self._PrefetchTree(resolved[name].values(), subtree)
+
+
+def PrefetchRefProps(entities, *props):
+  """Pre-fetches reference properties on the given list of entities.
+
+  Args:
+    entities: A list of db.Model objects.
+    props: The ReferenceProperty objects to resolve.
+
+  Returns:
+    The given entities.
+  """
+  return EntityLoader().Prefetch(entities, *[prop.name for prop in props])
@@ -21,11 +21,45 @@ an automation run.
 __author__ = 'alexto@google.com (Alexis O. Torres)'
 
 
+import hashlib
+import logging
+
+from google.appengine.api import images
+from google.appengine.api import memcache
 from google.appengine.ext import db
 
 
 DEFAULT_LIMIT = 10
 
+# Derived renditions that can be requested in addition to the original image,
+# mapped to the maximum width/height in pixels of the downscaled image.
+SIZES = {
+    'thumbnail': 160,
+    'small': 480,
+    'medium': 1024
+}
+
+# Renditions larger than this are not kept in memcache (values are capped at
+# 1MB by the service); only their ETag and modification date are.
+_MAX_CACHED_DATA = 900000
+
+# Screenshots only change when normalized, which drops their cached
+# renditions, so cached renditions never go stale.
+_RENDITION_CACHE_TIME = 86400  # 1 day.
+
+# Content types accepted for stored screenshots.
+PNG = 'image/png'
+JPEG = 'image/jpeg'
+CONTENT_TYPES = [PNG, JPEG]
+
+# Uploaded images larger than this, in bytes or pixels per side, are
+# re-encoded by NormalizeScreenshot.
+MAX_STORED_BYTES = 512000
+MAX_STORED_DIMENSION = 2560
+
+# Quality used when re-encoding oversized screenshots as JPEG.
+_REENCODE_JPEG_QUALITY = 85
+
 
 class Screenshot(db.Model):
   """Stores a screenshot."""
@@ -40,10 +74,55 @@ class Screenshot(db.Model):
   caption = db.StringProperty(required=False)
   details = db.TextProperty(required=False)
   labels = db.StringListProperty()
+  data_hash = db.StringProperty(required=False)
+  content_type = db.StringProperty(required=False, default=PNG,
+                                   choices=CONTENT_TYPES)
+  # Set until NormalizeScreenshot ran, as it may still replace the data.
+  pending_normalization = db.BooleanProperty(required=False, default=False)
+
+
+class ScreenshotRendition(db.Model):
+  """Stores a downscaled copy of a screenshot.
+
+  Renditions are children of the Screenshot they were derived from and use
+  the size name (one of the keys of SIZES) as key name.
+  """
+  data = db.BlobProperty(required=True)
+  data_hash = db.StringProperty(required=True)
+  content_type = db.StringProperty(required=False, default=PNG,
+                                   choices=CONTENT_TYPES)
+  created_date = db.DateTimeProperty(required=False, auto_now_add=True)
+
+
+class Rendition(object):
+  """Image data plus the metadata needed to serve it with HTTP caching.
+
+  Attributes:
+    data: The image bytes, or None when only the metadata was loaded.
+    etag: Strong entity tag of the image bytes.
+    modified_date: Datetime the image bytes last changed.
+    content_type: MIME type of the image bytes.
+    final: Whether the image bytes will not change anymore, i.e. the
+        screenshot is not pending normalization.
+  """
+
+  def __init__(self, data, etag, modified_date, content_type=PNG,
+               final=True):
+    self.data = data
+    self.etag = etag
+    self.modified_date = modified_date
+    self.content_type = content_type
+    self.final = final
+
+
+def ComputeHash(data):
+  """Returns the hex digest used as the entity tag of the given image data."""
+  return hashlib.sha1(data).hexdigest()
 
 
 def Add(data, source, source_id='', project='',
-        caption=None, details=None, labels=None):
+        caption=None, details=None, labels=None, content_type=PNG,
+        pending_normalization=False):
   """Adds a new screenshot entry.
 
   Args:
@@ -55,6 +134,9 @@ def Add(data, source, source_id='', project='',
     caption: Caption string.
     details: More detailed string about the screenshot.
     labels: List of strings used to label the screenshot.
+    content_type: MIME type of data, one of CONTENT_TYPES.
+    pending_normalization: Whether NormalizeScreenshot will run on the
+        screenshot.
 
   Returns:
     The model object for the new screenshot.
@@ -65,12 +147,15 @@ def Add(data, source, source_id='', project='',
     if labels:
       labels_list = labels
     screenshot = Screenshot(data=db.Blob(data),
+                            data_hash=ComputeHash(data),
+                            content_type=content_type,
                             source=source,
                             source_id=source_id,
                             project=project,
                             caption=caption,
                             details=details,
-                            labels=labels_list)
+                            labels=labels_list,
+                            pending_normalization=pending_normalization)
     screenshot.put()
     return screenshot
   return db.run_in_transaction(_Transaction)
@@ -82,11 +167,198 @@ def GetById(screenshot_id):
 
 
 def GetScreenshots(source, source_id=None, project=None,
-                   limit=DEFAULT_LIMIT):
-  query = Screenshot.all().filter('source=', source)
+                   limit=DEFAULT_LIMIT, keys_only=False):
+  """Gets the screenshots matching the given source, id and project.
+
+  Args:
+    source: The source name the screenshots were stored with.
+    source_id: Optional ID of the associated artifact.
+    project: Optional project name.
+    limit: Maximum number of screenshots to return.
+    keys_only: Whether to return only the keys, which avoids loading the
+        image data of every match.
+
+  Returns:
+    A list of Screenshot model objects, or keys if keys_only is set.
+  """
+  query = Screenshot.all(keys_only=keys_only).filter('source=', source)
   if source_id:
     query.filter('source_id=', source_id)
   if project:
     query.filter('project=', project)
   return query.fetch(limit)
 
+
+def _RenditionCacheKey(screenshot_id, size):
+  return 'screenshot_rendition_%s_%s' % (screenshot_id, size or 'original')
+
+
+def GetCachedRendition(screenshot_id, size=None):
+  """Gets a rendition from memcache without touching the datastore.
+
+  The returned rendition may have no data if the image was too large to be
+  cached, but its metadata is always enough to answer conditional requests.
+
+  Args:
+    screenshot_id: ID of the screenshot.
+    size: Name of the derived size, or None for the original image.
+
+  Returns:
+    A Rendition object, or None if it is not cached.
+  """
+  cached = memcache.get(_RenditionCacheKey(screenshot_id, size))
+  if not cached:
+    return None
+  return Rendition(cached.get('data'), cached['etag'],
+                   cached['modified_date'], cached.get('content_type', PNG),
+                   cached.get('final', True))
+
+
+def GetRendition(screenshot_id, size=None):
+  """Gets the image data of a screenshot, downscaling it if necessary.
+
+  Derived sizes are generated on first access, stored as ScreenshotRendition
+  children of the original and cached in memcache afterwards. Screenshots
+  pending normalization are neither stored nor cached, since their data may
+  still change.
+
+  Args:
+    screenshot_id: ID of the screenshot.
+    size: Name of the derived size (one of the keys of SIZES), or None for the
+        original image.
+
+  Returns:
+    A Rendition object, or None if the screenshot does not exist.
+  """
+  cached = GetCachedRendition(screenshot_id, size)
+  if cached and cached.data is not None:
+    return cached
+
+  screenshot_key = db.Key.from_path('Screenshot', int(screenshot_id))
+  rendition = None
+  if size:
+    stored = ScreenshotRendition.get_by_key_name(size, parent=screenshot_key)
+    if stored:
+      rendition = Rendition(stored.data, stored.data_hash, stored.created_date,
+                            stored.content_type)
+
+  if not rendition:
+    screenshot = db.get(screenshot_key)
+    if not screenshot:
+      return None
+    final = not screenshot.pending_normalization
+    if size:
+      rendition = _CreateRendition(screenshot, size, store=final)
+    else:
+      data_hash = screenshot.data_hash or ComputeHash(screenshot.data)
+      rendition = Rendition(screenshot.data, data_hash,
+                            screenshot.modified_date or
+                            screenshot.reported_date,
+                            screenshot.content_type or PNG, final)
+    if not final:
+      return rendition
+
+  _CacheRendition(screenshot_id, size, rendition)
+  return rendition
+
+
+def _CreateRendition(screenshot, size, store=True):
+  """Downscales a screenshot to the given size, storing the result.
+
+  Args:
+    screenshot: The Screenshot to downscale.
+    size: Name of the derived size, one of the keys of SIZES.
+    store: Whether to store the rendition; when not, it is not final.
+
+  Returns:
+    A Rendition object.
+  """
+  max_dimension = SIZES[size]
+  data = screenshot.data
+  content_type = screenshot.content_type or PNG
+  try:
+    image = images.Image(data)
+    if image.width > max_dimension or image.height > max_dimension:
+      data = images.resize(data, width=max_dimension, height=max_dimension,
+                           output_encoding=images.PNG)
+      content_type = PNG
+  except images.Error:
+    # Serve the original rather than failing the request; the rendition is
+    # still stored so the bad image is only inspected once.
+    logging.exception('Unable to resize screenshot %s.',
+                      screenshot.key().id())
+
+  data_hash = ComputeHash(data)
+  if not store:
+    return Rendition(data, data_hash, screenshot.modified_date, content_type,
+                     final=False)
+  rendition = ScreenshotRendition(key_name=size,
+                                  parent=screenshot,
+                                  data=db.Blob(data),
+                                  data_hash=data_hash,
+                                  content_type=content_type)
+  rendition.put()
+  return Rendition(rendition.data, rendition.data_hash,
+                   rendition.created_date, rendition.content_type)
+
+
+def _CacheRendition(screenshot_id, size, rendition):
+  """Stores a rendition, or only its metadata if too large, in memcache."""
+  value = {'etag': rendition.etag,
+           'modified_date': rendition.modified_date,
+           'content_type': rendition.content_type,
+           'final': rendition.final}
+  if len(rendition.data) <= _MAX_CACHED_DATA:
+    value['data'] = rendition.data
+  memcache.set(_RenditionCacheKey(screenshot_id, size), value,
+               _RENDITION_CACHE_TIME)
+
+
+def NormalizeScreenshot(screenshot_id):
+  """Validates an uploaded screenshot and re-encodes it if oversized.
+
+  Meant to run in a task after a binary upload so decoding the image does not
+  hold up the upload request. Screenshots that cannot be decoded are deleted.
+  The screenshot is then no longer pending normalization, and the renditions
+  derived from its previous data are dropped.
+
+  Args:
+    screenshot_id: ID of the screenshot to normalize.
+  """
+  screenshot = GetById(screenshot_id)
+  if not screenshot:
+    return
+
+  data = screenshot.data
+  try:
+    image = images.Image(data)
+    width, height = image.width, image.height
+  except images.Error:
+    logging.error('Deleting undecodable screenshot %s.', screenshot_id)
+    screenshot.delete()
+    return
+
+  oversized = (width > MAX_STORED_DIMENSION or
+               height > MAX_STORED_DIMENSION)
+  if not oversized and len(data) <= MAX_STORED_BYTES:
+    screenshot.pending_normalization = False
+    screenshot.put()
+    return
+
+  # Photographic screenshots compress far better as JPEG, so oversized ones
+  # are converted regardless of the uploaded format.
+  dimension = min(max(width, height), MAX_STORED_DIMENSION)
+  data = images.resize(data, width=dimension, height=dimension,
+                       output_encoding=images.JPEG,
+                       quality=_REENCODE_JPEG_QUALITY)
+  logging.info('Re-encoded screenshot %s from %d to %d bytes.',
+               screenshot_id, len(screenshot.data), len(data))
+
+  screenshot.data = db.Blob(data)
+  screenshot.data_hash = ComputeHash(data)
+  screenshot.content_type = JPEG
+  screenshot.pending_normalization = False
+  screenshot.put()
+  db.delete(ScreenshotRendition.all(keys_only=True).ancestor(screenshot))
+  memcache.delete_multi([_RenditionCacheKey(screenshot_id, size)
+                         for size in [None] + SIZES.keys()])
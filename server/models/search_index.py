@@ -0,0 +1,212 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Inverted index used to search the method store and the stored tests.
+
+Every indexed document has one SearchIndexEntry whose list properties hold
+its terms. Queries are plain equality filters on those lists, which the
+datastore answers with a merge join, so no composite indexes (and no external
+search service) are needed.
+"""
+
+import re
+
+from google.appengine.ext import db
+
+
+# Document kinds that can be indexed.
+METHOD = 'MethodMetaData'
+TEST = 'StorageMetadata'
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Prefix queries match words of the document title (e.g. method name and
+# labels, test name) from this many characters up to _MAX_PREFIX_LENGTH.
+_MIN_PREFIX_LENGTH = 2
+_MAX_PREFIX_LENGTH = 10
+
+# Caps the number of terms stored for one document, bounding the index writes
+# of a save.
+_MAX_TERMS = 500
+
+_CAMEL_CASE_RE = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z0-9]+')
+
+
+class SearchIndexEntry(db.Model):
+  """Stores the searchable terms of one document.
+
+  The key name is built from the document kind and key, see _GetKeyName.
+
+  Attributes:
+    kind: The kind of the indexed document, METHOD or TEST.
+    scope: Restricts searches, e.g. the project of a test. Empty if unused.
+    document: The key of the indexed document.
+    title: The display title of the document.
+    terms: All words of the document.
+    prefixes: Prefixes of the words of the document title.
+  """
+  kind = db.StringProperty(required=True)
+  scope = db.StringProperty(required=False, default='')
+  document = db.ReferenceProperty(required=True)
+  title = db.StringProperty(required=False, indexed=False)
+  terms = db.StringListProperty(default=[])
+  prefixes = db.StringListProperty(default=[])
+  modified = db.DateTimeProperty(required=False, auto_now=True)
+
+
+class SearchResults(object):
+  """A page of search results.
+
+  Attributes:
+    keys: The keys of the matching documents.
+    cursor: Cursor to pass back to get the next page.
+    more: Whether there may be more results after this page.
+  """
+
+  def __init__(self, keys, cursor, more):
+    self.keys = keys
+    self.cursor = cursor
+    self.more = more
+
+
+def Tokenize(text):
+  """Splits a text into lowercase search terms.
+
+  CamelCase words are indexed both whole and split, so "clickButton" is found
+  by "clickbutton", "click" and "button".
+
+  Args:
+    text: The text to split. (string)
+
+  Returns:
+    The set of terms.
+  """
+  terms = set()
+  if not text:
+    return terms
+  for word in re.findall(r'\w+', text, re.UNICODE):
+    terms.add(word.lower())
+    terms.update([part.lower() for part in _CAMEL_CASE_RE.findall(word)])
+  return terms
+
+
+def _GetPrefixes(terms):
+  prefixes = set()
+  for term in terms:
+    for length in range(_MIN_PREFIX_LENGTH,
+                        min(len(term), _MAX_PREFIX_LENGTH) + 1):
+      prefixes.add(term[:length])
+  return prefixes
+
+
+def _GetKeyName(kind, document_key):
+  return '%s:%s' % (kind, document_key)
+
+
+def IndexDocument(kind, document_key, title, title_texts, body_texts,
+                  scope=''):
+  """Adds or replaces the index entry of a document.
+
+  Args:
+    kind: The kind of the document, METHOD or TEST.
+    document_key: The key of the document. (db.Key)
+    title: The display title of the document.
+    title_texts: Texts that can be matched by prefix, e.g. names and labels.
+    body_texts: Texts that can only be matched by whole terms.
+    scope: Optional scope restricting searches, e.g. a project name.
+
+  Returns:
+    The entry that was stored.
+  """
+  title_terms = set()
+  for text in title_texts:
+    title_terms.update(Tokenize(text))
+  body_terms = set()
+  for text in body_texts:
+    body_terms.update(Tokenize(text) - title_terms)
+  body_limit = max(0, _MAX_TERMS - len(title_terms))
+  terms = title_terms.union(sorted(body_terms)[:body_limit])
+
+  entry = SearchIndexEntry(key_name=_GetKeyName(kind, document_key),
+                           kind=kind,
+                           scope=scope or '',
+                           document=document_key,
+                           title=title,
+                           terms=sorted(terms),
+                           prefixes=sorted(_GetPrefixes(title_terms)))
+  entry.put()
+  return entry
+
+
+def RemoveDocuments(kind, document_keys):
+  """Removes the index entries of the given documents."""
+  db.delete([db.Key.from_path('SearchIndexEntry', _GetKeyName(kind, key))
+             for key in document_keys])
+
+
+def Search(kind, query, scope=None, limit=DEFAULT_PAGE_SIZE, cursor=None):
+  """Finds the documents matching all the words of a query.
+
+  Words ending with "*" are matched as prefixes of the document title words,
+  all other words must match a term of the document exactly.
+
+  Args:
+    kind: The kind of documents to search, METHOD or TEST.
+    query: The query string.
+    scope: Optional scope the documents must belong to.
+    limit: Maximum number of results in the page.
+    cursor: Cursor returned with the previous page, if any.
+
+  Returns:
+    A SearchResults object.
+  """
+  limit = max(1, min(limit, MAX_PAGE_SIZE))
+  q = SearchIndexEntry.all(keys_only=True).filter('kind =', kind)
+  if scope is not None:
+    q.filter('scope =', scope)
+
+  # Prefixes longer than what was indexed are filtered on the stored terms
+  # once the page is loaded, so such pages may hold fewer results than limit.
+  long_prefixes = []
+  for word in (query or '').split():
+    is_prefix = word.endswith('*')
+    for term in Tokenize(word):
+      if not is_prefix:
+        q.filter('terms =', term)
+      elif len(term) >= _MIN_PREFIX_LENGTH:
+        q.filter('prefixes =', term[:_MAX_PREFIX_LENGTH])
+        if len(term) > _MAX_PREFIX_LENGTH:
+          long_prefixes.append(term)
+
+  if cursor:
+    q.with_cursor(cursor)
+  entry_keys = q.fetch(limit)
+  next_cursor = q.cursor()
+  more = len(entry_keys) == limit
+
+  if long_prefixes:
+    entries = [entry for entry in db.get(entry_keys) if entry]
+    entry_keys = [entry.key() for entry in entries
+                  if _MatchesPrefixes(entry.terms, long_prefixes)]
+
+  document_keys = [db.Key(key.name().split(':', 1)[1]) for key in entry_keys]
+  return SearchResults(document_keys, next_cursor, more)
+
+
+def _MatchesPrefixes(terms, prefixes):
+  for prefix in prefixes:
+    if not [term for term in terms if term.startswith(prefix)]:
+      return False
+  return True
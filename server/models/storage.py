@@ -25,7 +25,9 @@ import logging
 import re
 import uuid
 from google.appengine.ext import db
+from google.appengine.ext import deferred
 from config import settings
+from models import search_index
 
 
 DEFAULT_NUMBER_PER_BATCH = 500
@@ -83,6 +85,7 @@ class StorageMetadata(db.Model):
     """Updates the metadata and Google Docs using a transaction."""
     db.run_in_transaction(self._UpdateTransaction,
                           new_project, new_name, new_contents)
+    IndexTest(self)
 
   def _UpdateTransaction(self, new_project, new_name, new_contents):
     """This transaction ensures the metadata and Google Docs are in sync."""
@@ -175,8 +178,10 @@ def GetTestString(contents):
 
 def Save(project, new_test_name, contents):
   """Saves both new metadata and a new docs object."""
-  return db.run_in_transaction(
+  storage_metadata = db.run_in_transaction(
       _SaveTransaction, project, new_test_name, contents)
+  IndexTest(storage_metadata)
+  return storage_metadata
 
 
 def _SaveTransaction(project, new_test_name, contents):
@@ -227,6 +232,9 @@ def FetchByIds(ids):
 
 def DeleteMetadata(instances):
   """Deletes all of the metadata."""
+  search_index.RemoveDocuments(search_index.TEST,
+                               [instance.key() for instance in instances
+                                if instance])
 
   def BatchDelete(instances):
     db.delete(instances)
@@ -275,9 +283,74 @@ def AddPreexisting(project, test_name, resource_url, resource_id,
       project=project, test_name=test_name, docs_resource_url=resource_url,
       docs_resource_id=resource_id, legacy_wtf_id=legacy_wtf_id)
   metadata.put()
+  IndexTest(metadata)
   return metadata
 
 
+def _GetStrings(value):
+  """Gets all the strings nested in a decoded JSON value."""
+  if isinstance(value, basestring):
+    return [value]
+  elif isinstance(value, dict):
+    value = value.values()
+  elif not isinstance(value, list):
+    return []
+  strings = []
+  for item in value:
+    strings.extend(_GetStrings(item))
+  return strings
+
+
+def IndexTest(storage_metadata):
+  """Adds or updates the search index entry of the given test.
+
+  The test contents are client defined JSON, so every string in them (step
+  descriptions, scripts, urls, ...) is indexed as step text.
+  """
+  step_texts = []
+  text = storage_metadata.GetText()
+  if text:
+    try:
+      step_texts = _GetStrings(json.loads(text))
+    except ValueError:
+      step_texts = [text]
+  search_index.IndexDocument(
+      search_index.TEST, storage_metadata.key(), storage_metadata.test_name,
+      [storage_metadata.test_name], step_texts,
+      scope=storage_metadata.project)
+
+
+def ReindexTests(cursor=None):
+  """Rebuilds the search index of all the tests, one batch per task."""
+  q = StorageMetadata.all()
+  if cursor:
+    q.with_cursor(cursor)
+  tests = q.fetch(DEFAULT_NUMBER_PER_BATCH)
+  for test in tests:
+    IndexTest(test)
+  if len(tests) == DEFAULT_NUMBER_PER_BATCH:
+    deferred.defer(ReindexTests, q.cursor())
+
+
+def SearchTests(query, project=None,
+                limit=search_index.DEFAULT_PAGE_SIZE, cursor=None):
+  """Searches the tests by name and step text.
+
+  Args:
+    query: The query string, see search_index.Search.
+    project: Optional project name the tests must belong to.
+    limit: Maximum number of tests returned.
+    cursor: Cursor returned with the previous page, if any.
+
+  Returns:
+    A (tests, cursor, more) tuple, where tests is a list of StorageMetadata.
+  """
+  results = search_index.Search(search_index.TEST, query, scope=project,
+                                limit=limit, cursor=cursor)
+  tests = [test for test in db.get(results.keys) if test]
+  return tests, results.cursor, results.more
+
+
 def GetUniqueId():
   """Returns a unique 128 bit identifier as a string."""
   return str(uuid.uuid4())
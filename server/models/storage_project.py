@@ -20,6 +20,7 @@ this should be easy to change in the future.
 
 __author__ = 'jasonstredwick@google.com (Jason Stredwick)'
 
+import hashlib
 import logging
 import json
 
@@ -35,6 +36,9 @@ class StorageProjectMetadata(db.Model):
     page_map: A long json string containing an encoded mapping of url patterns
       matched to names.
     java_package_path: The Java package path. (string)
+    files_in_group: Whether the JS files are all children of the project.
+      Projects whose files were saved before that are migrated by their next
+      update of the files. (boolean)
   """
 
   # Project specific information
@@ -48,6 +52,8 @@ class StorageProjectMetadata(db.Model):
 
   common_methods = db.StringListProperty(default=[])
 
+  files_in_group = db.BooleanProperty(required=False, default=False)
+
 
 def GetOrInsertProject(name):
   """Gets or inserts a project object.
@@ -64,7 +70,8 @@ def GetOrInsertProject(name):
 
   project = StorageProjectMetadata.get_by_key_name(name)
   if project is None:
-    project = StorageProjectMetadata(key_name=name, name=name)
+    project = StorageProjectMetadata(key_name=name, name=name,
+                                     files_in_group=True)
     if project is None:
       return None
     project.put()
@@ -94,15 +101,12 @@ def GetProjectJson(name):
 
 def GetJsFiles(project):
   """Gets the JS files associated with a project."""
-  files = []
-  js_files = project.jsfile_set.get() or {}
-  if isinstance(js_files, JsFile):
-    js_files = [js_files]
-
-  for js_file in js_files:
-    files.append({'name': js_file.name,
-                  'code': js_file.code})
-  return files
+  if project.files_in_group:
+    js_files = _GetFiles(project)
+  else:
+    js_files = project.jsfile_set
+  return [{'name': js_file.name, 'code': js_file.code}
+          for js_file in js_files]
 
 
 def GetProjectObject(name):
@@ -152,19 +156,40 @@ def UpdateProject(name, data):
   if project is None:
     return None
 
-  if 'page_map' in data and data['page_map']:
-    project.page_map = data['page_map']
-  if 'java_package_path' in data:
-    project.java_package_path = data['java_package_path'] or ''
-  if 'params' in data and data['params']:
-    project.params = data['params']
-  if 'js_files' in data and data['js_files'] is not None:
-    DeleteFiles(project)
-    SaveFiles(project, data['js_files'])
-  if 'common_methods' in data and data['common_methods'] is not None:
-    project.common_methods = data['common_methods']
-
-  project.put()
+  js_files = data.get('js_files')
+  legacy_files = []
+  if js_files is not None:
+    # Files saved before they were stored in the project entity group can not
+    # be written in the transaction. The transaction replaces them with new
+    # ones and sets files_in_group, from when on they are no longer read, so
+    # they are deleted after it. If that fails, they are deleted by the next
+    # update instead.
+    legacy_files = _GetLegacyFiles(project)
+
+  def _Transaction():
+    project = StorageProjectMetadata.get_by_key_name(name)
+    if 'page_map' in data and data['page_map']:
+      project.page_map = data['page_map']
+    if 'java_package_path' in data:
+      project.java_package_path = data['java_package_path'] or ''
+    if 'params' in data and data['params']:
+      project.params = data['params']
+    if 'common_methods' in data and data['common_methods'] is not None:
+      project.common_methods = data['common_methods']
+
+    to_put = [project]
+    if js_files is not None:
+      project.files_in_group = True
+      changed, removed = _DiffFiles(project, js_files)
+      to_put.extend(changed)
+      if removed:
+        db.delete(removed)
+    db.put(to_put)
+    return project
+
+  project = db.run_in_transaction(_Transaction)
+  if legacy_files:
+    db.delete(legacy_files)
 
   return project
 
@@ -178,29 +203,73 @@ def GetProjectNames():
 class JsFile(db.Model):
   """Stores the JS file associated with a project.
 
+  Files are children of their project, keyed by file name, so they can be
+  updated in the same transaction as the project. Older files only
+  reference the project and are migrated on the next update.
+
   Attributes:
     name: The JS file name.
     code: The JS code.
+    content_hash: SHA-1 of the code, used to skip rewriting unchanged files.
   """
 
   name = db.StringProperty(required=True)
   code = db.TextProperty(required=False, default='')
   project = db.ReferenceProperty(StorageProjectMetadata)
+  content_hash = db.StringProperty(required=False)
+
+
+def _HashCode(code):
+  return hashlib.sha1((code or '').encode('utf-8')).hexdigest()
+
+
+def _GetFiles(project):
+  """Gets the files stored in the project entity group."""
+  return list(JsFile.all().ancestor(project))
+
+
+def _GetLegacyFiles(project):
+  """Gets the files referencing the project outside of its entity group."""
+  return [js_file for js_file in project.jsfile_set
+          if js_file.parent_key() != project.key()]
+
+
+def _DiffFiles(project, files):
+  """Computes the writes needed to make the project files match files.
+
+  Args:
+    project: The project the files belong to.
+    files: The new list of files, as dicts with name and code.
+
+  Returns:
+    A (changed, removed) tuple with the JsFile entities to put and the
+    existing ones to delete.
+  """
+  existing = dict((js_file.key().name(), js_file)
+                  for js_file in _GetFiles(project))
+  changed = []
+  new_files = dict((js_file['name'], js_file['code'] or '')
+                   for js_file in files)
+  for name, code in new_files.iteritems():
+    code_hash = _HashCode(code)
+    current = existing.pop(name, None)
+    if current:
+      current_hash = current.content_hash or _HashCode(current.code)
+      if current_hash == code_hash:
+        continue
+    changed.append(JsFile(key_name=name, parent=project, name=name,
+                          code=code, project=project,
+                          content_hash=code_hash))
+  return changed, existing.values()
 
 
 def SaveFiles(project, files):
   """Saves the JS files associated with the given project."""
-  entities = []
-  for file in files:
-    entity = JsFile(name=file['name'],
-                    code=file['code'],
-                    project=project)
-    entities.append(entity)
-  db.put(entities)
+  changed, _ = _DiffFiles(project, files)
+  project.files_in_group = True
+  db.put(changed + [project])
 
 
 def DeleteFiles(project):
   """Removes the files associated with the given project."""
-  js_files = project.jsfile_set.get()
-  if js_files:
-    db.delete(js_files)
+  db.delete(_GetFiles(project) + _GetLegacyFiles(project))
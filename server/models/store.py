@@ -16,9 +16,27 @@
 
 __author__ = 'phu@google.com (Po Hu)'
 
+import hashlib
 import json
 import logging
+import time
+
+from google.appengine.api import memcache
 from google.appengine.ext import db
+from google.appengine.ext import deferred
+from models import search_index
+
+
+# Datastore limit on the number of values in an IN filter.
+_MAX_IN_FILTER_VALUES = 30
+
+# Memcache key of the store generation; bumped whenever a method or
+# dependency changes so that previously cached bundles are never served.
+_GENERATION_KEY = 'store_generation'
+
+_BUNDLE_CACHE_TIME = 3600  # 1 hour.
+
+DEFAULT_REINDEX_BATCH = 100
 
 
 class CodeData(db.Model):
@@ -53,18 +71,106 @@ class MethodMetaData(db.Model):
 
 
 def GetDepsByNames(names):
-  """Gets the deps string by names."""
-
-  result = ''
-  temp_code = ''
+  """Gets the deps string by names.
+
+  The bundle holds the code of every named method, each preceded by its
+  dependency the first time that dependency is needed, so dependencies shared
+  by several methods are only included once. Bundles are cached per set of
+  names until any method or dependency in the store changes; bundles too
+  large for memcache are built on every call instead.
+
+  Args:
+    names: The list of method names.
+
+  Returns:
+    The bundled JS code. (string)
+  """
+  cache_key = _GetBundleCacheKey(names)
+  bundle = memcache.get(cache_key)
+  if bundle is None:
+    bundle = _BundleMethods(names)
+    try:
+      memcache.set(cache_key, bundle, _BUNDLE_CACHE_TIME)
+    except ValueError:
+      # Raised for values over the memcache size limit.
+      logging.warning('Not caching the %d characters bundle of %d methods.',
+                      len(bundle), len(names))
+  return bundle
+
+
+def _GetBundleCacheKey(names):
+  """Gets the memcache key of the bundle for the given method names."""
+  generation = memcache.get(_GENERATION_KEY)
+  if generation is None:
+    # Seed with the current time so a generation evicted from memcache never
+    # restarts at a value that older bundles were cached under.
+    memcache.add(_GENERATION_KEY, int(time.time()))
+    generation = memcache.get(_GENERATION_KEY)
+  names_hash = hashlib.sha1('\n'.join(names).encode('utf-8')).hexdigest()
+  return 'store_bundle_%s_%s' % (generation, names_hash)
+
+
+def _InvalidateBundles():
+  """Makes all cached bundles stale."""
+  if memcache.incr(_GENERATION_KEY) is None:
+    memcache.add(_GENERATION_KEY, int(time.time()))
+
+
+def _BundleMethods(names):
+  """Builds the code bundle for the given method names from the datastore.
+
+  Methods are fetched with IN queries and all referenced code and
+  dependencies with two batch gets, instead of dereferencing every method.
+
+  Args:
+    names: The list of method names.
+
+  Returns:
+    The bundled JS code. (string)
+  """
+  methods_by_name = {}
+  unique_names = list(set(names))
+  for i in range(0, len(unique_names), _MAX_IN_FILTER_VALUES):
+    chunk = unique_names[i:i + _MAX_IN_FILTER_VALUES]
+    for method in MethodMetaData.all().filter('name IN', chunk):
+      methods_by_name.setdefault(method.name, method)
+
+  # Keep the requested order; popping skips names listed more than once.
+  methods = []
   for name in names:
-    method = GetMethodByName(name)
-    if method:
-      temp_code = method.code.text
-      if method.dependency:
-        temp_code = method.dependency.code.text + temp_code
-      result += temp_code
-  return result
+    method = methods_by_name.pop(name, None)
+    if method and MethodMetaData.code.get_value_for_datastore(method):
+      methods.append(method)
+
+  code_keys = [MethodMetaData.code.get_value_for_datastore(method)
+               for method in methods]
+  deps_keys = [MethodMetaData.dependency.get_value_for_datastore(method)
+               for method in methods]
+  unique_deps_keys = list(set([key for key in deps_keys if key]))
+  entities = db.get(code_keys + unique_deps_keys)
+  codes = entities[:len(code_keys)]
+  deps = dict(zip(unique_deps_keys, entities[len(code_keys):]))
+
+  deps_code_keys = {}
+  for key, deps_instance in deps.iteritems():
+    if deps_instance:
+      code_key = DependencyMetaData.code.get_value_for_datastore(deps_instance)
+      if code_key:
+        deps_code_keys[key] = code_key
+  deps_codes = dict(zip(deps_code_keys.keys(),
+                        db.get(deps_code_keys.values())))
+
+  parts = []
+  included_deps = set()
+  for code, deps_key in zip(codes, deps_keys):
+    if deps_key and deps_key not in included_deps:
+      included_deps.add(deps_key)
+      deps_code = deps_codes.get(deps_key)
+      if deps_code:
+        parts.append(deps_code.text)
+    if code:
+      parts.append(code.text)
+  return ''.join(parts)
 
 
 def UpdateDependency(deps_name, deps_code):
@@ -83,6 +189,7 @@ def UpdateDependency(deps_name, deps_code):
                                        code=code_instance)
     deps_instance.put()
 
+  _InvalidateBundles()
   return deps_instance
 
 
@@ -103,6 +210,8 @@ def InsertMethod(method_code, method_name, description,
                           author=author)
   method.put()
 
+  _InvalidateBundles()
+  IndexMethod(method)
   return method
 
 
@@ -120,6 +229,9 @@ def UpdateMethod(method_code, method_name, description,
   method_instance.addl_labels = addl_labels
   method_instance.put()
 
+  _InvalidateBundles()
+  IndexMethod(method_instance)
+
 
 def GetDepsByName(deps_name):
   """Gets the entity of the given dependency name."""
@@ -137,6 +249,52 @@ def GetMethodByName(method_name):
   return q.get()
 
 
+def IndexMethod(method):
+  """Adds or updates the search index entry of the given method."""
+  search_index.IndexDocument(
+      search_index.METHOD, method.key(), method.name,
+      [method.name, method.primary_label] + method.addl_labels,
+      [method.description])
+
+
+def ReindexMethods(cursor=None):
+  """Rebuilds the search index of all the methods, one batch per task."""
+  q = MethodMetaData.all()
+  if cursor:
+    q.with_cursor(cursor)
+  methods = q.fetch(DEFAULT_REINDEX_BATCH)
+  for method in methods:
+    IndexMethod(method)
+  if len(methods) == DEFAULT_REINDEX_BATCH:
+    deferred.defer(ReindexMethods, q.cursor())
+
+
+def SearchMethods(query, limit=search_index.DEFAULT_PAGE_SIZE, cursor=None):
+  """Searches the methods by name, description and labels.
+
+  Args:
+    query: The query string, see search_index.Search.
+    limit: Maximum number of methods returned.
+    cursor: Cursor returned with the previous page, if any.
+
+  Returns:
+    A (methods, cursor, more) tuple, where methods is a list of method
+    summaries without code.
+  """
+  results = search_index.Search(search_index.METHOD, query,
+                                limit=limit, cursor=cursor)
+  methods = []
+  for method in db.get(results.keys):
+    if method:
+      methods.append({'methodName': method.name,
+                      'description': method.description,
+                      'primaryLabel': method.primary_label,
+                      'addlLabels': method.addl_labels,
+                      'author': method.author,
+                      'key': str(method.key())})
+  return methods, results.cursor, results.more
+
+
 def GetMethodsByPrimaryLabel(label):
   """Gets the methods by primary label."""
   q = MethodMetaData.all()
@@ -165,6 +323,8 @@ def DeleteMethod(key):
   if method:
     db.delete(method.code)
     db.delete(method)
+    _InvalidateBundles()
+    search_index.RemoveDocuments(search_index.METHOD, [method.key()])
 
 
 def GetMethodDetailsByInstance(method):
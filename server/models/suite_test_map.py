@@ -22,10 +22,14 @@ __author__ = 'phu@google.com (Po Hu)'
 #Import not at top
 #pylint: disable-msg=C6204
 try:
+  import itertools
+  import logging
   from google.appengine.ext import db
   from models import bite_suite
   from utils import basic_util
 except ImportError:
+  import itertools
+  import logging
   from google.appengine.ext import db
   from models import bite_suite
   from utils import basic_util
@@ -34,6 +38,17 @@ except ImportError:
 DEFAULT_TEST_ID_LIST_LENGTH = 200
 DEFAULT_PUT_DELETE_MAX = 500
 
+# Maximum number of values of an IN filter.
+_MAX_IN_FILTER_VALUES = 30
+
+# Separates the dimension name from its value in a dimension label, e.g.
+# "browser:chrome".
+_DIMENSION_SEPARATOR = ':'
+
+# Appended to the id and name of an expanded test, with the labels of its
+# dimensions combination, e.g. "login[browser:chrome,locale:en]".
+_COMBINATION_SUFFIX = '[%s]'
+
 
 class Error(Exception):
   pass
@@ -48,24 +63,138 @@ class DuplicatedProjectNameError(Error):
 
 
 class SuiteTestsMap(db.Model):
-  """Contains suite and tests association."""
+  """Contains suite and tests association.
+
+  labels is the union of the labels of the tests in the chunk; it indexes
+  the chunks by label. Chunks stored before it existed have labels_indexed
+  unset.
+  """
   suite = db.ReferenceProperty(bite_suite.BiteSuite,
                                collection_name='suite_tests_map')
   created_time = db.DateTimeProperty(required=False, auto_now_add=True)
   test_info_list_str = db.TextProperty()
+  labels = db.StringListProperty(default=None)
+  labels_indexed = db.BooleanProperty(required=False, default=False)
+
+
+def _GetTestLabels(test_info):
+  return test_info.get('labels') or []
+
 
+def _MatchesLabels(test_info, labels):
+  return bool(set(_GetTestLabels(test_info)).intersection(labels))
 
-def GetAllTestInfoOfSuite(suite_key_str):
+
+def _IsLabelIndexUsable(suite_key, labels):
+  """Whether the chunks matching labels can be found with the label index."""
+  if len(labels) > _MAX_IN_FILTER_VALUES:
+    return False
+  total = SuiteTestsMap.all(keys_only=True).filter(
+      'suite =', suite_key).count()
+  indexed = SuiteTestsMap.all(keys_only=True).filter(
+      'suite =', suite_key).filter('labels_indexed =', True).count()
+  if indexed != total:
+    logging.info('%d test chunks of %s are not indexed by label.',
+                 total - indexed, suite_key)
+  return indexed == total
+
+
+def GetAllTestInfoOfSuite(suite_key_str, labels=None):
+  """Gets the tests of a suite.
+
+  Args:
+    suite_key_str: The key string of the suite.
+    labels: If given, only the tests with at least one of these labels are
+        returned.
+
+  Returns:
+    A list of test info dicts.
+  """
   test_info_list = []
   suite_key = db.Key(suite_key_str)
   queries = SuiteTestsMap.all().filter('suite =', suite_key)
+  if labels and _IsLabelIndexUsable(suite_key, labels):
+    queries.filter('labels IN', list(labels))
   test_info_lists = [basic_util.ParseJsonStr(query.test_info_list_str)
                      for query in queries]
   for test_info in test_info_lists:
     test_info_list.extend(test_info)
+  if labels:
+    test_info_list = [test_info for test_info in test_info_list
+                      if _MatchesLabels(test_info, labels)]
   return test_info_list
 
 
+def _GetDimensions(dimension_labels):
+  """Groups dimension labels by dimension.
+
+  Labels are "name:value" pairs; labels without a name form one unnamed
+  dimension.
+
+  Args:
+    dimension_labels: A list of dimension labels.
+
+  Returns:
+    A list of lists of labels, one per dimension, in order of appearance.
+  """
+  dimensions = {}
+  names = []
+  for label in dimension_labels:
+    name = ''
+    if _DIMENSION_SEPARATOR in label:
+      name = label.split(_DIMENSION_SEPARATOR, 1)[0]
+    if name not in dimensions:
+      dimensions[name] = []
+      names.append(name)
+    if label not in dimensions[name]:
+      dimensions[name].append(label)
+  return [dimensions[name] for name in names]
+
+
+def ExpandDimensions(test_info_list, dimension_labels):
+  """Expands the tests over the cartesian product of the dimensions.
+
+  For example, the dimension labels
+  ['browser:chrome', 'browser:firefox', 'locale:en', 'locale:fr'] turn every
+  test into four tests, one per browser and locale combination. The
+  combination is added to the labels of each expanded test, and appended to
+  its id and name so that the results of the combinations stay distinct.
+
+  Args:
+    test_info_list: A list of test info dicts.
+    dimension_labels: A list of dimension labels.
+
+  Returns:
+    The list of expanded test info dicts.
+  """
+  if not dimension_labels:
+    return test_info_list
+  combinations = list(itertools.product(*_GetDimensions(dimension_labels)))
+  expanded = []
+  for test_info in test_info_list:
+    for combination in combinations:
+      suffix = _COMBINATION_SUFFIX % ','.join(combination)
+      expanded_info = dict(test_info)
+      expanded_info['id'] = '%s%s' % (test_info['id'], suffix)
+      expanded_info['name'] = '%s%s' % (test_info['name'], suffix)
+      expanded_info['dimensions'] = list(combination)
+      expanded_info['labels'] = (_GetTestLabels(test_info) +
+                                 list(combination))
+      expanded.append(expanded_info)
+  return expanded
+
+
+def _CreateChunk(suite_key, test_info_list):
+  labels = set()
+  for test_info in test_info_list:
+    labels.update(_GetTestLabels(test_info))
+  return SuiteTestsMap(suite=suite_key,
+                       test_info_list_str=basic_util.DumpJsonStr(
+                           test_info_list),
+                       labels=sorted(labels),
+                       labels_indexed=True)
+
+
 def AddTestsToSuite(suite_key_str, test_info_list):
   """Adds tests to a suite."""
   if not suite_key_str:
@@ -73,6 +202,9 @@ def AddTestsToSuite(suite_key_str, test_info_list):
   suite_key = db.Key(suite_key_str)
   if not test_info_list:
     return
+  # Tests with the same labels are stored together, so the label index of
+  # the chunks is selective.
+  test_info_list.sort(key=lambda test_info: sorted(_GetTestLabels(test_info)))
   map_list = []
   # Deals with a potentially very large list.
   while True:
@@ -80,16 +212,12 @@ def AddTestsToSuite(suite_key_str, test_info_list):
       db.put(map_list)
       map_list = []
     if len(test_info_list) >= DEFAULT_TEST_ID_LIST_LENGTH:
-      map_list.append(SuiteTestsMap(
-          suite=suite_key,
-          test_info_list_str=basic_util.DumpJsonStr(
-              test_info_list[:DEFAULT_TEST_ID_LIST_LENGTH])))
+      map_list.append(_CreateChunk(
+          suite_key, test_info_list[:DEFAULT_TEST_ID_LIST_LENGTH]))
       del test_info_list[:DEFAULT_TEST_ID_LIST_LENGTH]
     else:
       if test_info_list:
-        map_list.append(SuiteTestsMap(
-            suite=suite_key,
-            test_info_list_str=basic_util.DumpJsonStr(test_info_list)))
+        map_list.append(_CreateChunk(suite_key, test_info_list))
       break
   if map_list:
     db.put(map_list)
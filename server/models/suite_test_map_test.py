@@ -0,0 +1,110 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the dimension expansion of models.suite_test_map.
+
+Requires the App Engine SDK on the path. Run from the server folder with:
+  python -m models.suite_test_map_test
+"""
+
+import random
+import unittest
+
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+from models import bite_result
+from models import bite_run
+from models import suite_test_map
+
+
+class ExpandDimensionsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tests = [{'id': '1', 'name': 'one', 'labels': ['smoke']},
+                  {'id': '2', 'name': 'two'}]
+
+  def testNoDimensionsKeepsTests(self):
+    self.assertEqual(self.tests,
+                     suite_test_map.ExpandDimensions(self.tests, []))
+    self.assertEqual(self.tests,
+                     suite_test_map.ExpandDimensions(self.tests, None))
+
+  def testCartesianProductOfNamedDimensions(self):
+    expanded = suite_test_map.ExpandDimensions(
+        self.tests, ['browser:chrome', 'locale:en', 'browser:firefox',
+                     'locale:fr'])
+    self.assertEqual(8, len(expanded))
+    self.assertEqual(
+        [['browser:chrome', 'locale:en'],
+         ['browser:chrome', 'locale:fr'],
+         ['browser:firefox', 'locale:en'],
+         ['browser:firefox', 'locale:fr']],
+        [test['dimensions'] for test in expanded[:4]])
+    self.assertEqual(
+        ['1[browser:chrome,locale:en]', '1[browser:chrome,locale:fr]',
+         '1[browser:firefox,locale:en]', '1[browser:firefox,locale:fr]'],
+        [test['id'] for test in expanded[:4]])
+    self.assertEqual('two[browser:firefox,locale:fr]', expanded[7]['name'])
+
+  def testCombinationIsAddedToLabels(self):
+    expanded = suite_test_map.ExpandDimensions(self.tests, ['browser:chrome'])
+    self.assertEqual(['smoke', 'browser:chrome'], expanded[0]['labels'])
+    self.assertEqual(['browser:chrome'], expanded[1]['labels'])
+    # The original test infos are left untouched.
+    self.assertEqual(['smoke'], self.tests[0]['labels'])
+    self.assertFalse('dimensions' in self.tests[1])
+
+  def testUnnamedAndDuplicateLabels(self):
+    expanded = suite_test_map.ExpandDimensions(
+        self.tests[:1], ['fast', 'slow', 'fast', 'os:linux'])
+    self.assertEqual([['fast', 'os:linux'], ['slow', 'os:linux']],
+                     [test['dimensions'] for test in expanded])
+
+
+class ExpandedResultsTest(unittest.TestCase):
+  """Checks that the results of expanded tests are told apart."""
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.run_key = db.Key.from_path(bite_run.BiteRun.kind(), 1)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testEachCombinationReportsItsOwnResult(self):
+    expanded = suite_test_map.ExpandDimensions(
+        [{'id': '1', 'name': 'one'}], ['browser:chrome', 'browser:firefox'])
+    # Added the way deferred_util.KickOffTests adds the results of a run.
+    db.put([bite_result.BiteResult(run=self.run_key,
+                                   test_id=test_info['id'],
+                                   test_name=test_info['name'],
+                                   status='queued',
+                                   random=random.random())
+            for test_info in expanded])
+
+    # Looked up the way UpdateResultHandler finds the result to report.
+    reported = [bite_result.GetResult(str(self.run_key), test_info['id'],
+                                      test_info['name']).get()
+                for test_info in expanded]
+    self.assertEqual([test_info['id'] for test_info in expanded],
+                     [result.test_id for result in reported])
+    self.assertNotEqual(reported[0].key(), reported[1].key())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,94 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bite test duration model.
+
+Keeps the durations of the latest executions of each test, used to estimate
+how long a test takes so runs can hand out the longest tests first.
+"""
+
+from google.appengine.ext import db
+
+
+# Number of executions remembered per test.
+DEFAULT_SAMPLES_NUM = 20
+
+# Percentile of the remembered durations used as the estimate.
+DEFAULT_PERCENTILE = 90
+
+# Number of durations read per batch get.
+DEFAULT_GET_BATCH = 500
+
+
+class BiteTestDuration(db.Model):
+  """Contains the latest durations of a test, keyed by test id.
+
+  Attributes:
+    samples: Durations of the latest executions in seconds, oldest first.
+    estimate: The DEFAULT_PERCENTILE percentile of the samples.
+  """
+  samples = db.ListProperty(float, indexed=False)
+  estimate = db.FloatProperty(required=False, indexed=False)
+  last_modified_time = db.DateTimeProperty(required=False, auto_now=True)
+
+
+def _GetPercentile(values, percentile):
+  """Gets the nearest-rank percentile of a non empty list of values."""
+  values = sorted(values)
+  rank = int(round(percentile / 100.0 * (len(values) - 1)))
+  return values[rank]
+
+
+def AddDuration(test_id, seconds):
+  """Records the duration of an execution of a test.
+
+  Args:
+    test_id: The id of the test.
+    seconds: How long the execution took, in seconds.
+
+  Returns:
+    The updated BiteTestDuration.
+  """
+  key_name = str(test_id)
+
+  def _Txn():
+    duration = BiteTestDuration.get_by_key_name(key_name)
+    if not duration:
+      duration = BiteTestDuration(key_name=key_name)
+    duration.samples.append(float(seconds))
+    del duration.samples[:-DEFAULT_SAMPLES_NUM]
+    duration.estimate = _GetPercentile(duration.samples, DEFAULT_PERCENTILE)
+    duration.put()
+    return duration
+  return db.run_in_transaction(_Txn)
+
+
+def GetEstimates(test_ids):
+  """Gets the estimated durations of tests.
+
+  Args:
+    test_ids: A list of test ids.
+
+  Returns:
+    A dict of test id to estimated seconds; tests never executed are left
+    out.
+  """
+  keys = [db.Key.from_path('BiteTestDuration', str(test_id))
+          for test_id in set(test_ids)]
+  estimates = {}
+  for i in range(0, len(keys), DEFAULT_GET_BATCH):
+    for duration in db.get(keys[i:i + DEFAULT_GET_BATCH]):
+      if duration:
+        estimates[duration.key().name()] = duration.estimate
+  return estimates
@@ -0,0 +1,81 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Instance local least recently used cache.
+
+The cache lives in the memory of one instance and is shared by the threads
+serving its requests, so it is meant for small, rarely changing values that
+are read on most requests.
+"""
+
+import collections
+import threading
+import time
+
+
+class LruCache(object):
+  """Thread safe cache evicting the least recently used entries."""
+
+  def __init__(self, max_size, ttl=None):
+    """Creates an empty cache.
+
+    Args:
+      max_size: Maximum number of entries kept. (integer)
+      ttl: Seconds an entry is kept after being put, forever if None.
+          (number)
+    """
+    self._max_size = max_size
+    self._ttl = ttl
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def Get(self, key):
+    """Gets a cached value.
+
+    Args:
+      key: The key of the entry.
+
+    Returns:
+      A (found, value) tuple, so that cached None values can be told apart
+      from misses.
+    """
+    with self._lock:
+      if key not in self._entries:
+        return False, None
+      expiry, value = self._entries.pop(key)
+      if expiry is not None and expiry <= time.time():
+        return False, None
+      self._entries[key] = (expiry, value)
+      return True, value
+
+  def Put(self, key, value):
+    """Caches a value, evicting the least recently used entry if full."""
+    expiry = None
+    if self._ttl is not None:
+      expiry = time.time() + self._ttl
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = (expiry, value)
+      while len(self._entries) > self._max_size:
+        self._entries.popitem(last=False)
+
+  def Delete(self, key):
+    """Removes an entry, if present."""
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def Clear(self):
+    """Removes all entries."""
+    with self._lock:
+      self._entries.clear()
@@ -0,0 +1,104 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for utils.lru_cache.
+
+Run from the server folder with: python -m utils.lru_cache_test
+"""
+
+import unittest
+
+from utils import lru_cache
+
+
+class LruCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cache = lru_cache.LruCache(2)
+
+  def testMiss(self):
+    self.assertEqual((False, None), self.cache.Get('a'))
+
+  def testCachedNoneIsAHit(self):
+    self.cache.Put('a', None)
+    self.assertEqual((True, None), self.cache.Get('a'))
+
+  def testEvictsLeastRecentlyPut(self):
+    self.cache.Put('a', 1)
+    self.cache.Put('b', 2)
+    self.cache.Put('c', 3)
+    self.assertEqual((False, None), self.cache.Get('a'))
+    self.assertEqual((True, 2), self.cache.Get('b'))
+    self.assertEqual((True, 3), self.cache.Get('c'))
+
+  def testGetRefreshesEntry(self):
+    self.cache.Put('a', 1)
+    self.cache.Put('b', 2)
+    self.cache.Get('a')
+    self.cache.Put('c', 3)
+    self.assertEqual((True, 1), self.cache.Get('a'))
+    self.assertEqual((False, None), self.cache.Get('b'))
+
+  def testPutReplacesValue(self):
+    self.cache.Put('a', 1)
+    self.cache.Put('a', 2)
+    self.cache.Put('b', 3)
+    self.assertEqual((True, 2), self.cache.Get('a'))
+    self.assertEqual((True, 3), self.cache.Get('b'))
+
+  def testDeleteAndClear(self):
+    self.cache.Put('a', 1)
+    self.cache.Put('b', 2)
+    self.cache.Delete('a')
+    self.cache.Delete('missing')
+    self.assertEqual((False, None), self.cache.Get('a'))
+    self.cache.Clear()
+    self.assertEqual((False, None), self.cache.Get('b'))
+
+
+class LruCacheTtlTest(unittest.TestCase):
+
+  def setUp(self):
+    self.now = 1000.0
+    self.original_time = lru_cache.time.time
+    lru_cache.time.time = lambda: self.now
+    self.cache = lru_cache.LruCache(2, ttl=60)
+
+  def tearDown(self):
+    lru_cache.time.time = self.original_time
+
+  def testEntryExpires(self):
+    self.cache.Put('a', 1)
+    self.now += 59
+    self.assertEqual((True, 1), self.cache.Get('a'))
+    self.now += 1
+    self.assertEqual((False, None), self.cache.Get('a'))
+
+  def testGetDoesNotExtendTtl(self):
+    self.cache.Put('a', 1)
+    self.now += 30
+    self.cache.Get('a')
+    self.now += 30
+    self.assertEqual((False, None), self.cache.Get('a'))
+
+  def testPutRestartsTtl(self):
+    self.cache.Put('a', 1)
+    self.now += 30
+    self.cache.Put('a', 2)
+    self.now += 30
+    self.assertEqual((True, 2), self.cache.Get('a'))
+
+
+if __name__ == '__main__':
+  unittest.main()
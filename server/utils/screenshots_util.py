@@ -25,11 +25,40 @@ from utils import url_util
 # Path to the get screenshots API.
 GET_PATH = '/screenshots/fetch'
 
+# Largest image accepted by the binary upload API, kept under the datastore
+# entity size limit.
+MAX_UPLOAD_BYTES = 1000000
 
-def RetrievalUrl(request_url, screenshot_id):
-  """Returns URL to fetch a screenshot by id."""
+# Size name used for the thumbnails returned by the search API.
+THUMBNAIL_SIZE = 'thumbnail'
+
+# Leading bytes identifying the supported image formats.
+_MAGIC_NUMBERS = [
+    ('\x89PNG\r\n\x1a\n', 'image/png'),
+    ('\xff\xd8\xff', 'image/jpeg')
+]
+
+
+def RetrievalUrl(request_url, screenshot_id, size=None):
+  """Returns URL to fetch a screenshot by id, optionally downscaled."""
   base_url = url_util.GetBaseUrl(request_url)
-  return base_url + GET_PATH + '?id=' + str(screenshot_id)
+  url = base_url + GET_PATH + '?id=' + str(screenshot_id)
+  if size:
+    url += '&size=' + size
+  return url
+
+
+def ThumbnailUrl(request_url, screenshot_id):
+  """Returns URL to fetch the thumbnail of a screenshot by id."""
+  return RetrievalUrl(request_url, screenshot_id, THUMBNAIL_SIZE)
+
+
+def DetectContentType(data):
+  """Returns the MIME type of PNG or JPEG image data, or None otherwise."""
+  for magic, content_type in _MAGIC_NUMBERS:
+    if data.startswith(magic):
+      return content_type
+  return None
 
 
 def DecodeBase64PNG(data):
@@ -37,3 +66,19 @@ def DecodeBase64PNG(data):
   content = data[len(prefix):]
   return base64.b64decode(content)
 
+
+def DecodeDataUrl(data):
+  """Decodes a base64 data URL holding a PNG or JPEG image.
+
+  Args:
+    data: The data URL, e.g. "data:image/jpeg;base64,...".
+
+  Returns:
+    A (content_type, bytes) tuple. Content types other than JPEG are treated
+    as PNG, matching DecodeBase64PNG.
+  """
+  header, _, content = data.partition(',')
+  content_type = 'image/png'
+  if header.startswith('data:image/jpeg'):
+    content_type = 'image/jpeg'
+  return content_type, base64.b64decode(content)
@@ -0,0 +1,71 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Polls the version of the product a suite is run against.
+
+A suite's latest version URL serves the current build of the product, e.g.
+a build number or a version string. Scheduled jobs compare it with the last
+version they ran against to only start runs for new builds.
+"""
+
+import logging
+import sha
+
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
+
+
+# Jobs polling the same URL in one scheduler tick share a single fetch.
+_VERSION_CACHE_TIME = 60
+
+_FETCH_DEADLINE = 10
+
+# Versions longer than this are truncated, so they fit a StringProperty.
+_MAX_VERSION_LENGTH = 400
+
+
+def _GetCacheKey(url):
+  return 'latest_version_%s' % sha.sha(url).hexdigest()
+
+
+def GetLatestVersion(url):
+  """Gets the version currently served by a latest version URL.
+
+  Args:
+    url: The latest version URL.
+
+  Returns:
+    The version string (the stripped first line of the response), or None if
+    it could not be fetched.
+  """
+  cache_key = _GetCacheKey(url)
+  version = memcache.get(cache_key)
+  if version is not None:
+    return version
+
+  try:
+    response = urlfetch.fetch(url, deadline=_FETCH_DEADLINE)
+  except urlfetch.Error, err:
+    logging.warning('Failed to fetch the latest version from %s: %s',
+                    url, err)
+    return None
+  if response.status_code != 200:
+    logging.warning('Fetching the latest version from %s returned %d.',
+                    url, response.status_code)
+    return None
+
+  lines = response.content.strip().splitlines() or ['']
+  version = lines[0].strip()[:_MAX_VERSION_LENGTH]
+  memcache.set(cache_key, version, _VERSION_CACHE_TIME)
+  return version
@@ -0,0 +1,94 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for utils.version_util, with a stubbed URL fetch.
+
+Requires the App Engine SDK on the path. Run from the server folder with:
+  python -m utils.version_util_test
+"""
+
+import unittest
+
+from google.appengine.api import urlfetch
+from google.appengine.ext import testbed
+
+from utils import version_util
+
+
+URL = 'http://build.example.com/latest'
+
+
+class FakeResponse(object):
+
+  def __init__(self, content, status_code=200):
+    self.content = content
+    self.status_code = status_code
+
+
+class GetLatestVersionTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+    self.fetched = []
+    self.response = FakeResponse('')
+    self.original_fetch = version_util.urlfetch.fetch
+    version_util.urlfetch.fetch = self._Fetch
+
+  def tearDown(self):
+    version_util.urlfetch.fetch = self.original_fetch
+    self.testbed.deactivate()
+
+  def _Fetch(self, url, deadline=None):
+    self.fetched.append(url)
+    if isinstance(self.response, Exception):
+      raise self.response
+    return self.response
+
+  def testReturnsStrippedFirstLine(self):
+    self.response = FakeResponse('  1.2.345 \nbuilt today\n')
+    self.assertEqual('1.2.345', version_util.GetLatestVersion(URL))
+
+  def testTruncatesLongVersions(self):
+    self.response = FakeResponse('x' * 1000)
+    self.assertEqual(version_util._MAX_VERSION_LENGTH,
+                     len(version_util.GetLatestVersion(URL)))
+
+  def testEmptyResponseIsEmptyVersion(self):
+    self.response = FakeResponse('\n')
+    self.assertEqual('', version_util.GetLatestVersion(URL))
+
+  def testCachesVersionPerUrl(self):
+    self.response = FakeResponse('42')
+    version_util.GetLatestVersion(URL)
+    self.response = FakeResponse('43')
+    self.assertEqual('42', version_util.GetLatestVersion(URL))
+    self.assertEqual([URL], self.fetched)
+
+    self.assertEqual('43', version_util.GetLatestVersion(URL + '/other'))
+
+  def testErrorStatusIsNotCached(self):
+    self.response = FakeResponse('oops', status_code=500)
+    self.assertEqual(None, version_util.GetLatestVersion(URL))
+    self.response = FakeResponse('42')
+    self.assertEqual('42', version_util.GetLatestVersion(URL))
+
+  def testFetchErrorReturnsNone(self):
+    self.response = urlfetch.DownloadError('timeout')
+    self.assertEqual(None, version_util.GetLatestVersion(URL))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -97,6 +97,14 @@ rpf.WorkerManager = function(
    */
   this.autoRunningTestId_ = 0;
 
+  /**
+   * The attempt of the running result, returned to the server with its
+   * status so that a report sent after the lease expired is ignored.
+   * @type {?number}
+   * @private
+   */
+  this.autoRunningAttempt_ = null;
+
   /**
    * The result's unique info string.
    * @type {string}
@@ -519,7 +527,8 @@ rpf.WorkerManager.prototype.updateRunningTestStatus = function(
     'result': goog.json.serialize({'result': {
       'runKey': this.currentRunKey_,
       'testName': this.playbackMgr_.getCurrentTestName(),
-      'testId': this.playbackMgr_.getCurrentTestId()}}),
+      'testId': this.playbackMgr_.getCurrentTestId(),
+      'attempt': this.autoRunningAttempt_}}),
     'status': result,
     'screenshot': dataUrl,
     'log': log,
@@ -598,6 +607,7 @@ rpf.WorkerManager.prototype.fetchDashboardStatusCallback_ = function(e) {
           console.log('The data string is:' + this.dataStr_);
         } else {
           this.autoRunningTestId_ = obj['result']['id'];
+          this.autoRunningAttempt_ = obj['result']['attempt'];
           this.newServerUniqueStr_ = resText;
           testId = obj['result']['testId'];
         }